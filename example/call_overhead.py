@@ -0,0 +1,39 @@
+import numpy as np
+import timeit
+
+from toydsl.driver.driver import computation
+
+# This import is not needed. Horizontal etc. are not used by the python interpretor, we
+# just leave the import here so that VS Code is happy. :)
+from toydsl.frontend.language import Horizontal, Vertical, end, start
+
+
+@computation
+def copy_stencil(out_field, in_field):
+    with Vertical[start:end]:
+        with Horizontal[start : end, start: end]:
+            out_field[0, 0, 0] = in_field[0, 0, 0]
+
+
+def time_call(function, num_calls):
+    """The best time of a single call in microseconds"""
+    return min(timeit.repeat(function, number=num_calls, repeat=5)) / num_calls * 1e6
+
+
+if __name__ == "__main__":
+    num_calls = 10000
+    boost_call = getattr(copy_stencil.module, "copy_stencil")
+
+    print("{:>6} {:>10} {:>10} {:>10}".format("size", "boost", "fast", "bound"))
+    for size in [1, 2, 4, 8, 16]:
+        input = np.ones((size, size, size))
+        output = np.zeros((size, size, size))
+        bounds = [[0, size], [0, size], [0, size]]
+        bound_call = copy_stencil.bind(output, input, *bounds)
+
+        print("{:>6} {:>8.2f}us {:>8.2f}us {:>8.2f}us".format(
+            "{}^3".format(size),
+            time_call(lambda: boost_call(output, input, *bounds), num_calls),
+            time_call(lambda: copy_stencil(output, input, *bounds), num_calls),
+            time_call(bound_call, num_calls),
+        ))
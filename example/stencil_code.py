@@ -59,9 +59,10 @@ if __name__ == "__main__":
     plt.close()
     
     start = time.time_ns()
-    for _ in range(num_runs):
-        lapoflap(output, input,tmp1, i, j, k)
-        input = output
+    # All the steps run in one call, after every step the output becomes the next input
+    output = lapoflap.run(
+        output, input, tmp1, i, j, k, steps=num_runs, swap=("out_field", "in_field")
+    )
     end = time.time_ns()
     print(output[:, :, 0].T)
 
@@ -27,6 +27,9 @@ setup(
     ],
     install_requires=requirements,
     extras_require={},
+    entry_points={
+        "console_scripts": ["toydsl=toydsl.__main__:main"],
+    },
     license="MIT license",
     include_package_data=True,
     name="toydsl",
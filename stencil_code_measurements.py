@@ -33,6 +33,18 @@ def lapoflap(out_field, in_field, tmp1_field):
             out_field[0, 0, 0] = in_field[0, 0, 0] - 0.03 * (-4.0 * tmp1_field[0,0,0] + tmp1_field[-1,0,0] + tmp1_field[1,0,0] + tmp1_field[0,-1,0] + tmp1_field[0,1,0])
 
 
+@computation(tile_sizes=(64, 16, 0))
+def lapoflap_tiled(out_field, in_field, tmp1_field):
+    """
+    lapoflap with the horizontal loops blocked into 64x16 tiles
+    """
+    with Vertical[start:end]:
+        with Horizontal[start+1 : end-1, start+1: end-1]:
+            tmp1_field[0, 0, 0] = -4.0 * in_field[0,0,0] + in_field[-1,0,0] + in_field[1,0,0] + in_field[0,-1,0] + in_field[0,1,0]
+        with Horizontal[start+1 : end-1, start+1: end-1]:
+            out_field[0, 0, 0] = in_field[0, 0, 0] - 0.03 * (-4.0 * tmp1_field[0,0,0] + tmp1_field[-1,0,0] + tmp1_field[1,0,0] + tmp1_field[0,-1,0] + tmp1_field[0,1,0])
+
+
 def set_up_data(vert,plane):
     """
     Set up the input for the test example
@@ -76,6 +88,7 @@ if __name__ == "__main__":
             # Warm up
             for _ in range(num_runs_warm):
                 # lapoflap(output_warm, input_warm,tmp1_warm, i_warm, j_warm, k_warm)
+                # lapoflap_tiled(output_warm, input_warm,tmp1_warm, i_warm, j_warm, k_warm)
                 copy_stencil(output_warm, input_warm,i_warm,j_warm,k_warm)
                 # vertical_blur(output_warm, input_warm,i_warm,j_warm,k_warm)
                 input = output
@@ -83,6 +96,7 @@ if __name__ == "__main__":
             start = time.time_ns()
             for _ in range(num_runs):
                 # lapoflap(output, input,tmp1, i, j, k)
+                # lapoflap_tiled(output, input,tmp1, i, j, k)
                 copy_stencil(output, input,i,j,k)
                 # vertical_blur(output, input,i,j,k)
                 input = output
@@ -106,11 +120,17 @@ if __name__ == "__main__":
 
     # print("Called DSL function {} times in {} seconds".format(num_runs, (end-start)/(10**9)))
         time_sizes.append(median(time_all))
+        # The copy reads and writes every point once, to compare with the STREAM copy bandwidth
+        bandwidth = 2 * output.nbytes * num_runs / time_sizes[-1] / 10**9
+        print("{}x{}x{}: {:.1f} GB/s".format(vert[index], plane[index], plane[index], bandwidth))
 
     print(time_sizes)
     # with open('lapoflap.npy', 'wb') as f:
     #     np.save(f, time_sizes)
 
+    # with open('lapoflap_tiled.npy', 'wb') as f:
+    #     np.save(f, time_sizes)
+
     # with open('vertical_blur.npy', 'wb') as f:
     #     np.save(f, time_sizes)
 
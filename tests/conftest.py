@@ -0,0 +1,15 @@
+import os
+
+import pytest
+
+
+@pytest.fixture(scope="session", autouse=True)
+def code_cache(tmp_path_factory):
+    """All the tests share one code cache, so that every stencil is only compiled once"""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        root = tmp_path_factory.mktemp("codecache")
+        monkeypatch.setenv("CODE_CACHE_ROOT", str(root))
+        # The direct build needs neither CMake nor access to the network
+        monkeypatch.setenv("TOYDSL_BUILD_MODE", os.getenv("TOYDSL_BUILD_MODE", "direct"))
+        monkeypatch.setenv("TOYDSL_COMPILATION", "eager")
+        yield root
@@ -0,0 +1,47 @@
+"""
+The search of the autotuner and its records, with a fake build instead of the compiler.
+"""
+
+import json
+import time
+
+import numpy as np
+
+from toydsl.driver.autotune import Autotuner
+
+
+class FakeBuild:
+    """Records the options of every variant that is built, the kernels without OpenMP are slow"""
+
+    def __init__(self):
+        self.built = []
+
+    def __call__(self, options):
+        self.built.append(dict(options))
+        delay = 0.0 if options.get("openmp") else 0.01
+        return lambda *args: time.sleep(delay)
+
+
+def test_schedule_is_only_tuned_with_openmp(tmp_path):
+    build = FakeBuild()
+    search_space = {"openmp": [False, True], "schedule": [None, "dynamic", "guided"]}
+    tuner = Autotuner(build, tmp_path / "autotune.json", search_space=search_space, repetitions=1)
+    tuner.search([np.zeros((2, 2, 2))])
+
+    for options in build.built:
+        assert options["openmp"] or options["schedule"] is None
+    assert {"openmp": True, "schedule": "guided"} in build.built
+    assert {"openmp": False, "schedule": None} in build.built
+
+
+def test_records_are_kept(tmp_path):
+    record_filename = tmp_path / "autotune.json"
+    tuner = Autotuner(FakeBuild(), record_filename, search_space={})
+    tuner.store_record("a", {"openmp": True})
+    tuner.store_record("b", {"openmp": False})
+
+    assert json.loads(record_filename.read_text()) == {
+        "a": {"openmp": True},
+        "b": {"openmp": False},
+    }
+    assert [path.name for path in tmp_path.iterdir()] == ["autotune.json"]
@@ -0,0 +1,98 @@
+"""
+The numpy and python backends have to compute what the C++ kernels compute, for every
+stencil, so that either can stand in for a kernel that is still being compiled.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from toydsl import bench
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import create_stencil, hash_source_code
+# The stencils are parsed from their source, the import keeps linters happy
+from toydsl.frontend.language import Horizontal, Vertical, end, start
+
+
+pytestmark = pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+
+shape = (6, 9, 11)
+
+bounds = [[0, size] for size in shape]
+
+
+def horizontal_dependency(out_field, in_field):
+    with Vertical[start:end]:
+        with Horizontal[start + 1 : end, start : end]:
+            out_field[0, 0, 0] = out_field[-1, 0, 0] + in_field[0, 0, 0]
+        with Horizontal[start : end, start + 1 : end]:
+            out_field[0, 0, 0] = out_field[0, -1, 0] * 0.5 + in_field[0, 0, 0]
+
+
+def vertical_dependency(out_field, in_field):
+    with Vertical[start + 1 : end]:
+        with Horizontal[start : end, start : end]:
+            out_field[0, 0, 0] = out_field[0, 0, -1] + in_field[0, 0, 0]
+
+
+def scalar_parameter(out_field, in_field, coeff: float):
+    with Vertical[start:end]:
+        with Horizontal[start + 1 : end - 1, start + 1 : end - 1]:
+            out_field[0, 0, 0] = in_field[0, 0, 0] + coeff * (
+                in_field[1, 0, 0] + in_field[-1, 0, 0] + in_field[0, 1, 0]
+            )
+
+
+stencils = {
+    **{name: benchmark.definition for name, benchmark in bench.benchmarks.items()},
+    "horizontal_dependency": horizontal_dependency,
+    "vertical_dependency": vertical_dependency,
+    "scalar_parameter": scalar_parameter,
+}
+
+# The value passed for every scalar parameter
+coeff = 0.25
+
+
+def run(definition, backend):
+    stencil = create_stencil(definition, hash_source_code(definition), backend=backend)
+    return call(stencil, definition)
+
+
+def call(stencil, definition):
+    """Calls a stencil on random fields and returns them"""
+    fields = [
+        np.random.RandomState(seed).rand(*shape) for seed in range(len(field_names(definition)))
+    ]
+    scalars = [coeff] * (len(argument_names(definition)) - len(fields))
+    stencil(*fields, *scalars, *bounds)
+    return fields
+
+
+def argument_names(definition):
+    return definition.__code__.co_varnames[: definition.__code__.co_argcount]
+
+
+def field_names(definition):
+    annotations = definition.__annotations__
+    return [name for name in argument_names(definition) if annotations.get(name) is not float]
+
+
+@pytest.mark.parametrize("name", sorted(stencils))
+@pytest.mark.parametrize("backend", ["numpy", "python"])
+def test_backend_matches_cpp(name, backend):
+    expected = run(stencils[name], "cpp")
+    for field, expected_field in zip(run(stencils[name], backend), expected):
+        np.testing.assert_allclose(field, expected_field, rtol=1e-12)
+
+
+@pytest.mark.parametrize("fallback", ["numpy", "python"])
+def test_fallback_matches_compiled_kernel(fallback):
+    definition = bench.lapoflap
+    stencil = create_stencil(
+        definition, hash_source_code(definition), compilation="lazy", fallback=fallback
+    )
+    expected = call(stencil.wait(), definition)
+    for field, expected_field in zip(call(stencil.fallback_kernel(), definition), expected):
+        np.testing.assert_allclose(field, expected_field, rtol=1e-12)
@@ -0,0 +1,103 @@
+"""
+The keys of the code cache and what is recorded in it.
+"""
+
+import multiprocessing
+import shutil
+
+import pytest
+
+from toydsl.driver.build import BuildTimer, build_precompiled_header
+from toydsl.driver.cache import CodeCache, compiler, touch_interval
+from toydsl.driver.driver import cpp_cache_key
+
+
+def test_key_depends_on_the_build(monkeypatch):
+    monkeypatch.setenv("TOYDSL_BUILD_MODE", "direct")
+    monkeypatch.setenv("TOYDSL_BUILD_TYPE", "Release")
+    monkeypatch.delenv("TOYDSL_CXXFLAGS", raising=False)
+    monkeypatch.delenv("TOYDSL_LDFLAGS", raising=False)
+    key = cpp_cache_key("stencil")
+    assert cpp_cache_key("stencil") == key
+    assert cpp_cache_key("other stencil") != key
+
+    keys = {key}
+    for variable, value in [
+        ("TOYDSL_CXXFLAGS", "-march=native"),
+        ("TOYDSL_LDFLAGS", "-Wl,--as-needed"),
+        ("TOYDSL_BUILD_TYPE", "Debug"),
+        ("TOYDSL_BUILD_MODE", "cmake"),
+    ]:
+        with monkeypatch.context() as context:
+            context.setenv(variable, value)
+            keys.add(cpp_cache_key("stencil"))
+    assert len(keys) == 5
+
+
+@pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+def test_failed_precompile_is_not_retried(monkeypatch, tmp_path):
+    monkeypatch.setenv("TOYDSL_CXXFLAGS", "-fno-such-flag")
+    assert build_precompiled_header(tmp_path, "Release", BuildTimer()) is None
+
+    timer = BuildTimer()
+    assert build_precompiled_header(tmp_path, "Release", timer) is None
+    assert "precompile" not in timer.phases
+
+
+def test_touch_only_updates_entries_used_long_ago(tmp_path):
+    cache = CodeCache(tmp_path)
+    (tmp_path / "cpp_entry").write_text("module")
+    cache.record("cpp_entry", {"backend": "cpp"})
+    index_stat = cache.index_filename.stat()
+
+    cache.touch("cpp_entry")
+    assert cache.index_filename.stat().st_ino == index_stat.st_ino
+
+    index = cache.load()
+    index["cpp_entry"]["last_used"] -= touch_interval
+    cache.store(index)
+    cache.touch("cpp_entry")
+    assert cache.load()["cpp_entry"]["last_used"] > index["cpp_entry"]["last_used"]
+
+
+def test_prune_evicts_least_recently_used_unlocked_entries(tmp_path, monkeypatch):
+    monkeypatch.setenv("TOYDSL_CACHE_SIZE", "0")
+    cache = CodeCache(tmp_path)
+    for n, entry in enumerate(["cpp_old", "cpp_building", "cpp_new"]):
+        (tmp_path / entry).write_bytes(b"x" * 100)
+        cache.record(entry, {"backend": "cpp"})
+        index = cache.load()
+        index[entry]["last_used"] = n
+        cache.store(index)
+
+    # Another process builds the entry, it holds its lock
+    with cache.lock("cpp_building"):
+        assert cache.prune(150) == ["cpp_old", "cpp_new"]
+
+    assert [metadata["entry"] for metadata in cache.entries()] == ["cpp_building"]
+    assert (tmp_path / "cpp_building").exists()
+    assert not (tmp_path / "cpp_old").exists()
+    assert not list(tmp_path.glob("*.tmp"))
+
+
+def record_entries(root, process):
+    cache = CodeCache(root)
+    for n in range(20):
+        entry = "cpp_{}_{}".format(process, n)
+        (root / entry).write_text("module")
+        cache.record(entry, {"backend": "cpp"})
+
+
+def test_concurrent_records_are_all_kept(tmp_path, monkeypatch):
+    monkeypatch.setenv("TOYDSL_CACHE_SIZE", "0")
+    processes = [
+        multiprocessing.Process(target=record_entries, args=(tmp_path, process))
+        for process in range(8)
+    ]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    assert len(CodeCache(tmp_path).load()) == 8 * 20
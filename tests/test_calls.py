@@ -0,0 +1,104 @@
+"""
+The entry points of the compiled stencils: direct calls and calls bound to their arguments.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from toydsl import bench
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import create_stencil, hash_source_code
+
+
+pytestmark = pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+
+shape = (4, 8, 10)
+
+bounds = [[0, size] for size in shape]
+
+
+def fields():
+    return [np.random.RandomState(seed).rand(*shape) for seed in range(3)]
+
+
+def stencil(backend="cpp"):
+    return create_stencil(bench.lapoflap, hash_source_code(bench.lapoflap), backend=backend)
+
+
+def test_bound_call_matches_call():
+    expected = fields()
+    stencil(backend="numpy")(*expected, *bounds)
+
+    arguments = fields()
+    step = stencil().bind(*arguments, *bounds)
+    step()
+    for field, expected_field in zip(arguments, expected):
+        np.testing.assert_allclose(field, expected_field, rtol=1e-12)
+
+    # The bound arrays are read again by every call
+    arguments[1][...] = arguments[0]
+    expected[1][...] = expected[0]
+    step()
+    stencil(backend="numpy")(*expected, *bounds)
+    for field, expected_field in zip(arguments, expected):
+        np.testing.assert_allclose(field, expected_field, rtol=1e-12)
+
+
+def read_only(field):
+    field = field.copy()
+    field.flags.writeable = False
+    return field
+
+
+invalid_arguments = {
+    "missing_field": (TypeError, lambda f: f[:2] + bounds),
+    "missing_bounds": (TypeError, lambda f: f + bounds[:2]),
+    "list": (TypeError, lambda f: [f[0].tolist()] + f[1:] + bounds),
+    "dtype": (ValueError, lambda f: [f[0].astype(np.float32)] + f[1:] + bounds),
+    "out_of_bounds": (ValueError, lambda f: f + bounds[:2] + [[0, shape[2] + 2]]),
+    "read_only": (ValueError, lambda f: [read_only(f[0])] + f[1:] + bounds),
+}
+
+
+@pytest.mark.parametrize("bound", [False, True])
+@pytest.mark.parametrize("name", sorted(invalid_arguments))
+def test_invalid_arguments_raise(name, bound):
+    compiled = stencil()
+    error, arguments = invalid_arguments[name]
+    with pytest.raises(error):
+        (compiled.bind if bound else compiled)(*arguments(fields()))
+
+
+@pytest.mark.parametrize("steps", [4, 5])
+def test_run_matches_python_loop(steps):
+    expected = fields()
+    reference = stencil(backend="numpy")
+    for _ in range(steps):
+        reference(*expected, *bounds)
+        expected[0], expected[1] = expected[1], expected[0]
+
+    arguments = fields()
+    result = stencil().run(*arguments, *bounds, steps=steps, swap=("out_field", "in_field"))
+    # The odd steps write into the array passed as out_field, the even ones into in_field
+    assert result is arguments[(steps - 1) % 2]
+    np.testing.assert_allclose(result, expected[1], rtol=1e-12)
+    np.testing.assert_allclose(arguments[2], expected[2], rtol=1e-12)
+
+
+def test_run_without_swap_repeats_the_call():
+    expected = fields()
+    for _ in range(3):
+        stencil(backend="numpy")(*expected, *bounds)
+
+    arguments = fields()
+    assert stencil().run(*arguments, *bounds, steps=3) is None
+    for field, expected_field in zip(arguments, expected):
+        np.testing.assert_allclose(field, expected_field, rtol=1e-12)
+
+
+@pytest.mark.parametrize("swap", [("out_field",), ("out_field", "out_field"), ("out_field", "k")])
+def test_run_rejects_invalid_swap(swap):
+    with pytest.raises(ValueError):
+        stencil().run(*fields(), *bounds, steps=2, swap=swap)
@@ -0,0 +1,90 @@
+"""
+Stencils compiled ahead of time are loaded from the shipped cache, without a compiler.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+from toydsl.compile import lock_files, strip_build_files
+from toydsl.driver.cache import CodeCache, compiler
+
+
+pytestmark = pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+
+repository = Path(__file__).parent.parent
+
+stencils = '''
+from toydsl.driver.driver import computation
+from toydsl.frontend.language import Horizontal, Vertical, end, start
+
+
+@computation
+def vertical_blur(out_field, in_field):
+    with Vertical[start + 1 : end - 1]:
+        with Horizontal[start : end, start : end]:
+            out_field[0, 0, 0] = (in_field[0, 0, 1] + in_field[0, 0, 0] + in_field[0, 0, -1]) / 3
+'''
+
+run_stencil = '''
+import numpy as np
+import stencils
+
+in_field = np.random.RandomState(0).rand(6, 5, 4)
+out_field = np.zeros_like(in_field)
+stencils.vertical_blur(out_field, in_field, [0, 6], [0, 5], [0, 4])
+expected = (in_field[2:] + in_field[1:-1] + in_field[:-2]) / 3
+assert np.allclose(out_field[1:-1], expected)
+'''
+
+
+def run_python(code_or_args, cwd, **environment):
+    args = ["-c", code_or_args] if isinstance(code_or_args, str) else code_or_args
+    env = dict(os.environ, PYTHONPATH=str(repository), **environment)
+    return subprocess.run(
+        [sys.executable] + args, cwd=cwd, env=env, capture_output=True, text=True
+    )
+
+
+def test_compiled_cache_loads_without_compiler(tmp_path):
+    (tmp_path / "stencils.py").write_text(stencils)
+    prebuilt = tmp_path / "prebuilt"
+    environment = {"TOYDSL_BUILD_MODE": "direct", "TOYDSL_BUILD_TYPE": "Release"}
+
+    result = run_python(
+        ["-m", "toydsl.compile", "stencils.py", "-o", str(prebuilt)], tmp_path, **environment
+    )
+    assert result.returncode == 0, result.stderr
+    assert not list(prebuilt.glob("*.lock"))
+
+    # The cache is shipped to a node where the compiler isn't installed
+    node = tmp_path / "node"
+    shutil.copytree(prebuilt, node / "cache")
+    shutil.copy(tmp_path / "stencils.py", node)
+    result = run_python(
+        run_stencil,
+        node,
+        CODE_CACHE_ROOT=str(node / "cache"),
+        CXX=str(tmp_path / "missing" / "c++"),
+        TOYDSL_COMPILATION="eager",
+        **environment,
+    )
+    assert result.returncode == 0, result.stderr
+    assert "Built" not in result.stderr
+
+
+def test_strip_keeps_the_locks_of_other_processes(tmp_path):
+    cache = CodeCache(tmp_path)
+    # Another process using the cache waits for this lock
+    with cache.lock("cpp_other"):
+        existing_locks = lock_files(cache)
+        (tmp_path / "cpp_built").mkdir()
+        with cache.lock("cpp_built"):
+            cache.record("cpp_built", {"backend": "cpp"})
+        strip_build_files(cache, existing_locks)
+
+    assert [path.name for path in lock_files(cache)] == ["cpp_other.lock"]
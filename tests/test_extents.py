@@ -0,0 +1,121 @@
+"""
+The extents of the field accesses: the halos the arrays need, the checks of the calls
+against them and the domains inferred from them.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from toydsl import bench
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import create_stencil, hash_source_code, optimize
+from toydsl.frontend.frontend import parse
+# The stencils are parsed from their source, the import keeps linters happy
+from toydsl.frontend.language import Horizontal, Vertical, end, start
+from toydsl.ir.extents import field_halos
+
+
+shape = (5, 8, 10)
+
+backends = [
+    pytest.param(
+        "cpp",
+        marks=pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler"),
+    ),
+    "numpy",
+    "python",
+]
+
+
+def shifted_read(out_field, in_field):
+    with Vertical[start:end]:
+        with Horizontal[start:end, start:end]:
+            out_field[0, 0, 0] = in_field[-1, 0, 0] + in_field[0, 2, 0] + in_field[0, 0, 1]
+
+
+def lapoflap_without_margins(out_field, in_field, tmp1_field):
+    with Vertical[start:end]:
+        with Horizontal[start:end, start:end]:
+            tmp1_field[0, 0, 0] = (
+                -4.0 * in_field[0, 0, 0]
+                + in_field[-1, 0, 0] + in_field[1, 0, 0]
+                + in_field[0, -1, 0] + in_field[0, 1, 0]
+            )
+        with Horizontal[start:end, start:end]:
+            out_field[0, 0, 0] = in_field[0, 0, 0] - 0.03 * (
+                -4.0 * tmp1_field[0, 0, 0]
+                + tmp1_field[-1, 0, 0] + tmp1_field[1, 0, 0]
+                + tmp1_field[0, -1, 0] + tmp1_field[0, 1, 0]
+            )
+
+
+def fields(count):
+    return [np.random.RandomState(seed).rand(*shape) for seed in range(count)]
+
+
+def test_field_halos():
+    assert field_halos(parse(shifted_read)) == {
+        "out_field": [(0, 0), (0, 0), (0, 0)],
+        "in_field": [(1, 0), (0, 2), (0, 1)],
+    }
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_domain_inside_the_halo_matches_numpy(backend):
+    stencil = create_stencil(shifted_read, hash_source_code(shifted_read), backend=backend)
+    out_field, in_field = fields(2)
+    expected = out_field.copy()
+    nk, nj, ni = shape
+    expected[: nk - 1, : nj - 2, 1:] = (
+        in_field[: nk - 1, : nj - 2, :-1] + in_field[: nk - 1, 2:, 1:] + in_field[1:, : nj - 2, 1:]
+    )
+
+    stencil(out_field, in_field, [0, nk - 1], [0, nj - 2], [1, ni])
+    np.testing.assert_array_equal(out_field, expected)
+
+
+@pytest.mark.parametrize("backend", backends)
+# Along k, j and i, past the end and before the start of the arrays
+@pytest.mark.parametrize("axis, bound", [(0, [0, 5]), (1, [0, 7]), (2, [0, 10])])
+def test_domain_outside_the_arrays_raises(backend, axis, bound):
+    stencil = create_stencil(shifted_read, hash_source_code(shifted_read), backend=backend)
+    bounds = [[0, shape[0] - 1], [0, shape[1] - 2], [1, shape[2]]]
+    bounds[axis] = bound
+    out_field, in_field = fields(2)
+    with pytest.raises(ValueError, match="in_field is accessed"):
+        stencil(out_field, in_field, *bounds)
+
+
+def test_shrink_matches_explicit_margins():
+    definition = lapoflap_without_margins
+    stencil = create_stencil(
+        definition, hash_source_code(definition), backend="numpy", domains="shrink"
+    )
+    expected = fields(3)
+    bounds = [[0, size] for size in shape]
+    bench.lapoflap_numpy(*expected, *bounds)
+
+    arguments = fields(3)
+    stencil(*arguments, *bounds)
+    np.testing.assert_allclose(arguments[0], expected[0], rtol=1e-12)
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_extend_computes_the_halo_the_later_stages_read(backend):
+    definition = lapoflap_without_margins
+    stencil = create_stencil(
+        definition, hash_source_code(definition), backend=backend, domains="extend"
+    )
+    halos = field_halos(optimize(parse(definition), {"domains": "extend"}))
+    assert halos["in_field"] == [(2, 2), (2, 2), (0, 0)]
+    # The arrays have a halo of two points along i and j around the bounds
+    bounds = [[0, shape[0]], [2, shape[1] - 2], [2, shape[2] - 2]]
+    expected = fields(3)
+    bench.lapoflap_numpy(*expected, [0, shape[0]], [0, shape[1]], [0, shape[2]])
+
+    arguments = fields(3)
+    stencil(*arguments, *bounds)
+    interior = (slice(None), slice(2, -2), slice(2, -2))
+    np.testing.assert_allclose(arguments[0][interior], expected[0][interior], rtol=1e-12)
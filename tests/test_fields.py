@@ -0,0 +1,71 @@
+"""
+The fields have their halo around the interior, the first interior point of every row on
+the alignment, and strides that are no multiple of 4096 bytes.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from toydsl import bench, fields
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import create_stencil, hash_source_code
+
+
+@pytest.mark.parametrize("dtype", [np.float64, np.float32])
+@pytest.mark.parametrize("alignment", [32, 64])
+# The rows of 512 points of float64 are 4096 bytes long without the padding
+@pytest.mark.parametrize(
+    "shape, halo", [((4, 5, 7), 0), ((4, 5, 7), (1, 2, (3, 1))), ((3, 8, 512), (1, 2, 0))]
+)
+def test_interior_rows_are_aligned(dtype, alignment, shape, halo):
+    field = fields.empty(shape, halo=halo, dtype=dtype, alignment=alignment)
+    (k_start, k_end), (j_start, j_end), (i_start, i_end) = fields.bounds(shape, halo=halo)
+    assert field.dtype == dtype
+    assert field[k_start:k_end, j_start:j_end, i_start:i_end].shape == tuple(shape)
+    for k in range(field.shape[0]):
+        for j in range(field.shape[1]):
+            assert field[k, j, i_start:].ctypes.data % alignment == 0
+    assert all(stride % fields.conflict_stride != 0 for stride in field.strides[:2])
+
+
+def test_halo_and_bounds():
+    field = fields.zeros((3, 4, 5), halo=(0, 1, (2, 3)))
+    assert field.shape == (3, 6, 10)
+    assert not field.any()
+    assert fields.bounds((3, 4, 5), halo=(0, 1, (2, 3))) == [[0, 3], [1, 5], [2, 7]]
+    assert fields.bounds((3, 4, 5), halo=2) == [[2, 5], [2, 6], [2, 7]]
+
+
+@pytest.mark.parametrize(
+    "shape, halo, alignment",
+    [
+        ((4, 5), 0, 64),
+        ((4, 5, 6), (1, 2), 64),
+        ((4, 5, 6), -1, 64),
+        ((4, 5, 6), (0, 0, (1, -1)), 64),
+        ((4, 5, 6), 0, 12),
+        ((4, 5, 6), 0, 0),
+    ],
+)
+def test_invalid_fields_raise(shape, halo, alignment):
+    with pytest.raises(ValueError):
+        fields.empty(shape, halo=halo, alignment=alignment)
+
+
+@pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+def test_stencil_on_fields_matches_numpy():
+    shape, halo = (3, 9, 21), (0, 2, 2)
+    bounds = fields.bounds(shape, halo=halo)
+    arguments = [fields.empty(shape, halo=halo) for _ in range(3)]
+    for seed, field in enumerate(arguments):
+        field[...] = np.random.RandomState(seed).rand(*field.shape)
+    expected = [np.array(field) for field in arguments]
+
+    definition = bench.lapoflap
+    create_stencil(definition, hash_source_code(definition))(*arguments, *bounds)
+    create_stencil(definition, hash_source_code(definition), backend="numpy")(
+        *expected, *bounds
+    )
+    np.testing.assert_allclose(arguments[0], expected[0], rtol=1e-12)
@@ -0,0 +1,90 @@
+"""
+The fused horizontal domains have to compute what the domains compute one after the other.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from toydsl import bench
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import create_stencil, hash_source_code, optimize
+from toydsl.frontend.frontend import parse
+# The stencils are parsed from their source, the import keeps linters happy
+from toydsl.frontend.language import Horizontal, Vertical, end, start
+
+
+shape = (4, 5, 7)
+
+bounds = [[0, size] for size in shape]
+
+backends = [
+    pytest.param(
+        "cpp",
+        marks=pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler"),
+    ),
+    "numpy",
+    "python",
+]
+
+
+def shifted_write(out_field, tmp_field, in_field):
+    with Vertical[start:end]:
+        with Horizontal[start + 1 : end, start:end]:
+            tmp_field[-1, 0, 0] = in_field[0, 0, 0]
+        with Horizontal[start + 1 : end, start:end]:
+            out_field[0, 0, 0] = tmp_field[0, 0, 0]
+
+
+def pointwise(out_field, tmp_field, in_field):
+    with Vertical[start:end]:
+        with Horizontal[start:end, start:end]:
+            tmp_field[0, 0, 0] = in_field[0, 0, 0] * 2.0
+        with Horizontal[start:end, start:end]:
+            out_field[0, 0, 0] = tmp_field[0, 0, 0] + in_field[0, 0, 0]
+
+
+def horizontal_domains(definition):
+    return [len(vertical_domain.body) for vertical_domain in optimize(parse(definition)).body]
+
+
+def test_merges_pointwise_domains():
+    assert horizontal_domains(pointwise) == [1]
+
+
+def test_keeps_domains_reading_a_shifted_write():
+    assert horizontal_domains(shifted_write) == [2]
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_inlined_temporary_matches_baseline(backend):
+    definition = bench.lapoflap
+    options = {"temporaries": ["tmp1_field"]}
+    ir = optimize(parse(definition), options)
+    assert [len(vertical_domain.body) for vertical_domain in ir.body] == [1]
+
+    out_field, in_field, tmp1_field = [
+        np.random.RandomState(seed).rand(*shape) for seed in range(3)
+    ]
+    expected = out_field.copy()
+    bench.lapoflap_numpy(expected, in_field, tmp1_field.copy(), *bounds)
+
+    stencil = create_stencil(definition, hash_source_code(definition), backend=backend, **options)
+    stencil(out_field, in_field, tmp1_field, *bounds)
+    np.testing.assert_allclose(out_field, expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_shifted_write_matches_sequential_domains(backend):
+    out_field, tmp_field, in_field = [np.random.RandomState(seed).rand(*shape) for seed in range(3)]
+    # The first domain runs over all the points before the second one starts
+    expected_tmp = tmp_field.copy()
+    expected_tmp[:, :, :-1] = in_field[:, :, 1:]
+    expected_out = out_field.copy()
+    expected_out[:, :, 1:] = expected_tmp[:, :, 1:]
+
+    stencil = create_stencil(shifted_write, hash_source_code(shifted_write), backend=backend)
+    stencil(out_field, tmp_field, in_field, *bounds)
+    np.testing.assert_array_equal(tmp_field, expected_tmp)
+    np.testing.assert_array_equal(out_field, expected_out)
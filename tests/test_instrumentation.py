@@ -0,0 +1,58 @@
+"""
+The instrumented kernels count the calls, cycles and bytes of each of their stages.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from toydsl import bench
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import create_stencil, hash_source_code
+
+
+pytestmark = pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+
+shape = (4, 8, 10)
+
+bounds = [[0, size] for size in shape]
+
+
+def fields():
+    return [np.random.RandomState(seed).rand(*shape) for seed in range(3)]
+
+
+def test_stats_count_the_calls_of_every_stage():
+    definition = bench.lapoflap
+    stencil = create_stencil(definition, hash_source_code(definition), instrument=True)
+    stencil.reset_stats()
+    arguments = fields()
+    stencil(*arguments, *bounds)
+    stencil(*arguments, *bounds)
+
+    stats = stencil.stats()
+    assert stats
+    assert {field for stage in stats for field in stage["writes"]} == {"out_field", "tmp1_field"}
+    for stage in stats:
+        assert set(stage) == {
+            "vertical", "horizontal", "writes", "calls", "cycles", "thread_cycles", "bytes"
+        }
+        assert stage["calls"] == 2
+        assert stage["cycles"] == sum(stage["thread_cycles"]) > 0
+        assert stage["bytes"] > 0
+
+    stencil.reset_stats()
+    assert all(stage["calls"] == stage["cycles"] == 0 for stage in stencil.stats())
+
+    # Every step is a call
+    stencil.run(*arguments, *bounds, steps=3)
+    assert all(stage["calls"] == 3 for stage in stencil.stats())
+
+
+def test_stats_without_instrumentation_raise():
+    definition = bench.lapoflap
+    stencil = create_stencil(definition, hash_source_code(definition))
+    stencil(*fields(), *bounds)
+    with pytest.raises(RuntimeError, match="instrument"):
+        stencil.stats()
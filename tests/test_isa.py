@@ -0,0 +1,99 @@
+"""
+Every instruction set variant of the kernels computes the results of the numpy backend.
+The module picks the variant when it is loaded, so each one runs in its own process.
+"""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from toydsl import bench
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import create_stencil, hash_source_code
+
+
+pytestmark = pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+
+repository = Path(__file__).parent.parent
+
+# The rows are no multiple of the vector width, the last points are masked
+shape = (3, 7, 13)
+
+bounds = [[0, size] for size in shape]
+
+# From the narrowest to the widest
+isas = ["scalar", "avx2", "avx512"]
+
+
+def fields():
+    return [np.random.RandomState(seed).rand(*shape) for seed in range(3)]
+
+
+run_stencil = '''
+import json
+import sys
+
+import numpy as np
+
+from tests.test_isa import bounds, fields
+from toydsl import bench
+from toydsl.driver.driver import create_stencil, hash_source_code
+
+options = json.loads(sys.argv[2])
+stencil = create_stencil(bench.lapoflap, hash_source_code(bench.lapoflap), **options)
+arguments = fields()
+stencil(*arguments, *bounds)
+np.save(sys.argv[1] + "/out_field.npy", arguments[0])
+print(stencil.module.isa)
+'''
+
+
+def run(tmp_path, options, **environment):
+    """Runs lapoflap in a new process, returns the instruction set and the output"""
+    env = {name: value for name, value in os.environ.items() if name != "TOYDSL_ISA"}
+    env.update(PYTHONPATH=str(repository), **environment)
+    result = subprocess.run(
+        [sys.executable, "-c", run_stencil, str(tmp_path), json.dumps(options)],
+        cwd=repository, env=env, capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    return result.stdout.split()[-1], np.load(tmp_path / "out_field.npy")
+
+
+def expected():
+    arguments = fields()
+    create_stencil(bench.lapoflap, hash_source_code(bench.lapoflap), backend="numpy")(
+        *arguments, *bounds
+    )
+    return arguments[0]
+
+
+@pytest.fixture(scope="module")
+def widest_isa(tmp_path_factory):
+    selected, out_field = run(tmp_path_factory.mktemp("isa"), {})
+    np.testing.assert_allclose(out_field, expected(), rtol=1e-12)
+    return selected
+
+
+def test_widest_isa_matches_numpy(widest_isa):
+    assert widest_isa in isas
+
+
+@pytest.mark.parametrize("isa", ["scalar", "avx2"])
+def test_selected_isa_matches_numpy(tmp_path, widest_isa, isa):
+    selected, out_field = run(tmp_path, {}, TOYDSL_ISA=isa)
+    # A CPU without the instruction set keeps a narrower one
+    assert selected == min(isa, widest_isa, key=isas.index)
+    np.testing.assert_allclose(out_field, expected(), rtol=1e-12)
+
+
+def test_scalar_kernels_only(tmp_path):
+    selected, out_field = run(tmp_path, {"isas": []})
+    assert selected == "scalar"
+    np.testing.assert_allclose(out_field, expected(), rtol=1e-12)
@@ -0,0 +1,101 @@
+"""
+The C++ kernels read the strides of the arrays, so that views with any layout give the
+results of contiguous arrays.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from toydsl import bench
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import create_stencil, hash_source_code
+# The stencils are parsed from their source, the import keeps linters happy
+from toydsl.frontend.language import Horizontal, Vertical, end, start
+
+
+pytestmark = pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+
+shape = (5, 8, 10)
+
+bounds = [[0, size] for size in shape]
+
+
+def horizontal_dependency(out_field, in_field):
+    with Vertical[start:end]:
+        with Horizontal[start + 1 : end, start : end]:
+            out_field[0, 0, 0] = out_field[-1, 0, 0] + in_field[0, 0, 0]
+        with Horizontal[start : end, start + 1 : end]:
+            out_field[0, 0, 0] = out_field[0, -1, 0] * 0.5 + in_field[0, 0, 0]
+
+
+def transposed(field):
+    """Contiguous along k"""
+    return np.ascontiguousarray(field.transpose(2, 1, 0)).transpose(2, 1, 0)
+
+
+def contiguous_along_j(field):
+    return np.ascontiguousarray(field.transpose(0, 2, 1)).transpose(0, 2, 1)
+
+
+def strided(field):
+    """Every third point along i and every second row of a larger array"""
+    nk, nj, ni = field.shape
+    view = np.zeros((nk, 2 * nj, 3 * ni))[:, ::2, ::3]
+    view[...] = field
+    return view
+
+
+def padded(field):
+    """Contiguous along i, but the rows and planes are longer than the field"""
+    nk, nj, ni = field.shape
+    view = np.zeros((nk + 1, nj + 3, ni + 5))[1:, 2:-1, 3:-2]
+    view[...] = field
+    return view
+
+
+layouts = {
+    "transposed": transposed,
+    "fortran": np.asfortranarray,
+    "contiguous_along_j": contiguous_along_j,
+    "strided": strided,
+    "padded": padded,
+}
+
+
+def fields(count):
+    return [np.random.RandomState(seed).rand(*shape) for seed in range(count)]
+
+
+def reference(definition, arrays):
+    """The fields computed by the numpy backend on C ordered arrays"""
+    create_stencil(definition, hash_source_code(definition), backend="numpy")(*arrays, *bounds)
+    return arrays
+
+
+@pytest.mark.parametrize("definition", [bench.lapoflap, horizontal_dependency])
+@pytest.mark.parametrize("layout", sorted(layouts))
+def test_layout_matches_contiguous_arrays(definition, layout):
+    stencil = create_stencil(definition, hash_source_code(definition))
+    count = definition.__code__.co_argcount
+    expected = reference(definition, fields(count))
+
+    views = [layouts[layout](field) for field in fields(count)]
+    assert not any(view.flags.c_contiguous for view in views)
+    stencil(*views, *bounds)
+    for view, expected_field in zip(views, expected):
+        np.testing.assert_allclose(view, expected_field, rtol=1e-12)
+
+
+def test_mixed_layouts_match_contiguous_arrays():
+    definition = bench.lapoflap
+    stencil = create_stencil(definition, hash_source_code(definition))
+    expected = reference(definition, fields(3))
+
+    views = [
+        layout(field) for layout, field in zip([padded, np.asfortranarray, strided], fields(3))
+    ]
+    stencil(*views, *bounds)
+    for view, expected_field in zip(views, expected):
+        np.testing.assert_allclose(view, expected_field, rtol=1e-12)
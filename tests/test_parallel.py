@@ -0,0 +1,106 @@
+"""
+The loops the C++ backend shares among threads are those without carried dependencies,
+so that the results don't depend on the number of threads.
+"""
+
+import os
+import shutil
+import subprocess
+import sys
+from pathlib import Path
+
+import numpy as np
+import pytest
+
+from toydsl.driver.cache import compiler
+from toydsl.frontend.frontend import parse
+# The stencils are parsed from their source, the import keeps linters happy
+from toydsl.frontend.language import Horizontal, Vertical, end, start
+from toydsl.ir.dependencies import parallel_loops
+
+
+repository = Path(__file__).parent.parent
+
+shape = (6, 9, 11)
+
+
+def vertical_dependency(out_field, in_field):
+    with Vertical[start + 1 : end]:
+        with Horizontal[start : end, start : end]:
+            out_field[0, 0, 0] = out_field[0, 0, -1] + in_field[0, 0, 0]
+
+
+def horizontal_dependency(out_field, in_field):
+    with Vertical[start:end]:
+        with Horizontal[start + 1 : end, start : end]:
+            out_field[0, 0, 0] = out_field[-1, 0, 0] + in_field[0, 0, 0]
+        with Horizontal[start : end, start + 1 : end]:
+            out_field[0, 0, 0] = out_field[0, -1, 0] * 0.5 + in_field[0, 0, 0]
+
+
+def pointwise(out_field, in_field):
+    with Vertical[start:end]:
+        with Horizontal[start:end, start:end]:
+            out_field[0, 0, 0] = in_field[0, 0, -1] + in_field[1, 1, 0]
+
+
+def loops(definition):
+    return [
+        (loops.vertical, [sorted(axes) for axes in loops.horizontal])
+        for loops in map(parallel_loops, parse(definition).body)
+    ]
+
+
+def test_parallel_loops():
+    assert loops(vertical_dependency) == [(False, [["i", "j"]])]
+    assert loops(horizontal_dependency) == [(True, [["j"], ["i"]])]
+    assert loops(pointwise) == [(True, [["i", "j"]])]
+
+
+def fields():
+    return [np.random.RandomState(seed).rand(*shape) for seed in range(2)]
+
+
+def sequential(name):
+    """The fields computed one point after the other, in the order of the loops"""
+    out_field, in_field = fields()
+    nk, nj, ni = shape
+    if name == "vertical_dependency":
+        for k in range(1, nk):
+            out_field[k] = out_field[k - 1] + in_field[k]
+    else:
+        for i in range(1, ni):
+            out_field[:, :, i] = out_field[:, :, i - 1] + in_field[:, :, i]
+        for j in range(1, nj):
+            out_field[:, j, :] = out_field[:, j - 1, :] * 0.5 + in_field[:, j, :]
+    return out_field
+
+
+run_stencils = '''
+import sys
+
+import numpy as np
+
+from tests.test_parallel import fields, horizontal_dependency, shape, vertical_dependency
+from toydsl.driver.driver import create_stencil, hash_source_code
+
+for definition in [vertical_dependency, horizontal_dependency]:
+    out_field, in_field = fields()
+    stencil = create_stencil(definition, hash_source_code(definition))
+    stencil(out_field, in_field, *[[0, size] for size in shape])
+    np.save("{}/{}.npy".format(sys.argv[1], definition.__name__), out_field)
+'''
+
+
+@pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+def test_threads_match_sequential_loops(tmp_path):
+    # The OpenMP runtime reads the number of threads when the process starts
+    env = dict(os.environ, PYTHONPATH=str(repository), OMP_NUM_THREADS="4")
+    result = subprocess.run(
+        [sys.executable, "-c", run_stencils, str(tmp_path)],
+        cwd=repository, env=env, capture_output=True, text=True,
+    )
+    assert result.returncode == 0, result.stderr
+    for name in ["vertical_dependency", "horizontal_dependency"]:
+        computed = np.load(tmp_path / (name + ".npy"))
+        np.testing.assert_allclose(computed, sequential(name), rtol=1e-12)
@@ -0,0 +1,81 @@
+"""
+A program computes what its stages compute when they are called one after the other.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from toydsl import bench
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import computation, program
+
+
+shape = (6, 8, 10)
+
+bounds = [[0, size] for size in shape]
+
+backends = [
+    pytest.param(
+        "cpp",
+        marks=pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler"),
+    ),
+    "numpy",
+]
+
+
+def stages(backend="numpy"):
+    return [
+        computation(backend=backend)(definition)
+        for definition in [bench.lapoflap, bench.vertical_blur]
+    ]
+
+
+def fields():
+    # out_field, in_field, tmp1_field and blurred_field
+    return [np.random.RandomState(seed).rand(*shape) for seed in range(4)]
+
+
+def expected_fields():
+    out_field, in_field, tmp1_field, blurred_field = fields()
+    lapoflap, vertical_blur = stages()
+    lapoflap(out_field, in_field, tmp1_field, *bounds)
+    vertical_blur(blurred_field, out_field, *bounds)
+    return out_field, in_field, tmp1_field, blurred_field
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_program_matches_its_stages(backend):
+    model_step = program(
+        bench.lapoflap,
+        (bench.vertical_blur, {"in_field": "out_field", "out_field": "blurred_field"}),
+        name="model_step",
+        backend=backend,
+    )
+    arguments = fields()
+    model_step(*arguments, *bounds)
+    for field, expected_field in zip(arguments, expected_fields()):
+        np.testing.assert_allclose(field, expected_field, rtol=1e-12)
+
+
+@pytest.mark.parametrize("backend", backends)
+def test_demoted_temporaries_are_dropped_from_the_signature(backend):
+    lapoflap, vertical_blur = stages(backend)
+    model_step = program(
+        lapoflap,
+        (vertical_blur, {"in_field": "out_field", "out_field": "blurred_field"}),
+        name="model_step",
+        backend=backend,
+        demote_temporaries=True,
+    )
+    out_field, in_field, _, blurred_field = fields()
+    model_step(out_field, in_field, blurred_field, *bounds)
+    expected_out, _, _, expected_blurred = expected_fields()
+    np.testing.assert_allclose(out_field, expected_out, rtol=1e-12)
+    np.testing.assert_allclose(blurred_field, expected_blurred, rtol=1e-12)
+
+
+def test_program_needs_a_stage():
+    with pytest.raises(ValueError):
+        program()
@@ -0,0 +1,68 @@
+"""
+The simplified expressions compute the same values as the expressions of the stencil,
+bit for bit where the rewrites are exact.
+"""
+
+import numpy as np
+
+from toydsl.backend.codegen_numpy import CodeGenNumpy
+from toydsl.frontend.frontend import parse
+# The stencils are parsed from their source, the import keeps linters happy
+from toydsl.frontend.language import Horizontal, Vertical, end, start
+from toydsl.ir.simplify import SimplifyExpressions
+
+
+shape = (4, 6, 7)
+
+bounds = [[0, size] for size in shape]
+
+
+def shared_terms(out_field, tmp_field, in_field):
+    with Vertical[start : end - 1]:
+        with Horizontal[start:end, start:end]:
+            tmp_field[0, 0, 0] = (in_field[0, 0, 0] - in_field[0, 0, 1]) ** 2 + 0.0
+            out_field[0, 0, 0] = (
+                (in_field[0, 0, 0] - in_field[0, 0, 1]) * (2.0 * 0.5) / 4.0 + in_field[0, 0, 0]
+            )
+
+
+def rounded_rewrites(out_field, in_field):
+    with Vertical[start:end]:
+        with Horizontal[start:end, start:end]:
+            out_field[0, 0, 0] = in_field[0, 0, 0] / 3.0 + in_field[0, 0, 0] ** 3
+
+
+def compile_numpy(ir):
+    code = CodeGenNumpy.apply(ir)
+    namespace = {}
+    exec(compile(code, "<{}>".format(ir.name), "exec"), namespace)
+    return code, namespace[ir.name]
+
+
+def run(definition, simplified):
+    ir = parse(definition)
+    if simplified:
+        ir = SimplifyExpressions().apply(ir)
+    code, stencil = compile_numpy(ir)
+    arguments = [np.random.RandomState(seed).rand(*shape) for seed in range(len(ir.api_signature))]
+    stencil(*arguments, *bounds)
+    return code, arguments
+
+
+def test_simplified_expressions_are_bit_compatible():
+    code, simplified = run(shared_terms, simplified=True)
+    # The difference is computed once for both statements
+    assert "local_" in code
+    assert "power" not in code
+    _, expected = run(shared_terms, simplified=False)
+    for field, expected_field in zip(simplified, expected):
+        np.testing.assert_array_equal(field, expected_field)
+
+
+def test_rounded_rewrites_are_close():
+    # The reciprocal of 3 is rounded, and the cube is rounded after each multiplication
+    code, simplified = run(rounded_rewrites, simplified=True)
+    assert "divide" not in code
+    assert "power" not in code
+    _, expected = run(rounded_rewrites, simplified=False)
+    np.testing.assert_allclose(simplified[0], expected[0], rtol=4 * np.finfo(np.float64).eps)
@@ -0,0 +1,61 @@
+"""
+The stencils with `dtype="auto"` dispatch every call to the kernel for the dtype of its fields.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from toydsl import bench
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import create_stencil, hash_source_code
+
+
+pytestmark = pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+
+shape = (4, 8, 10)
+
+bounds = [[0, size] for size in shape]
+
+
+def fields(dtype):
+    return [np.random.RandomState(seed).rand(*shape).astype(dtype) for seed in range(3)]
+
+
+@pytest.mark.parametrize("dtype", ["float64", "float32"])
+def test_specialization_matches_numpy(dtype):
+    definition = bench.lapoflap
+    stencil = create_stencil(definition, hash_source_code(definition), dtype="auto")
+    reference = create_stencil(definition, hash_source_code(definition), backend="numpy")
+    expected = fields(dtype)
+    reference(*expected, *bounds)
+
+    result = fields(dtype)
+    stencil(*result, *bounds)
+    for field, expected_field in zip(result, expected):
+        assert field.dtype == dtype
+        rtol = 1e-5 if dtype == "float32" else 1e-12
+        np.testing.assert_allclose(field, expected_field, rtol=rtol)
+
+
+def test_stats_of_all_specializations():
+    definition = bench.lapoflap
+    stencil = create_stencil(
+        definition, hash_source_code(definition), dtype="auto", instrument=True
+    )
+    # The float64 kernel shares its counters with the other instrumented lapoflap stencils
+    for dtype in ["float64", "float32"]:
+        stencil(*fields(dtype), *bounds)
+    stencil.reset_stats()
+    stencil(*fields("float64"), *bounds)
+    stencil(*fields("float32"), *bounds)
+    stencil(*fields("float32"), *bounds)
+
+    stats = stencil.stats()
+    assert {stage["dtype"] for stage in stats} == {"float32", "float64"}
+    for stage in stats:
+        assert stage["calls"] == (2 if stage["dtype"] == "float32" else 1)
+
+    stencil.reset_stats()
+    assert all(stage["calls"] == 0 for stage in stencil.stats())
@@ -0,0 +1,57 @@
+"""
+The write-only fields are stored with non-temporal stores where they are aligned, and with
+regular stores elsewhere, without changing what is written.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from toydsl import bench, fields
+from toydsl.backend.codegen_cpp import CodeGenCpp
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import create_stencil, hash_source_code, optimize
+from toydsl.frontend.frontend import parse
+
+
+def generated_code(definition, **options):
+    return CodeGenCpp.apply(optimize(parse(definition)), **options)
+
+
+def test_only_write_only_fields_are_streamed():
+    assert "stream" in generated_code(bench.copy_stencil)
+    assert "stream" in generated_code(bench.copy_stencil, streaming_stores=("out_field",))
+    assert "stream" not in generated_code(bench.copy_stencil, streaming_stores=())
+    assert "stream" in generated_code(bench.lapoflap)
+    # lapoflap reads tmp1_field back
+    with pytest.raises(ValueError, match="tmp1_field"):
+        generated_code(bench.lapoflap, streaming_stores=("tmp1_field",))
+
+
+@pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+@pytest.mark.parametrize("streaming_stores", [None, (), ("out_field",)])
+# Rows that are and that aren't multiples of the vector width, starting at aligned and
+# unaligned addresses
+@pytest.mark.parametrize("shape, halo", [((3, 5, 32), 0), ((3, 5, 29), (0, 1, (3, 2)))])
+def test_streamed_copy_matches_input(streaming_stores, shape, halo):
+    definition = bench.copy_stencil
+    stencil = create_stencil(
+        definition, hash_source_code(definition), streaming_stores=streaming_stores
+    )
+    out_field = fields.zeros(shape, halo=halo)
+    in_field = fields.empty(shape, halo=halo)
+    in_field[...] = np.random.RandomState(0).rand(*in_field.shape)
+    bounds = fields.bounds(shape, halo=halo)
+
+    stencil(out_field, in_field, *bounds)
+    interior = tuple(slice(start, end) for start, end in bounds)
+    np.testing.assert_array_equal(out_field[interior], in_field[interior])
+    # Nothing is written outside of the bounds
+    out_field[interior] = 0
+    assert not out_field.any()
+
+    # Unaligned rows
+    out_view, in_view = np.zeros(out_field.shape)[:, :, 1:], in_field[:, :, 1:]
+    stencil(out_view, in_view, *bounds[:2], [0, in_view.shape[2]])
+    np.testing.assert_array_equal(out_view[interior[:2]], in_view[interior[:2]])
@@ -0,0 +1,51 @@
+"""
+The tiled loops of the C++ backend compute the same points in the same order as the
+untiled ones, also where the tiles don't divide the domain.
+"""
+
+import shutil
+
+import numpy as np
+import pytest
+
+from toydsl import bench
+from toydsl.driver.cache import compiler
+from toydsl.driver.driver import create_stencil, hash_source_code
+# The stencils are parsed from their source, the import keeps linters happy
+from toydsl.frontend.language import Horizontal, Vertical, end, start
+
+
+pytestmark = pytest.mark.skipif(shutil.which(compiler()) is None, reason="no C++ compiler")
+
+shape = (6, 9, 11)
+
+bounds = [[0, size] for size in shape]
+
+
+def horizontal_dependency(out_field, in_field):
+    with Vertical[start:end]:
+        with Horizontal[start + 1 : end, start : end]:
+            out_field[0, 0, 0] = out_field[-1, 0, 0] + in_field[0, 0, 0]
+        with Horizontal[start : end, start + 1 : end]:
+            out_field[0, 0, 0] = out_field[0, -1, 0] * 0.5 + in_field[0, 0, 0]
+
+
+def run(definition, **options):
+    stencil = create_stencil(definition, hash_source_code(definition), **options)
+    fields = [np.random.RandomState(seed).rand(*shape) for seed in range(3)]
+    fields = fields[: definition.__code__.co_argcount]
+    stencil(*fields, *bounds)
+    return fields
+
+
+@pytest.mark.parametrize("definition", [bench.lapoflap, horizontal_dependency])
+# Along i, j and k: tiles that divide the domain, that don't, and that are larger than it
+@pytest.mark.parametrize("tile_sizes", [(11, 3, 0), (4, 2, 4), (16, 16, 16)])
+def test_tiles_match_untiled_loops(definition, tile_sizes):
+    expected = run(definition, backend="numpy")
+    untiled = run(definition)
+    for field, untiled_field, expected_field in zip(
+        run(definition, tile_sizes=tile_sizes), untiled, expected
+    ):
+        np.testing.assert_array_equal(field, untiled_field)
+        np.testing.assert_allclose(field, expected_field, rtol=1e-12)
@@ -0,0 +1,185 @@
+"""
+Command line interface of the DSL, e.g. `python -m toydsl cache list`.
+"""
+
+import argparse
+import datetime
+import sys
+from pathlib import Path
+
+from toydsl.driver.build import phase_order
+from toydsl.driver.cache import CodeCache, format_size, parse_size, size_limit
+from toydsl.driver.driver import set_up_cache_directory
+
+
+def split_list(value: str):
+    return [item for item in value.split(",") if item]
+
+
+def cache_list(cache: CodeCache, args) -> None:
+    for metadata in cache.entries():
+        last_used = datetime.datetime.fromtimestamp(metadata["last_used"])
+        print("{entry:40} {backend:6} {name:24} {size:>8}  last used {last_used}".format(
+            entry=metadata["entry"],
+            backend=metadata.get("backend", "?"),
+            name=metadata.get("name", "?"),
+            size=format_size(metadata["size"]),
+            last_used=last_used.strftime("%Y-%m-%d %H:%M:%S"),
+        ))
+        if args.verbose:
+            for name, value in sorted(metadata.get("environment", {}).items()):
+                print("    {}: {}".format(name, value))
+            if metadata.get("options"):
+                print("    options: {}".format(metadata["options"]))
+            if metadata.get("build_phases"):
+                phases = sorted(metadata["build_phases"], key=phase_order)
+                print("    built with {} in {}".format(
+                    metadata.get("build_mode", "cmake"),
+                    ", ".join(
+                        "{} {:.2f} s".format(phase, metadata["build_phases"][phase])
+                        for phase in phases
+                    ),
+                ))
+
+    limit = size_limit()
+    print("{} entries, {} in {} (limit: {})".format(
+        len(cache.entries()),
+        format_size(cache.total_size()),
+        cache.root,
+        format_size(limit) if limit is not None else "none",
+    ))
+
+def cache_prune(cache: CodeCache, args) -> None:
+    limit = parse_size(args.max_size) if args.max_size is not None else size_limit()
+    if limit is None:
+        print("No size limit set, nothing to prune.")
+        return
+    evicted = cache.prune(limit)
+    print("Evicted {} entries, {} left.".format(len(evicted), format_size(cache.total_size())))
+
+def cache_clear(cache: CodeCache, args) -> None:
+    cache.clear()
+    print("Cleared {}.".format(cache.root))
+
+# The bench commands import the module of the benchmarks, which imports numpy and parses
+# the stencils, only when they run, so that the cache commands start quickly
+def bench_run(args) -> int:
+    from toydsl import bench
+
+    report = bench.run_suite(
+        stencils=split_list(args.stencils) if args.stencils else list(bench.benchmarks),
+        backends=split_list(args.backends) if args.backends else bench.default_backends,
+        sizes=(
+            [bench.parse_shape(shape) for shape in split_list(args.sizes)]
+            if args.sizes else bench.default_sizes
+        ),
+        threads=[int(count) for count in split_list(args.threads)] if args.threads else None,
+        dtype=args.dtype,
+        repeat=args.repeat,
+    )
+    bench.save_results(report, Path(args.output))
+    print("Wrote {} results to {}.".format(len(report["results"]), args.output))
+    return 0
+
+def bench_startup(args) -> int:
+    from toydsl import bench
+
+    stencils = split_list(args.stencils) if args.stencils else list(bench.benchmarks)
+    startup = bench.time_startup(stencils, args.dtype, args.repeat)
+    print(
+        "Started a process with {} cached stencils in {:.3f} s: "
+        "import {:.3f} s, define {:.3f} s".format(
+            len(startup["stencils"]), startup["process"], startup["import"], startup["define"]
+        )
+    )
+    return 0
+
+def bench_compare(args) -> int:
+    from toydsl import bench
+
+    threshold = args.threshold if args.threshold is not None else bench.default_threshold
+    baseline = bench.load_results(Path(args.baseline))
+    current = bench.load_results(Path(args.current))
+    for difference in bench.environment_differences(baseline, current):
+        print("warning: the runs differ in {}".format(difference))
+
+    comparisons = bench.compare(baseline, current, threshold)
+    for comparison in comparisons:
+        print(bench.format_comparison(comparison))
+    regressions = [comparison for comparison in comparisons if comparison["status"] == "regression"]
+    print("{} benchmarks compared, {} regressions above {:.0%}.".format(
+        len(comparisons), len(regressions), threshold
+    ))
+    return 1 if regressions else 0
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(prog="toydsl")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cache_parser = commands.add_parser("cache", help="inspect and prune the code cache")
+    cache_commands = cache_parser.add_subparsers(dest="cache_command", required=True)
+
+    list_parser = cache_commands.add_parser("list", help="list the cached modules")
+    list_parser.add_argument("-v", "--verbose", action="store_true",
+                             help="show how the modules were built")
+    list_parser.set_defaults(handler=cache_list)
+
+    prune_parser = cache_commands.add_parser(
+        "prune", help="evict the least recently used modules down to the size limit"
+    )
+    prune_parser.add_argument("--max-size",
+                              help="size limit, e.g. 500M, default: $TOYDSL_CACHE_SIZE")
+    prune_parser.set_defaults(handler=cache_prune)
+
+    clear_parser = cache_commands.add_parser("clear", help="remove all the generated code")
+    clear_parser.set_defaults(handler=cache_clear)
+
+    bench_parser = commands.add_parser("bench", help="benchmark the stencils and backends")
+    bench_commands = bench_parser.add_subparsers(dest="bench_command", required=True)
+
+    run_parser = bench_commands.add_parser("run", help="run the benchmarks and store the results")
+    run_parser.add_argument("--stencils", help="comma separated benchmarks, default: all of them")
+    run_parser.add_argument("--backends",
+                            help="comma separated backends out of cpp, numpy, python and the "
+                                 "handwritten numpy baseline, default: cpp,numpy,baseline")
+    run_parser.add_argument("--sizes",
+                            help="comma separated grid sizes NKxNJxNI, default: from 16x32x32 "
+                                 "to 128x256x256")
+    run_parser.add_argument("--threads",
+                            help="comma separated numbers of OpenMP threads to run the C++ "
+                                 "backend with, default: $OMP_NUM_THREADS")
+    run_parser.add_argument("--dtype", default="float64", choices=["float64", "float32"])
+    run_parser.add_argument("--repeat", type=int, default=5,
+                            help="measurements per benchmark, the median is reported")
+    run_parser.add_argument("-o", "--output", default="bench.json", help="the JSON file to write")
+    run_parser.set_defaults(bench_handler=bench_run)
+
+    startup_parser = bench_commands.add_parser(
+        "startup", help="time how long a process takes to import the DSL and load cached stencils"
+    )
+    startup_parser.add_argument("--stencils",
+                                help="comma separated benchmarks, default: all of them")
+    startup_parser.add_argument("--dtype", default="float64", choices=["float64", "float32"])
+    startup_parser.add_argument("--repeat", type=int, default=5,
+                                help="processes started, the median is reported")
+    startup_parser.set_defaults(bench_handler=bench_startup)
+
+    compare_parser = bench_commands.add_parser(
+        "compare", help="compare two runs and flag the benchmarks that got slower"
+    )
+    compare_parser.add_argument("baseline", help="results of the reference run")
+    compare_parser.add_argument("current", help="results of the run to check")
+    compare_parser.add_argument("--threshold", type=float,
+                                help="relative slowdown reported as a regression, default: 0.1")
+    compare_parser.set_defaults(bench_handler=bench_compare)
+
+    args = parser.parse_args(argv)
+    if args.command == "bench":
+        return args.bench_handler(args)
+    cache = CodeCache(Path(set_up_cache_directory()))
+    args.handler(cache, args)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
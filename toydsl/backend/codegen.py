@@ -1,20 +1,29 @@
 from __future__ import annotations
 
+import functools
 import importlib
 import sys
-from typing import List
-
-import black
+from typing import Callable, List
 
 import toydsl.ir.ir as ir
+from toydsl.ir.accesses import call_arguments, field_arguments
 from toydsl.ir.visitor import IRNodeVisitor
 
 
-black_mode = black.FileMode(
-    target_versions={black.TargetVersion.PY36, black.TargetVersion.PY37},
-    line_length=100,
-    string_normalization=True,
-)
+@functools.lru_cache(maxsize=None)
+def python_formatter() -> Callable[[str], str]:
+    """
+    Formats the generated python code. black takes longer to import than the rest of
+    the DSL, it is only imported once python code is generated.
+    """
+    import black
+
+    mode = black.FileMode(
+        target_versions={black.TargetVersion.PY36, black.TargetVersion.PY37},
+        line_length=100,
+        string_normalization=True,
+    )
+    return functools.partial(black.format_str, mode=mode)
 
 
 class TextBlock:
@@ -57,6 +66,10 @@ class CodeGen(IRNodeVisitor):
     This module generates simple python code with tripple-nested loops
     """
 
+    def __init__(self):
+        self._defined_locals = set()  # the locals computed so far in the current loop body
+        self._local_definitions: List[str] = []  # the locals the current statement needs first
+
     @classmethod
     def apply(cls: CodeGen, ir: ir.IR) -> str:
         """
@@ -68,15 +81,17 @@ class CodeGen(IRNodeVisitor):
     @staticmethod
     def offset_to_string(offset: ir.AccessOffset) -> str:
         """
-        Converts the offset of a FieldAccess to a string with the proper indexing
+        Converts the offset of a FieldAccess to a string with the proper indexing. The
+        offsets are given as (i, j, k), the arrays are indexed (k, j, i) like in the
+        other backends.
         """
         return (
-            "[idx_i + "
-            + str(offset.offsets[0])
+            "[idx_k + "
+            + str(offset.offsets[2])
             + ", idx_j + "
             + str(offset.offsets[1])
-            + ", idx_k + "
-            + str(offset.offsets[2])
+            + ", idx_i + "
+            + str(offset.offsets[0])
             + "]"
         )
 
@@ -143,8 +158,18 @@ class CodeGen(IRNodeVisitor):
     def visit_AssignmentStmt(self, node: ir.AssignmentStmt) -> str:
         return self.visit(node.left) + "=" + self.visit(node.right)
 
+    def visit_ScalarAccessExpr(self, node: ir.ScalarAccessExpr) -> str:
+        return node.name
+
     def visit_BinaryOp(self, node: ir.BinaryOp) -> str:
-        return self.visit(node.left) + node.operator + self.visit(node.right)
+        return "(" + self.visit(node.left) + node.operator + self.visit(node.right) + ")"
+
+    def visit_LocalExpr(self, node: ir.LocalExpr) -> str:
+        if node.name not in self._defined_locals:
+            value = self.visit(node.value)
+            self._defined_locals.add(node.name)
+            self._local_definitions.append(node.name + "=" + value)
+        return node.name
 
     def visit_VerticalDomain(self, node: ir.VerticalDomain) -> List[str]:
         vertical_loop = self.create_vertical_loop(node)
@@ -156,11 +181,17 @@ class CodeGen(IRNodeVisitor):
         return vertical_loop.lines
 
     def visit_HorizontalDomain(self, node: ir.HorizontalDomain) -> List[str]:
-        inner_loop = self.create_horizontal_loop("j", node)
+        # The innermost loop runs along i, the contiguous axis of the arrays
+        inner_loop = self.create_horizontal_loop("i", node)
+        self._defined_locals = set()
         for stmt in node.body:
-            inner_loop.append(self.visit(stmt))
+            code = self.visit(stmt)
+            for definition in self._local_definitions:
+                inner_loop.append(definition)
+            self._local_definitions = []
+            inner_loop.append(code)
 
-        outer_loop = self.create_horizontal_loop("i", node)
+        outer_loop = self.create_horizontal_loop("j", node)
         for line in inner_loop.lines:
             outer_loop.append(line)
 
@@ -168,11 +199,17 @@ class CodeGen(IRNodeVisitor):
 
     def visit_IR(self, node: ir.IR) -> str:
         scope = TextBlock()
-        function_def = "def {name}({args},i,j,k):".format(
-            name=node.name, args=", ".join(node.api_signature)
+        arguments = call_arguments(node)
+        fields = field_arguments(node)
+        if node.temporaries:
+            scope.append("import numpy as np")
+        function_def = "def {name}({args},k,j,i):".format(
+            name=node.name, args=", ".join(arguments)
         )
         scope.append(function_def)
         scope.indent()
+        for name in node.temporaries:
+            scope.append("{} = np.empty_like({})".format(name, fields[0]))
 
         for stmt in node.body:
             vertical_regions = self.visit(stmt)
@@ -180,7 +217,7 @@ class CodeGen(IRNodeVisitor):
                 scope.append(line)
         code_block = "\n".join(scope.lines)
 
-        formatted_source = black.format_str(code_block, mode=black_mode)
+        formatted_source = python_formatter()(code_block)
         return formatted_source
 
 
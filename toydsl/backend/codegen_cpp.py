@@ -4,22 +4,152 @@ import os
 from pathlib import Path
 import shutil
 import subprocess
-from typing import Any, List
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
 
 import toydsl.ir.ir as ir
+from toydsl.ir.accesses import (
+    accessed_fields,
+    assignments,
+    call_arguments,
+    conflicting_fields,
+    field_arguments,
+    read_accesses,
+    subexpressions,
+    written_fields,
+)
+from toydsl.ir.dependencies import ParallelLoops, carried_fields, parallel_loops
+from toydsl.ir.extents import describe_constraint, extent_constraints, field_extents
 from toydsl.ir.visitor import IRNodeVisitor
 
+# The modules loaded so far by the path of their .so file
+loaded_modules: Dict[Path, Any] = {}
+
 def load_cpp_module(so_filename: Path):
     """
     Load the python module from the .so file.
 
+    All the modules are called `dslgen`, and python keeps a single copy of the
+    initialized module for all the extensions of the same name. Loading a file a second
+    time would return the functions of the module loaded last, so every file is only
+    loaded once.
+
     https://stackoverflow.com/a/67692
     """
+    so_filename = Path(so_filename).resolve()
+    if so_filename not in loaded_modules:
+        spec = importlib.util.spec_from_file_location("dslgen", so_filename)
+        mod = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(mod)
+        loaded_modules[so_filename] = mod
+    return loaded_modules[so_filename]
+
+class CppStencil:
+    """
+    A compiled stencil. Calls go through the buffer protocol entry point of the module,
+    which skips the argument conversions of Boost.Python. The Boost.Python entry point
+    is still available as `stencil.module.<name>`.
+    """
+
+    def __new__(cls, module, name: str):
+        # A python `__call__` would add a frame to every call, about as much time as the
+        # fast entry point saves. The entry point itself becomes the call operator of a
+        # subclass for this stencil instead.
+        fast = getattr(module, name + "_fast")
+        stencil_class = type(cls.__name__, (cls,), {"__call__": staticmethod(fast)})
+        return super().__new__(stencil_class)
+
+    def __init__(self, module, name: str):
+        self.module = module
+        self.name = name
+        self.arguments = list(getattr(module, name + "_arguments"))
+        self.scalars = list(getattr(module, name + "_scalars"))
+        self.fields = [arg for arg in self.arguments if arg not in self.scalars]
+        self.fast = getattr(module, name + "_fast")
+        self._bind = getattr(module, name + "_bind")
+        self._steps = getattr(module, name + "_steps")
+
+    def bind(self, *args):
+        """
+        Checks the arguments `(fields and scalars..., k, j, i)` once and returns a function without
+        arguments that runs the stencil on them. The arrays are kept alive, and their
+        content can change between the calls, but not their shape or memory.
+        """
+        return self._bind(*args)
+
+    def run(self, *args, steps: int, swap: Optional[Tuple[str, str]] = None):
+        """
+        Runs `steps` steps of the stencil in a single call, all of them in one parallel
+        region. With `swap=("out_field", "in_field")`, the two fields exchange their arrays
+        after every step, so every step reads the output of the previous one.
+
+        Returns the array holding the output of the last step, or `None` without `swap`.
+        """
+        first, second = swap_positions(self.arguments, swap, self.scalars)
+        # The module counts the positions of the swapped fields among the fields only
+        self._steps(*args, steps, *swap_positions(self.fields, swap))
+        if swap is None:
+            return None
+        # The output of the last step was written into the first of the swapped fields
+        return args[first] if steps % 2 == 1 else args[second]
 
-    spec = importlib.util.spec_from_file_location("dslgen", so_filename)
-    mod = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(mod)
-    return mod
+    def stats(self) -> List[Dict[str, Any]]:
+        """
+        The counters of every stage, a horizontal domain, of a stencil compiled with
+        `instrument=True`, accumulated over all the calls since the module was loaded or
+        `reset_stats` was called. For every stage: its `vertical` and `horizontal` index,
+        the fields it `writes`, the number of `calls`, the `cycles` summed over the threads,
+        the `thread_cycles` of each thread and the estimated `bytes` moved from and to memory.
+        """
+        if not hasattr(self.module, self.name + "_stats"):
+            raise RuntimeError(
+                "{} was compiled without instrumentation, use @computation(instrument=True)".format(
+                    self.name
+                )
+            )
+        stages = getattr(self.module, self.name + "_stages")
+        stats = []
+        for (vertical, horizontal, writes), (calls, memory_bytes, thread_cycles) in zip(
+            stages, getattr(self.module, self.name + "_stats")()
+        ):
+            stats.append({
+                "vertical": vertical,
+                "horizontal": horizontal,
+                "writes": writes.split(", ") if writes else [],
+                "calls": calls,
+                "cycles": sum(thread_cycles),
+                "thread_cycles": list(thread_cycles),
+                "bytes": memory_bytes,
+            })
+        return stats
+
+    def reset_stats(self) -> None:
+        """Sets the counters of `stats` back to zero"""
+        if hasattr(self.module, self.name + "_reset_stats"):
+            getattr(self.module, self.name + "_reset_stats")()
+
+def swap_positions(
+    arguments: List[str], swap: Optional[Tuple[str, str]], scalars: Sequence[str] = ()
+) -> Tuple[int, int]:
+    """The positions of the two fields to swap in the signature of a stencil"""
+    if swap is None:
+        return 0, 0
+    fields = [arg for arg in arguments if arg not in scalars]
+    if len(swap) != 2 or swap[0] == swap[1] or any(name not in fields for name in swap):
+        raise ValueError(
+            "Expected two different fields of {} to swap, got {}".format(fields, swap)
+        )
+    return arguments.index(swap[0]), arguments.index(swap[1])
+
+def run_steps(
+    stencil, arguments: List[str], args, steps: int, swap: Optional[Tuple[str, str]] = None
+):
+    """Runs several steps of a stencil from python, like `CppStencil.run` does natively"""
+    first, second = swap_positions(arguments, swap)
+    args = list(args)
+    for _ in range(steps):
+        stencil(*args)
+        args[first], args[second] = args[second], args[first]
+    return args[second] if swap is not None else None
 
 def format_cpp(cpp_filename: Path, cmake_dir: Path):
     """
@@ -45,6 +175,14 @@ def compile_cpp(code_dir: Path, cmake_dir: Path, build_type: str = "Release"):
     Compile the generated C++ code using CMake.
     """
 
+    configure_cpp(code_dir, cmake_dir, build_type)
+    make_cpp(code_dir)
+
+def configure_cpp(code_dir: Path, cmake_dir: Path, build_type: str = "Release"):
+    """
+    Configure the CMake project building the generated C++ code in `code_dir/build`.
+    """
+
     build_dir = code_dir / "build"
     os.makedirs(build_dir, exist_ok=True)
 
@@ -58,31 +196,83 @@ def compile_cpp(code_dir: Path, cmake_dir: Path, build_type: str = "Release"):
     if ret != 0:
         raise Exception("CMake failed. build directory: {dir}. return code: {ret}. build type: {build_type}".format(dir=build_dir, ret=ret, build_type=build_type))
 
+def make_cpp(code_dir: Path):
+    """
+    Compile and link the configured C++ code.
+    """
+
+    build_dir = code_dir / "build"
     ret = subprocess.call(["make", "-j", "VERBOSE=1"], cwd=build_dir)
     if ret != 0:
         raise Exception("make failed. build directory: {dir}. return code: {ret}".format(dir=build_dir, ret=ret))
 
-def offset_to_string(offset: ir.AccessOffset, unroll_offset: int = 0) -> str:
+def offset_to_string(
+    offset: ir.AccessOffset,
+    unroll_offset: int = 0,
+    unroll_axis: str = "i",
+    unit_stride: Optional[str] = None,
+) -> str:
     """
     Converts the offset of a FieldAccess to a 1-dimensional array access with the proper indexing
+
+    The index is computed from the strides of the field, the stride along the axis
+    `unit_stride` is known to be 1 and left out. The unroll offset is added to the index
+    of the axis the loop is unrolled along.
     """
-    return "[(idx_i + {i}) + (idx_j + {j})*dim2 + (idx_k + {k})*dim3 + {unroll_offset}]".format(
-        i=offset.offsets[0],
-        j=offset.offsets[1],
-        k=offset.offsets[2],
-        unroll_offset=unroll_offset
-    )
+    terms = []
+    for axis, axis_offset in zip(["i", "j", "k"], offset.offsets):
+        if axis == unroll_axis:
+            axis_offset += unroll_offset
+        index = "(idx_{} + {})".format(axis, axis_offset)
+        if axis == unit_stride:
+            terms.append(index)
+        else:
+            terms.append("{}*{{name}}.stride_{}".format(index, axis))
+    return "[" + " + ".join(terms) + "]"
 
-def create_loop_header(loop_variable: str, extents: List[str], stride: int = 1) -> str:
+def create_loop_header(
+    loop_variable: str, extents: List[str], stride: int = 1, partial: bool = False
+) -> str:
+    """With `partial`, the last iteration may cover fewer than `stride` points."""
     assert loop_variable in ["i", "j", "k"]
 
-    return "for (std::size_t {var} = {start}; {var} <= {end} - {stride}; {var} += {stride})".format(
+    # Comparing with `{var} + {stride} <= {end}` instead of `{var} <= {end} - {stride}`
+    # makes sure the unsigned bound can't wrap around on domains smaller than the stride.
+    # Loops with unit stride keep the canonical form `{var} < {end}` that openmp requires.
+    condition = "{var} < {end}" if stride == 1 or partial else "{var} + {stride} <= {end}"
+    return ("for (std::size_t {var} = {start}; " + condition + "; {var} += {stride})").format(
         start=extents[0],
         end=extents[1],
         var="idx_{}".format(loop_variable),
         stride=stride
     )
 
+def create_tile_loop_header(loop_variable: str, extents: List[str], tile_size: int) -> List[str]:
+    """
+    Opens the loop over the tiles of an axis and declares the end of the current tile.
+    The extents of the point loop inside the tile are `tile_{var}` and `tile_end_{var}`.
+    """
+    assert loop_variable in ["i", "j", "k"]
+
+    return [
+        "for (std::size_t tile_{var} = {start}; tile_{var} < {end}; tile_{var} += {size})".format(
+            start=extents[0],
+            end=extents[1],
+            var=loop_variable,
+            size=tile_size
+        ),
+        "{",
+        "const std::size_t tile_end_{var} = "
+        "std::min<std::size_t>(tile_{var} + {size}, {end});".format(
+            end=extents[1],
+            var=loop_variable,
+            size=tile_size
+        ),
+    ]
+
+def tile_extents(loop_variable: str) -> List[str]:
+    return ["tile_{}".format(loop_variable), "tile_end_{}".format(loop_variable)]
+
 def create_extents(extents: ir.AxisInterval, loop_variable: str) -> List[str]:
     def create_offset(offset: ir.Offset):
         side = "start" if offset.level == ir.LevelMarker.START else "end"
@@ -94,64 +284,182 @@ def create_extents(extents: ir.AxisInterval, loop_variable: str) -> List[str]:
     ]
 
 def generate_converter(arg_name: str):
-    return "auto {a} = reinterpret_cast<scalar_t*>({a}_np.get_data());".format(a=arg_name)
-
-def check_openmp_private(node: ir.IR):
-    written = set()
-    read = set()
-    for vert in node.body:
-        if isinstance(vert, ir.VerticalDomain):
-            for hori in vert.body:
-                if isinstance(hori, ir.HorizontalDomain):
-                    for stmt in hori.body:
-                        if isinstance(stmt, ir.AssignmentStmt):
-                            if isinstance(stmt.left,ir.FieldAccessExpr):
-                                written.add(stmt.left.name)
-                            if isinstance(stmt.left,ir.BinaryOp):
-                                written = written.union(check_binop(stmt.left))
-                            if isinstance(stmt.right,ir.FieldAccessExpr):
-                                read.add(stmt.right.name)
-                            if isinstance(stmt.right,ir.BinaryOp):
-                                read = read.union(check_binop(stmt.right))
-
-    global private_var
-    private_var = (written&read)
-    global public_var
-    public_var = set(node.api_signature) - private_var
-
-def check_binop(node: ir.BinaryOp):
-    names = set()
-    if isinstance(node.left,ir.FieldAccessExpr):
-        names.add(node.left.name)
-    if isinstance(node.right,ir.FieldAccessExpr):
-        names.add(node.right.name)
-    if isinstance(node.left,ir.BinaryOp):
-        names = names.union(check_binop(node.left))
-    if isinstance(node.right,ir.BinaryOp):
-        names = names.union(check_binop(node.right))
-    return names
+    return "const field_t {a} = get_field({a}_np);".format(a=arg_name)
+
+def other_axis(axis: str) -> str:
+    return "j" if axis == "i" else "i"
+
+
+# The kernel variants that are generated for every computation. The name of the
+# variant, the axis that has to be contiguous in memory for all the fields, whether
+# the innermost loop may use vector instructions, and whether there is a version using
+# aligned loads and stores for fields whose rows are aligned, like the ones allocated by
+# `toydsl.fields`. The first variant whose layout matches the arrays is called, the last
+# one works with any strides.
+layout_variants = [
+    ("contiguous_i", "i", True, True),
+    ("contiguous_j", "j", True, False),
+    ("strided", None, False, False),
+]
+
+bounds_names = ["start_i", "end_i", "start_j", "end_j", "start_k", "end_k"]
+
+# The instruction sets the kernels are generated for. The target attribute of the kernels,
+# the size of a vector in bits and the intrinsics, `{suffix}` selects the element type.
+# The masked loads and stores cover the remainder of the innermost loop, `mask` holds the
+# lanes of the points left. The streaming stores are non-temporal where the address is
+# aligned, the aligned loads and stores need addresses aligned to the vector size.
+instruction_sets = {
+    "avx512": {
+        "target": "avx512f",
+        "bits": 512,
+        "set": "_mm512_set1_{suffix}({value})",
+        "load": "_mm512_loadu_{suffix}(&{access})",
+        "store": "_mm512_storeu_{suffix}(&{access}, {value});",
+        "masked_load": "_mm512_maskz_loadu_{suffix}(mask, &{access})",
+        "masked_store": "_mm512_mask_storeu_{suffix}(&{access}, mask, {value});",
+        "stream": "stream_store_avx512_{suffix}(&{access}, {value});",
+        "aligned_load": "_mm512_load_{suffix}(&{access})",
+        "aligned_store": "_mm512_store_{suffix}(&{access}, {value});",
+        "aligned_stream": "_mm512_stream_{suffix}(&{access}, {value});",
+        "mask": "const auto mask = remainder_mask_avx512_{suffix}({count});",
+    },
+    "avx2": {
+        "target": "avx2,fma",
+        "bits": 256,
+        "set": "_mm256_set1_{suffix}({value})",
+        "load": "_mm256_loadu_{suffix}(&{access})",
+        "store": "_mm256_storeu_{suffix}(&{access}, {value});",
+        "masked_load": "_mm256_maskload_{suffix}(&{access}, mask)",
+        "masked_store": "_mm256_maskstore_{suffix}(&{access}, mask, {value});",
+        "stream": "stream_store_avx2_{suffix}(&{access}, {value});",
+        "aligned_load": "_mm256_load_{suffix}(&{access})",
+        "aligned_store": "_mm256_store_{suffix}(&{access}, {value});",
+        "aligned_stream": "_mm256_stream_{suffix}(&{access}, {value});",
+        "mask": "const auto mask = remainder_mask_avx2_{suffix}({count});",
+    },
+    "scalar": {
+        "target": None,
+        "bits": None,
+    },
+}
+
+# The element types of the fields: the size in bytes and the suffix of the intrinsics
+dtypes = {
+    "float64": (8, "pd"),
+    "float32": (4, "ps"),
+}
+
+# The vector instruction sets used by default, from the widest to the narrowest
+default_isas = ("avx512", "avx2")
 
 class CodeGenCpp(IRNodeVisitor):
     """
     The code-generation module that traverses the IR and generates code form it.
     """
-    def __init__(self):
+    def __init__(
+        self,
+        *,
+        unroll_factor: int = 4,
+        vectorize: bool = True,
+        openmp: bool = True,
+        schedule: Optional[str] = None,
+        tile_sizes: Optional[Tuple[int, int, int]] = None,
+        isas: Optional[Sequence[str]] = None,
+        dtype: str = "float64",
+        streaming_stores: Optional[Sequence[str]] = None,
+        instrument: bool = False,
+    ):
+        """
+        Args:
+        unroll_factor: How many points the unrolled innermost loop computes per iteration,
+            rounded up to a multiple of the vector width.
+        vectorize: Use vector instructions.
+        openmp: Parallelize the loops that are free of loop carried dependencies with openmp.
+        schedule: The openmp schedule of the vertical loops, e.g. "static" or "dynamic,4".
+            `None` leaves the choice to the openmp runtime.
+        tile_sizes: Sizes of the tiles along the i, j and k axes. A size of 0 leaves the
+            axis untiled, `None` disables tiling altogether.
+        isas: The vector instruction sets to generate kernels for, `None` for all of them.
+            The module calls the widest one the CPU supports, or the scalar kernels.
+        dtype: The element type of the fields, "float64" or "float32".
+        streaming_stores: The fields that are written with non-temporal stores, they
+            must only be written by the computation. `None` selects all such fields.
+        instrument: Count the cycles every thread spends in each horizontal domain, and
+            the calls and estimated memory traffic of each of them, see `CppStencil.stats`.
+        """
         # The private variables here are properties that count for certain subtrees of the AST.
         # Any visitor can modify them to influence all the visitors in the subtree below
         # itself, but note that the setter of the variable is responsible to return it to
         # its previous value when the subtree has been processed.
 
-        self._repetitions = 1 # how many times should statements be executed
-        self._unroll_offset = 0 # indexes the repeated statements in an unrolled loop
-        self._vectorize = True # use avx2 instructions
-        self._openmp = True # use openmp
+        self._repetitions = 1  # how many times should statements be executed
+        self._unroll_offset = 0  # indexes the repeated statements in an unrolled loop
+        self._vectorize = vectorize  # use vector instructions
+        self._isa = "scalar"  # the instruction set of the current kernel
+        self._masked = False  # the vector loads and stores only cover the lanes in `mask`
+        # the rows of the fields are aligned at the start bound of the inner axis
+        self._aligned = False
+        # the unrolled loop starts at this offset from the aligned start
+        self._alignment_offset: Optional[int] = None
+        self._openmp = openmp  # use openmp
+        self._temporaries = set()  # fields that are stored in per-thread planes
+        self._inner_axis = "i"  # the axis of the innermost, unrolled, loop
+        self._unit_stride = "i"  # the axis along which all the fields are contiguous
+        self._enclosing_region = False  # the loops run inside a parallel region of the caller
+        self._nowait = False  # the threads don't wait for each other after the vertical loop
+        self._plane_halos = {}  # points past the end bounds (i, j) the planes of temporaries need
+        self._parallel_loops: Dict[int, ParallelLoops] = {}  # by the id of the vertical domains
+        self._shared_planes: Set[str] = set()  # temporaries in one plane shared by all the threads
+        # the horizontal loop is shared among the threads
+        self._parallel_axes: Optional[Set[str]] = None
+        # the names of the vectors holding the literals, by value
+        self._constants: Dict[str, str] = {}
+        # the locals computed so far in the current loop body
+        self._defined_locals: Set[str] = set()
+        self._local_definitions: List[str] = []  # the locals the current statement needs first
+        self._vector_math = True  # all the operators of the computation have vector versions
+        self._scalars: List[str] = []  # the scalar parameters, passed to the kernels by value
+
+        if unroll_factor < 1:
+            raise ValueError("Invalid unroll factor: {}".format(unroll_factor))
+        self._unroll_factor = unroll_factor
+        schedule_kinds = ["static", "dynamic", "guided", "auto"]
+        if schedule is not None and schedule.split(",")[0] not in schedule_kinds:
+            raise ValueError("Invalid openmp schedule: {}".format(schedule))
+        self._schedule = schedule
+
+        if tile_sizes is None:
+            tile_sizes = (0, 0, 0)
+        if len(tile_sizes) != 3 or any(size < 0 for size in tile_sizes):
+            raise ValueError("Invalid tile sizes: {}".format(tile_sizes))
+        self._tile_sizes = {axis: size for axis, size in zip(["i", "j", "k"], tile_sizes)}
+
+        if isas is None:
+            isas = default_isas
+        if any(isa not in default_isas for isa in isas):
+            raise ValueError("Invalid instruction sets: {}".format(isas))
+        # The widest first, the scalar kernels are the fallback
+        self._isas = [isa for isa in default_isas if isa in isas] + ["scalar"]
+
+        if dtype not in dtypes:
+            raise ValueError("Invalid dtype: {}".format(dtype))
+        self._dtype = dtype
+        self._streaming_stores = streaming_stores
+        self._streamed: Set[str] = set()  # fields written with non-temporal stores
+        self._instrument = instrument
+        # the index of the counters of every horizontal domain, by id
+        self._stages: Dict[int, int] = {}
+        self._stage_counted = False  # the counters of the stage are around the loop over the levels
 
     @classmethod
-    def apply(cls: CodeGenCpp, ir: ir.IR) -> str:
+    def apply(cls: CodeGenCpp, ir: ir.IR, **options: Any) -> str:
         """
         Entrypoint for the code generation, applying this to an IR returns a formatted function for that IR
+
+        The keyword arguments are forwarded to the constructor of the code generator.
         """
-        codegen = cls()
+        codegen = cls(**options)
         return codegen.visit(ir)
 
     # ---- Visitor handlers ----
@@ -162,17 +470,32 @@ class CodeGenCpp(IRNodeVisitor):
         raise RuntimeError("Invalid IR node: {}".format(node))
 
     def visit_LiteralExpr(self, node: ir.LiteralExpr) -> str:
-        # instruction: __m256d _mm256_set_pd (double e3, double e2, double e1, double e0)
         if self._vectorize:
-            return "_mm256_set1_pd({d})".format(d=node.value)
+            # Broadcast once at the start of the kernel, see `constant_declarations`
+            return self._constants[node.value]
+        elif self._dtype != "float64":
+            # A double literal would carry out the arithmetic in double precision
+            return "static_cast<scalar_t>({})".format(node.value)
         else:
             return node.value
 
+    def visit_ScalarAccessExpr(self, node: ir.ScalarAccessExpr) -> str:
+        if self._vectorize:
+            # Broadcast once at the start of the kernel, see `constant_declarations`
+            return "{}_vector".format(node.name)
+        return node.name
+
     def visit_FieldAccessExpr(self, node: ir.FieldAccessExpr) -> str:
-        array_access = node.name + offset_to_string(node.offset, self._unroll_offset)
+        array_access = "{name}.data" + offset_to_string(
+            node.offset, self._unroll_offset, self._inner_axis, self._unit_stride
+        )
+        array_access = array_access.format(name=node.name)
         if self._vectorize:
-            # instruction: __m256d _mm256_loadu_pd (double const * mem_addr)
-            return "_mm256_loadu_pd(&{})".format(array_access)
+            if self._masked:
+                return self.intrinsic("masked_load", access=array_access)
+            if self.aligned_access(node):
+                return self.intrinsic("aligned_load", access=array_access)
+            return self.intrinsic("load", access=array_access)
         else:
             return array_access
 
@@ -183,21 +506,28 @@ class CodeGenCpp(IRNodeVisitor):
             self._vectorize = False
             # On the left side we only want to generate the normal array access
             # so that we can then take the address of it when using it as the
-            # destination in the stream function. We thus turn off `_vectorize`
+            # destination in the store function. We thus turn off `_vectorize`
             # in order to not generate a load instruction.
             left = self.visit(node.left)
             self._vectorize = True
 
-            # instruction: void _mm256_storeu_pd (double * mem_addr, __m256d a)
-            return "_mm256_storeu_pd(&{}, {});".format(left, right)
+            if self._masked:
+                store = "masked_store"
+            elif node.left.name in self._streamed:
+                store = "stream"
+            else:
+                store = "store"
+            if not self._masked and self.aligned_access(node.left):
+                store = "aligned_" + store
+            return self.intrinsic(store, access=left, value=right)
         else:
             left = self.visit(node.left)
         return "{} = {};".format(left, right)
 
     def visit_BinaryOp(self, node: ir.BinaryOp) -> str: # TODO : Do not strip out the brackets
-        # We actually don't have to add the avx2 intrinsics
+        # We actually don't have to add the vector intrinsics
         # for binary operators here because the arithmetic
-        # operators are apparently overloaded for `__m256d`.
+        # operators are apparently overloaded for the vector types.
 
         assert(node.operator),"Unknown operator"
         # Keep the commented lines bellow, it might be useful later
@@ -216,75 +546,284 @@ class CodeGenCpp(IRNodeVisitor):
         # else:
         #     assert(False),"Operator has been defined in frontend.py only"
         if node.operator == "**":
-            binaryOp_str = "pow("+self.visit(node.left) + "," + self.visit(node.right) + ")"
+            # Only in scalar kernels, there is no vector pow, see `kernel_isas`
+            binaryOp_str = "std::pow(" + self.visit(node.left) + "," + self.visit(node.right) + ")"
         else:
             binaryOp_str = "(" + self.visit(node.left) + node.operator + self.visit(node.right) + ")"
         return binaryOp_str
 
+    def visit_LocalExpr(self, node: ir.LocalExpr) -> str:
+        # Every repetition of the unrolled statements computes the value for its own points
+        name = "{}_{}".format(node.name, self._unroll_offset)
+        if name not in self._defined_locals:
+            value = self.visit(node.value)
+            self._defined_locals.add(name)
+            self._local_definitions.append("const auto {} = {};".format(name, value))
+        return name
+
     def visit_VerticalDomain(self, node: ir.VerticalDomain) -> List[str]:
-        if self._openmp:
-            if(len(private_var)!=0 and len(public_var)!=0):
-                pragma_string = "#pragma omp parallel for default(none) shared(dim2,dim3,start_k,start_j,start_i,end_k,end_j,end_i,{public}) firstprivate({private})".format(public=", ".join(public_var),private=", ".join(private_var))
-            elif (len(private_var)==0):
-                pragma_string = "#pragma omp parallel for default(none) shared(dim2,dim3,start_k,start_j,start_i,end_k,end_j,end_i,{public})".format(public=", ".join(public_var))
-            elif (len(public_var)==0):
-                pragma_string = "#pragma omp parallel for default(none) shared(dim2,dim3,start_k,start_j,start_i,end_k,end_j,end_i) firstprivate({private})".format(private=", ".join(private_var))
-            else:
-                pragma_string = "#pragma omp parallel for default(none) shared(dim2,dim3,start_k,start_j,start_i,end_k,end_j,end_i)"
+        accessed = accessed_fields(node)
+        temporaries = sorted(name for name in self._temporaries if name in accessed)
+        loops = self._parallel_loops.get(id(node))
+        # Without openmp, the levels are computed one after the other by the only thread
+        parallel = loops is None or loops.vertical
+        schedule = self.schedule_clause()
+        if (
+            parallel
+            and loops is not None
+            and self._tile_sizes["k"] == 0
+            and loops.collapse(self.outermost_axis())
+        ):
+            # Also shares the rows of the levels among the threads, so there is
+            # work for all of them even on a few levels.
+            schedule = " collapse(2)" + schedule
+        # Nothing can be put between collapsed loops, the counters of the only horizontal
+        # domain go around the loop over the levels instead
+        count_levels = self._instrument and "collapse" in schedule
+
+        # Inside an enclosing parallel region, the threads allocate their planes once
+        buffers = [] if self._enclosing_region else self.temporary_buffers(temporaries)
 
-            vertical_loop = [pragma_string]
+        closing_braces = 0
+        if self._openmp and self._enclosing_region:
+            if parallel:
+                # The loop is orphaned, it is shared among the threads of the enclosing region
+                vertical_loop = ["#pragma omp for" + schedule + (" nowait" if self._nowait else "")]
+            else:
+                # Every thread runs through all the levels, sharing the horizontal loops
+                vertical_loop = []
+        elif self._openmp:
+            shared = sorted(accessed - (self._temporaries - self._shared_planes))
+            clauses = "default(none) shared({})".format(
+                ", ".join(bounds_names + shared + self.shared_constants())
+            )
+            if not parallel:
+                # The planes are declared outside of the parallel region to share them
+                vertical_loop = ["{"] + buffers + ["#pragma omp parallel " + clauses, "{"]
+                closing_braces = 2
+            elif buffers or count_levels:
+                vertical_loop = ["#pragma omp parallel " + clauses, "{"]
+                vertical_loop.extend(buffers)
+                vertical_loop.append("#pragma omp for" + schedule)
+                closing_braces = 1
+            else:
+                vertical_loop = ["#pragma omp parallel for " + clauses + schedule]
+        elif buffers:
+            vertical_loop = ["{"] + buffers
+            closing_braces = 1
         else:
             vertical_loop = []
-        vertical_loop.append(create_loop_header("k", create_extents(node.extents, "k")))
+        if count_levels:
+            # Before the `#pragma omp for`, which is the last line so far
+            vertical_loop[-1:-1] = self.start_stage_counter()
+        extents = create_extents(node.extents, "k")
+        if self._tile_sizes["k"] > 0:
+            # The tiles of levels are distributed among the threads, each thread
+            # then computes a contiguous block of levels.
+            vertical_loop.extend(create_tile_loop_header("k", extents, self._tile_sizes["k"]))
+            extents = tile_extents("k")
+        vertical_loop.append(create_loop_header("k", extents))
         vertical_loop.append("{")
-        for stmt in node.body:
-            lines_of_code = self.visit(stmt)
-            for line in lines_of_code:
-                vertical_loop.append(line)
+        previous_counted = self._stage_counted
+        self._stage_counted = count_levels
+        for index, stmt in enumerate(node.body):
+            if not parallel:
+                self._parallel_axes = loops.horizontal[index]
+            vertical_loop.extend(self.visit(stmt))
+            self._parallel_axes = None
+        self._stage_counted = previous_counted
         vertical_loop.append("}")
+        if self._tile_sizes["k"] > 0:
+            vertical_loop.append("}")
+        if count_levels:
+            vertical_loop.extend(self.stop_stage_counter(node.body[0]))
+        vertical_loop.extend(["}"] * closing_braces)
 
         return vertical_loop
 
+    def find_parallel_loops(self, node: ir.IR) -> Dict[int, ParallelLoops]:
+        """
+        Finds the parallel loops of every vertical domain. The temporaries of vertical domains
+        whose levels are computed one after the other are shared among the threads, so
+        every other vertical domain accessing one of them has to do the same.
+        """
+        loops = {
+            id(vertical_domain): parallel_loops(vertical_domain) for vertical_domain in node.body
+        }
+        while True:
+            shared = set()
+            for vertical_domain in node.body:
+                if not loops[id(vertical_domain)].vertical:
+                    shared |= accessed_fields(vertical_domain) & self._temporaries
+            serialized = False
+            for vertical_domain in node.body:
+                vertical_loops = loops[id(vertical_domain)]
+                if vertical_loops.vertical and accessed_fields(vertical_domain) & shared:
+                    vertical_loops.vertical = False
+                    serialized = True
+            if not serialized:
+                return loops
+
+    def find_shared_planes(self, node: ir.IR) -> Set[str]:
+        """
+        The temporaries that are written and read on one level by different threads,
+        because the horizontal loops are shared among them.
+        """
+        shared = set()
+        for vertical_domain in node.body:
+            loops = self._parallel_loops.get(id(vertical_domain))
+            if loops is not None and not loops.vertical:
+                shared |= accessed_fields(vertical_domain) & self._temporaries
+        return shared
+
+    def outermost_axis(self) -> str:
+        """
+        The axis of the outermost loop of the horizontal domains, a loop over tiles with
+        tiling
+        """
+        outer_axis = other_axis(self._inner_axis)
+        if self._tile_sizes[self._inner_axis] > 0 and self._tile_sizes[outer_axis] == 0:
+            return self._inner_axis
+        return outer_axis
+
+    def temporary_buffers(self, temporaries: List[str]) -> List[str]:
+        """
+        Every thread gets its own plane for each of the temporaries. They are only
+        read on the level they were written on, so one plane is all we need.
+        The levels whose horizontal loops are shared among the threads use one plane
+        declared outside of the parallel region instead. The planes are laid out such that
+        the innermost loop runs along contiguous memory.
+        """
+        buffers = []
+        for name in temporaries:
+            halo_i, halo_j = self._plane_halos.get(name, (0, 0))
+            size_i = "(end_i + {})".format(halo_i)
+            size_j = "(end_j + {})".format(halo_j)
+            plane_strides = "1, " + size_i if self._inner_axis == "i" else size_j + ", 1"
+            buffers.append("std::vector<scalar_t> {}_buffer({} * {});".format(name, size_i, size_j))
+            buffers.append(
+                "const field_t {name} = plane_field({name}_buffer.data(), {strides});".format(
+                    name=name, strides=plane_strides
+                )
+            )
+        return buffers
+
+    def schedule_clause(self) -> str:
+        if self._schedule is None:
+            return ""
+        return " schedule({})".format(self._schedule)
+
     def visit_HorizontalDomain(self, node: ir.HorizontalDomain) -> List[str]:
-        unroll_factor = 4
+        unroll_factor = self._unroll_factor
+        inner_axis = self._inner_axis
+        outer_axis = other_axis(inner_axis)
+        axis_index = {"i": 0, "j": 1}
+
+        inner_extents = create_extents(node.extents[axis_index[inner_axis]], inner_axis)
+        outer_extents = create_extents(node.extents[axis_index[outer_axis]], outer_axis)
+
+        # With tiling, the point loops below only traverse the current tile and the
+        # loops over the tiles are wrapped around them at the end.
+        tile_loops = []
+        for axis, extents in [(outer_axis, outer_extents), (inner_axis, inner_extents)]:
+            if self._tile_sizes[axis] > 0:
+                tile_loops.extend(create_tile_loop_header(axis, extents, self._tile_sizes[axis]))
+        if self._tile_sizes[inner_axis] > 0:
+            inner_extents = tile_extents(inner_axis)
+        if self._tile_sizes[outer_axis] > 0:
+            outer_extents = tile_extents(outer_axis)
 
-        inner_extents = create_extents(node.extents[0], "i")
         inner_loop = []
 
-        self._repetitions *= unroll_factor
-        inner_loop.append(create_loop_header("i", inner_extents, self._repetitions))
+        # Vector instructions compute several points at once, which changes the result if
+        # the points along the innermost loop depend on each other. Unrolling alone keeps
+        # the order of the points.
+        previous_vectorize = self._vectorize
+        if carried_fields(node, inner_axis, fixed=["k", outer_axis]):
+            self._vectorize = False
+
+        # Every iteration of the unrolled loop computes whole vectors
+        width = self.vector_width() if self._vectorize else 1
+        step = -(-unroll_factor // width) * width
+
+        # In the aligned kernels, the unrolled loop (and every tile of it) starts at a known
+        # offset from the aligned start bound, so the alignment of the accesses is known.
+        previous_alignment_offset = self._alignment_offset
+        start = node.extents[axis_index[inner_axis]].start
+        if (
+            self._aligned
+            and start.level == ir.LevelMarker.START
+            and self._tile_sizes[inner_axis] % width == 0
+        ):
+            self._alignment_offset = start.offset
+        else:
+            self._alignment_offset = None
+
+        self._repetitions *= step
+        inner_loop.append(create_loop_header(inner_axis, inner_extents, self._repetitions))
         inner_loop.append("{")
         inner_loop.extend(self.visit(node.body))
         inner_loop.append("}")
-        self._repetitions //= unroll_factor
+        self._repetitions //= step
 
         # Generate instructions for the rest that was not evenly divisible by the unroll factor
-        if unroll_factor > 1:
+        if step > 1:
             inner_extents[0] = "{e} - ({e} - ({s})) % {r}".format(
                 s=inner_extents[0],
                 e=inner_extents[1],
-                r=unroll_factor
+                r=step
             )
 
-            inner_loop.append(create_loop_header("i", inner_extents, self._repetitions))
-            inner_loop.append("{")
-            inner_loop.extend(self.visit(node.body))
-            inner_loop.append("}")
+            if width > 1:
+                # The vectors of the rest only load and store the lanes of the points left
+                self._masked = True
+                self._repetitions *= width
+                inner_loop.append(create_loop_header(
+                    inner_axis, inner_extents, self._repetitions, partial=True
+                ))
+                inner_loop.append("{")
+                inner_loop.append(self.intrinsic(
+                    "mask", count="({}) - idx_{}".format(inner_extents[1], inner_axis)
+                ))
+                inner_loop.extend(self.visit(node.body))
+                inner_loop.append("}")
+                self._repetitions //= width
+                self._masked = False
+            else:
+                inner_loop.append(create_loop_header(inner_axis, inner_extents, self._repetitions))
+                inner_loop.append("{")
+                inner_loop.extend(self.visit(node.body))
+                inner_loop.append("}")
+        self._vectorize = previous_vectorize
+        self._alignment_offset = previous_alignment_offset
 
-        outer_loop = [create_loop_header("j", create_extents(node.extents[1], "j"))]
+        outer_loop = [create_loop_header(outer_axis, outer_extents)]
         outer_loop.append("{")
         for line in inner_loop:
             outer_loop.append(line)
         outer_loop.append("}")
 
+        if tile_loops:
+            closing_braces = ["}" for line in tile_loops if line == "{"]
+            outer_loop = tile_loops + outer_loop + closing_braces
+
+        if self._parallel_axes is not None:
+            # The levels are computed one after the other, the threads share the loop
+            # over the points of the level if they are independent of each other.
+            if self.outermost_axis() in self._parallel_axes:
+                outer_loop.insert(0, "#pragma omp for" + self.schedule_clause())
+            else:
+                outer_loop = ["#pragma omp single", "{"] + outer_loop + ["}"]
+
+        if self._instrument and not self._stage_counted:
+            outer_loop = self.start_stage_counter() + outer_loop + self.stop_stage_counter(node)
+
         return outer_loop
 
     def visit_list_of_Stmt(self, nodes: List[ir.Stmt]) -> List[str]:
         res = []
 
-        # Make sure to adjust this if we change the instrucions or
-        # the datatype used.
-        vectorize_width = 4
+        vectorize_width = self.vector_width()
 
         # The `previous_*` variables are used to remember the value
         # of some subtree properties so that we can change the
@@ -293,64 +832,610 @@ class CodeGenCpp(IRNodeVisitor):
 
         previous_unroll_offset = self._unroll_offset
         previous_repetitions = self._repetitions
+        previous_defined_locals = self._defined_locals
         self._repetitions = 1
+        self._defined_locals = set()
 
         if self._vectorize and previous_repetitions % vectorize_width == 0:
             for i in range(previous_repetitions // vectorize_width):
                 self._unroll_offset = i * vectorize_width
                 for stmt in nodes:
-                    res.append(self.visit(stmt))
+                    res.extend(self.visit_with_locals(stmt))
         else:
             previous_vectorize = self._vectorize
             self._vectorize = False
 
             for i in range(previous_repetitions):
                 self._unroll_offset = i
-            for stmt in nodes:
-                res.append(self.visit(stmt))
+                for stmt in nodes:
+                    res.extend(self.visit_with_locals(stmt))
 
             self._vectorize = previous_vectorize
 
         self._repetitions = previous_repetitions
         self._unroll_offset = previous_unroll_offset
+        self._defined_locals = previous_defined_locals
 
         return res
 
-    def visit_IR(self, node: ir.IR) -> str:
+    def visit_with_locals(self, stmt: ir.Stmt) -> List[str]:
+        """A statement preceded by the definitions of the locals it uses first"""
+        code = self.visit(stmt)
+        definitions = self._local_definitions
+        self._local_definitions = []
+        return definitions + [code]
+
+    def constant_declarations(self) -> List[str]:
+        """
+        Broadcasts the literals and the scalar parameters into vectors once per kernel
+        instead of in the loops
+        """
+        if not self._vectorize:
+            return []
+        constants = list(self._constants.items())
+        constants += [(name, name + "_vector") for name in self._scalars]
+        return [
+            "[[maybe_unused]] const auto {} = {};".format(name, self.intrinsic("set", value=value))
+            for value, name in constants
+        ]
+
+    def shared_constants(self) -> List[str]:
+        """
+        The scalar parameters and their vectors, which the parallel regions share, and
+        the counters of the instrumented kernels
+        """
+        shared = ["stage_stats"] if self._instrument else []
+        if not self._vectorize:
+            return list(self._scalars) + shared
+        names = list(self._constants.values()) + self._scalars
+        return names + [name + "_vector" for name in self._scalars] + shared
+
+    def kernel_parameters(self, fields: List[str]) -> str:
+        """The parameters of a kernel before the bounds: the fields and the scalars"""
+        return ", ".join(fields + ["const scalar_t {}".format(name) for name in self._scalars])
+
+    def start_stage_counter(self) -> List[str]:
+        """Opens the scope of a stage whose cycles are counted, see `stop_stage_counter`"""
+        return ["{", "const myInt64 stage_start = start_tsc();"]
+
+    def stop_stage_counter(self, node: ir.HorizontalDomain) -> List[str]:
+        """Every thread adds the cycles it spent in the stage to its own counters"""
+        return [
+            "stage_stats.record({}, stop_tsc(stage_start));".format(self._stages[id(node)]),
+            "}",
+        ]
+
+    def count_stage_stats(self, node: ir.IR, calls: str) -> List[str]:
+        """
+        Adds the calls of an entry point and the bytes they move to the counters of every
+        stage. Every field the stage accesses is assumed to be read or written once per
+        point, the temporaries stay in the cache.
+        """
+        if not self._instrument:
+            return []
+        counters = []
+        for vertical_domain in node.body:
+            for horizontal_domain in vertical_domain.body:
+                stage = self._stages[id(horizontal_domain)]
+                intervals = zip(
+                    horizontal_domain.extents + [vertical_domain.extents], ["i", "j", "k"]
+                )
+                points = " * ".join(
+                    "static_cast<std::uint64_t>(std::max<std::ptrdiff_t>(0, "
+                    "static_cast<std::ptrdiff_t>({end}) - "
+                    "static_cast<std::ptrdiff_t>({start})))".format(start=start, end=end)
+                    for start, end in (
+                        create_extents(interval, axis) for interval, axis in intervals
+                    )
+                )
+                read = {access.name for access in read_accesses(horizontal_domain)}
+                read -= self._temporaries
+                written = written_fields(horizontal_domain) - self._temporaries
+                counters.append("stage_stats.calls[{}] += {};".format(stage, calls))
+                counters.append("stage_stats.bytes[{}] += {} * {} * {} * sizeof(scalar_t);".format(
+                    stage, calls, points, len(read) + len(written)
+                ))
+        return counters
+
+    def stage_descriptions(self, node: ir.IR) -> List[str]:
+        """The vertical and horizontal index and the fields written of every stage"""
+        descriptions = []
+        for v, vertical_domain in enumerate(node.body):
+            for h, horizontal_domain in enumerate(vertical_domain.body):
+                descriptions.append('boost::python::make_tuple({}, {}, "{}")'.format(
+                    v, h, ", ".join(sorted(written_fields(horizontal_domain)))
+                ))
+        return descriptions
+
+    def aligned_access(self, node: ir.FieldAccessExpr) -> bool:
+        """Whether a vector access of the unrolled loop is aligned to the vector size"""
+        if self._alignment_offset is None or node.name in self._temporaries:
+            return False
+        offset = node.offset.offsets[["i", "j", "k"].index(self._inner_axis)]
+        return (self._alignment_offset + offset) % self.vector_width() == 0
+
+    def vector_width(self) -> int:
+        """The number of elements in a vector of the current instruction set"""
+        bits = instruction_sets[self._isa]["bits"]
+        if bits is None:
+            return 1
+        return bits // (8 * dtypes[self._dtype][0])
+
+    def intrinsic(self, name: str, **kwargs: str) -> str:
+        """An intrinsic of the current instruction set for the element type of the fields"""
+        return instruction_sets[self._isa][name].format(suffix=dtypes[self._dtype][1], **kwargs)
+
+    def find_streamed_fields(self, node: ir.IR) -> Set[str]:
+        """
+        The fields that are written with non-temporal stores. Only the fields the
+        computation doesn't read qualify, the stores don't bring their lines into the cache.
+        """
+        read = {access.name for access in read_accesses(node)}
+        write_only = written_fields(node) - read - self._temporaries
+        if self._streaming_stores is None:
+            return write_only
+        invalid = set(self._streaming_stores) - write_only
+        if invalid:
+            raise ValueError(
+                "Streaming stores need fields that are only written, {} are not".format(
+                    sorted(invalid)
+                )
+            )
+        return set(self._streaming_stores)
+
+    def streaming(self) -> bool:
+        """Whether the current kernel writes fields with non-temporal stores"""
+        return self._vectorize and bool(self._streamed)
+
+    def kernel_name(
+        self,
+        node: ir.IR,
+        variant: str,
+        isa: Optional[str] = None,
+        aligned: Optional[bool] = None,
+    ) -> str:
+        """The name of a kernel, by default of the current instruction set and alignment"""
+        isa = self._isa if isa is None else isa
+        aligned = self._aligned if aligned is None else aligned
+        return "{}_{}_{}{}".format(node.name, variant, isa, "_aligned" if aligned else "")
+
+    def kernel_attributes(self) -> str:
+        """The target attribute enabling the instruction set of the current kernel"""
+        target = instruction_sets[self._isa]["target"]
+        if target is None:
+            return ""
+        return '__attribute__((target("{}"))) '.format(target)
+
+    def kernel_isas(self, vectorize: bool) -> List[str]:
+        """The instruction sets the kernels of a layout variant are generated for"""
+        if self._vectorize and self._vector_math and vectorize:
+            return self._isas
+        return ["scalar"]
+
+    def selected_isa(self) -> str:
+        """
+        The instruction set of the vector kernels the module calls, the widest one they are
+        generated for that the CPU supports
+        """
+        selected = "isa_t::scalar"
+        for isa in reversed(self.kernel_isas(True)[:-1]):
+            selected = "cpu_isa >= isa_t::{isa} ? isa_t::{isa} : {selected}".format(
+                isa=isa, selected=selected
+            )
+        return selected
+
+    def generate_kernel(self, node: ir.IR, variant: str, arguments: List[str]) -> List[str]:
+        """
+        Generates the kernel of one layout variant, working on fields with arbitrary strides
+        """
+        kernel = ["{attributes}static void {name}({fields}, {bounds}) {{".format(
+            attributes=self.kernel_attributes(),
+            name=self.kernel_name(node, variant),
+            fields=self.kernel_parameters(["const field_t {}".format(arg) for arg in arguments]),
+            bounds=", ".join(["const std::size_t {}".format(bound) for bound in bounds_names]),
+        )]
+        kernel.extend(self.constant_declarations())
+        if self._openmp and (len(node.body) > 1 or self.streaming()):
+            # All the vertical domains share one parallel region instead of starting
+            # the threads for each of them. With streaming stores, every thread also
+            # needs the region to fence its stores before the threads join.
+            shared_planes = sorted(self._shared_planes)
+            kernel.extend(self.temporary_buffers(shared_planes))
+            kernel.append("#pragma omp parallel default(none) shared({})".format(
+                ", ".join(arguments + bounds_names + shared_planes + self.shared_constants())
+            ))
+            kernel.append("{")
+            kernel.extend(self.temporary_buffers(sorted(self._temporaries - self._shared_planes)))
+            kernel.extend(self.generate_region(node, final_barrier=False))
+            if self.streaming():
+                kernel.append("_mm_sfence();")
+            kernel.append("}")
+        else:
+            for stmt in node.body:
+                kernel.extend(self.visit(stmt))
+            if self.streaming():
+                kernel.append("_mm_sfence();")
+        kernel.append("}")
+        return kernel
+
+    def generate_region(self, node: ir.IR, final_barrier: bool) -> List[str]:
+        """
+        Generates the vertical domains inside of an enclosing parallel region. The threads
+        only wait for each other after a vertical domain if a later one accesses a field
+        that was written since the last barrier or writes a field that was accessed.
+        """
+        region = []
+        unsynchronized = []
+        self._enclosing_region = True
+        for index, vertical_domain in enumerate(node.body):
+            unsynchronized.append(vertical_domain)
+            if index + 1 < len(node.body):
+                following = node.body[index + 1]
+                barrier = any(
+                    conflicting_fields(previous, following) - self._temporaries
+                    for previous in unsynchronized
+                )
+            else:
+                barrier = final_barrier
+            if barrier:
+                unsynchronized = []
+
+            self._nowait = not barrier
+            region.extend(self.visit(vertical_domain))
+        self._nowait = False
+        self._enclosing_region = False
+        return region
+
+    def generate_check(self, node: ir.IR, arguments: List[str]) -> List[str]:
+        """
+        Generates the function checking that the arrays are large enough for all the
+        accesses. It returns the error message of the first violated constraint. The
+        planes of the temporaries are as large as needed, only their lower bounds
+        depend on the bounds of the call.
+        """
+        check = [
+            "static const char* {}_check([[maybe_unused]] const std::size_t* shapes, "
+            "[[maybe_unused]] const std::size_t* bounds) {{".format(node.name)
+        ]
+        for n, bound in enumerate(bounds_names):
+            check.append(
+                "[[maybe_unused]] const std::ptrdiff_t {} = bounds[{}];".format(bound, n)
+            )
+        for name, axis, is_upper, level, offset in extent_constraints(field_extents(node)):
+            bound = "{}_{}".format("start" if level == ir.LevelMarker.START else "end", axis)
+            if name in arguments and is_upper:
+                shape = "static_cast<std::ptrdiff_t>(shapes[{}])".format(
+                    3 * arguments.index(name) + "ijk".index(axis)
+                )
+                condition = "{} + {} > {}".format(bound, offset, shape)
+            elif (name in arguments or name in self._temporaries) and not is_upper:
+                condition = "{} + {} < 0".format(bound, offset)
+            else:
+                continue
+            check.append('if ({}) return "{}";'.format(
+                condition, describe_constraint(name, axis, is_upper, level, offset)
+            ))
+        check.append("return nullptr;")
+        check.append("}")
+        return check
+
+    def generate_dispatch(self, node: ir.IR, suffix: str, call_arguments: List[str]) -> List[str]:
+        """
+        Calls the first kernel variant whose layout matches the strides of all the fields,
+        using the widest instruction set that the CPU supports
+        """
+        arguments = field_arguments(node)
+        dispatch = []
+        for variant, unit_stride, vectorize, aligned_variant in layout_variants:
+            calls = []
+            for isa in self.kernel_isas(vectorize):
+                call = "{}{}({});".format(
+                    self.kernel_name(node, variant, isa, False), suffix, ", ".join(call_arguments)
+                )
+                if aligned_variant and isa != "scalar":
+                    # The rows of all the fields have to be aligned to the vector size at
+                    # the start bound
+                    condition = " && ".join(
+                        "aligned_rows(&{arg}.data[start_{axis}], "
+                        "{arg}.stride_{first}, {arg}.stride_{second}, {size})".format(
+                            arg=arg,
+                            axis=unit_stride,
+                            first=other_axis(unit_stride),
+                            second="k",
+                            size=instruction_sets[isa]["bits"] // 8,
+                        )
+                        for arg in arguments
+                    ) or "true"
+                    aligned_call = "{}{}({});".format(
+                        self.kernel_name(node, variant, isa, True),
+                        suffix,
+                        ", ".join(call_arguments),
+                    )
+                    call = "if ({}) {{\n{}\n}} else {{\n{}\n}}".format(
+                        condition, aligned_call, call
+                    )
+                if isa == "scalar":
+                    calls.extend(["else {", call, "}"] if calls else [call])
+                else:
+                    keyword = "else if" if calls else "if"
+                    calls.extend(["{} (cpu_isa >= isa_t::{}) {{".format(keyword, isa), call, "}"])
+            if unit_stride is None:
+                dispatch.extend(["else {"] + calls + ["}"])
+            else:
+                condition = " && ".join(
+                    "{}.stride_{} == 1".format(arg, unit_stride) for arg in arguments
+                ) or "true"
+                keyword = "else if" if dispatch else "if"
+                dispatch.extend(["{} ({}) {{".format(keyword, condition)] + calls + ["}"])
+        return dispatch
+
+    def generate_steps_kernel(self, node: ir.IR, variant: str, arguments: List[str]) -> List[str]:
+        """
+        Generates the kernel running several steps of one layout variant. All the steps
+        run in one parallel region, the loops over the levels are shared among its threads.
+        After every step the threads swap two of their field pointers.
+        """
+        kernel = ["{attributes}static void {name}_steps({fields}, {bounds}, {steps}) {{".format(
+            attributes=self.kernel_attributes(),
+            name=self.kernel_name(node, variant),
+            fields=self.kernel_parameters(["const field_t* initial_fields"]),
+            bounds=", ".join(["const std::size_t {}".format(bound) for bound in bounds_names]),
+            steps=(
+                "const std::size_t steps, const std::size_t swap_first, "
+                "const std::size_t swap_second"
+            ),
+        )]
+        kernel.extend(self.constant_declarations())
+        shared_planes = sorted(self._shared_planes)
+        kernel.extend(self.temporary_buffers(shared_planes))
         if self._openmp:
-            check_openmp_private(node)
+            kernel.append(
+                "#pragma omp parallel default(none) "
+                "shared(initial_fields, {}, steps, swap_first, swap_second)".format(
+                    ", ".join(bounds_names + shared_planes + self.shared_constants())
+                )
+            )
+        kernel.append("{")
+        kernel.append("std::array<field_t, {}> fields;".format(len(arguments)))
+        kernel.append("std::copy_n(initial_fields, fields.size(), fields.begin());")
+        kernel.extend(self.temporary_buffers(sorted(self._temporaries - self._shared_planes)))
+        kernel.append("for (std::size_t step = 0; step < steps; ++step) {")
+        for n, arg in enumerate(arguments):
+            kernel.append("const field_t {} = fields[{}];".format(arg, n))
+
+        # The next step reads what this one wrote, all the threads have to be done
+        # with the step before the fields are swapped.
+        if self.streaming():
+            # The non-temporal stores of the step have to be visible to the other threads
+            kernel.extend(self.generate_region(node, final_barrier=False))
+            kernel.append("_mm_sfence();")
+            if self._openmp:
+                kernel.append("#pragma omp barrier")
+        else:
+            kernel.extend(self.generate_region(node, final_barrier=True))
 
-        scope = [""" #include <common_python.hpp>
+        kernel.append("std::swap(fields[swap_first], fields[swap_second]);")
+        kernel.append("}")
+        kernel.append("}")
+        kernel.append("}")
+        return kernel
+
+    def visit_IR(self, node: ir.IR) -> str:
+        self._temporaries = set(node.temporaries)
+        self._parallel_loops = self.find_parallel_loops(node) if self._openmp else {}
+        self._shared_planes = self.find_shared_planes(node)
+        self._streamed = self.find_streamed_fields(node)
+        self._scalars = list(node.scalars)
+        self._stages = {
+            id(horizontal_domain): n
+            for n, horizontal_domain in enumerate(
+                horizontal_domain
+                for vertical_domain in node.body
+                for horizontal_domain in vertical_domain.body
+            )
+        }
+        arguments = field_arguments(node)
+        signature = call_arguments(node)
+        expressions = [expr for stmt in assignments(node) for expr in subexpressions(stmt.right)]
+        literals = [expr.value for expr in expressions if isinstance(expr, ir.LiteralExpr)]
+        self._constants = {
+            value: "constant_{}".format(n) for n, value in enumerate(dict.fromkeys(literals))
+        }
+        self._vector_math = not any(
+            isinstance(expr, ir.BinaryOp) and expr.operator == "**" for expr in expressions
+        )
+        self._plane_halos = {
+            name: (extents[0].halo()[1], extents[1].halo()[1])
+            for name, extents in field_extents(node).items()
+            if name in self._temporaries
+        }
+
+        # The header picks the element type of the fields
+        scope = ["#define TOYDSL_FLOAT32"] if self._dtype == "float32" else []
+        scope.append(""" #include <common_python.hpp>
+            #include <algorithm>
+            #include <cmath>
             #include <immintrin.h>
+            #include <vector>
+        """)
+        if self._instrument:
+            scope.append("#include <instrumentation.hpp>")
+            scope.append("static stage_stats_t<{}> stage_stats;".format(len(self._stages)))
 
-            void {name}({array_args}, {bounds}) {{
+        previous_vectorize = self._vectorize
+        for variant, unit_stride, vectorize, aligned_variant in layout_variants:
+            self._unit_stride = unit_stride
+            self._inner_axis = unit_stride if unit_stride is not None else "i"
+            for isa in self.kernel_isas(vectorize):
+                self._isa = isa
+                self._vectorize = isa != "scalar"
+                for aligned in [False, True] if aligned_variant and self._vectorize else [False]:
+                    self._aligned = aligned
+                    scope.extend(self.generate_kernel(node, variant, arguments))
+                    scope.extend(self.generate_steps_kernel(node, variant, arguments))
+            self._vectorize = previous_vectorize
+        self._isa = "scalar"
+        self._aligned = False
 
-                const auto [start_i, end_i, start_j, end_j, start_k, end_k] = get_bounds(i, j, k);
-                const std::size_t dim2 = (end_i - start_i);
-                const std::size_t dim3 = dim2 * (end_j - start_j);
+        # The entry points read the strides of the arrays and dispatch to the kernel
+        # whose innermost loop runs along contiguous memory.
+        dispatch = self.generate_dispatch(node, "", arguments + self._scalars + bounds_names)
+        steps_dispatch = self.generate_dispatch(
+            node,
+            "_steps",
+            ["fields"] + self._scalars + bounds_names + ["steps", "swap_first", "swap_second"],
+        )
 
-                    {converters}
+        written = written_fields(node)
+        scope.extend(self.generate_check(node, arguments))
 
-        """.format(
-            name=node.name,
-            array_args=", ".join(["array_t &{}_np".format(arg) for arg in node.api_signature]),
-            bounds=", ".join(["const bounds_t &{}".format(axis) for axis in ["k", "j", "i"]]),
-            converters="\n".join(map(generate_converter, node.api_signature))
-        )]
+        stats_functions = stats_exports = ""
+        if self._instrument:
+            stats_functions = """
+                static boost::python::list {name}_stats() {{
+                    return stage_stats.to_python();
+                }}
 
-        for stmt in node.body:
-            scope.extend(self.visit(stmt))
+                static void {name}_reset_stats() {{
+                    stage_stats.reset();
+                }}
+            """.format(name=node.name)
+            stats_exports = """
+                boost::python::def("{name}_stats", {name}_stats);
+                boost::python::def("{name}_reset_stats", {name}_reset_stats);
+                boost::python::scope().attr("{name}_stages") = boost::python::make_tuple({stages});
+            """.format(name=node.name, stages=", ".join(self.stage_descriptions(node)))
 
         scope.append("""
+            static void {name}_run(const field_t* fields, [[maybe_unused]] const scalar_t* scalars,
+                                   const std::size_t* bounds) {{
+                {unpack_fields}
+                {unpack_scalars}
+                {unpack_bounds}
+                {count_stats}
+
+                {dispatch}
+            }}
+
+            static void {name}_run_steps(const field_t* fields,
+                                         [[maybe_unused]] const scalar_t* scalars,
+                                         const std::size_t* bounds, const std::size_t steps,
+                                         const std::size_t swap_first,
+                                         const std::size_t swap_second) {{
+                {unpack_fields}
+                {unpack_scalars}
+                {unpack_bounds}
+                {count_steps_stats}
+
+                {steps_dispatch}
+            }}
+
+            void {name}({parameters}, {bounds}) {{
+
+                const std::array<std::size_t, 6> bounds = get_bounds(i, j, k);
+                const std::array<std::size_t, {num_shapes}> shapes = {{{{{shapes}}}}};
+                const char* error = {name}_check(shapes.data(), bounds.data());
+                if (error != nullptr) {{
+                    throw std::invalid_argument(error);
+                }}
+
+                {converters}
+
+                const std::array<field_t, {num_fields}> fields = {{{{{arguments}}}}};
+                const std::array<scalar_t, {num_scalars}> scalars = {{{{{scalars}}}}};
+                {name}_run(fields.data(), scalars.data(), bounds.data());
 
                 return;
             }}
 
+            static const kernel_info_t<{num_fields}, {num_scalars}> {name}_info = {{
+                {name}_run, {name}_run_steps, {name}_check, {{{{{written}}}}},
+                {{{{{field_positions}}}}}, {{{{{scalar_positions}}}}}
+            }};
+
+            static PyMethodDef {name}_fast_def = {{
+                "{name}_fast",
+                reinterpret_cast<PyCFunction>(reinterpret_cast<void (*)()>(
+                    fast_call<{num_fields}, {num_scalars}, {name}_info>)),
+                METH_FASTCALL,
+                "Calls {name} through the buffer protocol."
+            }};
+
+            static PyMethodDef {name}_bind_def = {{
+                "{name}_bind",
+                reinterpret_cast<PyCFunction>(reinterpret_cast<void (*)()>(
+                    bind_call<{num_fields}, {num_scalars}, {name}_info>)),
+                METH_FASTCALL,
+                "Checks the arguments of {name} once and returns a function calling it on them."
+            }};
+
+            static PyMethodDef {name}_steps_def = {{
+                "{name}_steps",
+                reinterpret_cast<PyCFunction>(reinterpret_cast<void (*)()>(
+                    steps_call<{num_fields}, {num_scalars}, {name}_info>)),
+                METH_FASTCALL,
+                "Runs several steps of {name}, swapping two fields after every step."
+            }};
+
+            {stats_functions}
+
             BOOST_PYTHON_MODULE(dslgen) {{
                 Py_Initialize();
                 np::initialize();
                 boost::python::def("{name}", {name});
+                add_function({name}_fast_def);
+                add_function({name}_bind_def);
+                add_function({name}_steps_def);
+                boost::python::scope().attr("{name}_arguments") =
+                    boost::python::make_tuple({argument_names});
+                boost::python::scope().attr("{name}_scalars") =
+                    boost::python::make_tuple({scalar_names});
+                boost::python::scope().attr("isa") = isa_name({selected_isa});
+                {stats_exports}
             }}
-        """.format(name=node.name))
+        """.format(
+            name=node.name,
+            parameters=", ".join(
+                "const scalar_t {}".format(arg)
+                if arg in self._scalars
+                else "array_t &{}_np".format(arg)
+                for arg in signature
+            ),
+            bounds=", ".join(["const bounds_t &{}".format(axis) for axis in ["k", "j", "i"]]),
+            converters="\n".join(map(generate_converter, arguments)),
+            unpack_fields="\n".join(
+                "const field_t {} = fields[{}];".format(arg, n) for n, arg in enumerate(arguments)
+            ),
+            unpack_scalars="\n".join(
+                "const scalar_t {} = scalars[{}];".format(name, n)
+                for n, name in enumerate(self._scalars)
+            ),
+            unpack_bounds="\n".join(
+                "const std::size_t {} = bounds[{}];".format(bound, n)
+                for n, bound in enumerate(bounds_names)
+            ),
+            count_stats="\n".join(self.count_stage_stats(node, "1")),
+            count_steps_stats="\n".join(self.count_stage_stats(node, "steps")),
+            stats_functions=stats_functions,
+            stats_exports=stats_exports,
+            selected_isa=self.selected_isa(),
+            dispatch="\n".join(dispatch),
+            steps_dispatch="\n".join(steps_dispatch),
+            argument_names=", ".join('"{}"'.format(arg) for arg in signature),
+            scalar_names=", ".join('"{}"'.format(name) for name in self._scalars),
+            num_fields=len(arguments),
+            num_scalars=len(self._scalars),
+            num_shapes=3 * len(arguments),
+            shapes=", ".join(
+                "static_cast<std::size_t>({}_np.shape({}))".format(arg, axis)
+                for arg in arguments
+                for axis in [2, 1, 0]
+            ),
+            arguments=", ".join(arguments),
+            scalars=", ".join(self._scalars),
+            field_positions=", ".join(str(signature.index(arg)) for arg in arguments),
+            scalar_positions=", ".join(str(signature.index(name)) for name in self._scalars),
+            written=", ".join("true" if arg in written else "false" for arg in arguments),
+        ))
 
         return "\n".join(scope)
@@ -0,0 +1,308 @@
+from __future__ import annotations
+
+from typing import List, Set
+
+import toydsl.ir.ir as ir
+from toydsl.backend.codegen import TextBlock
+from toydsl.ir.accesses import FieldCollector, call_arguments, field_arguments, written_fields
+from toydsl.ir.dependencies import carried_fields
+from toydsl.ir.visitor import IRNodeVisitor
+
+
+# The numpy ufuncs used to lower the binary operators of the DSL. All of them
+# accept an `out=` argument, which is what lets us evaluate expressions in place.
+ufuncs = {
+    "+": "np.add",
+    "-": "np.subtract",
+    "*": "np.multiply",
+    "/": "np.true_divide",
+    "**": "np.power",
+    "%": "np.mod",
+}
+
+# The axes of the IR in the order of the numpy array dimensions. This matches the
+# memory layout of the C++ backend, where `i` is the fastest varying index.
+array_axes = ["k", "j", "i"]
+
+
+def bound_to_string(offset: ir.Offset, axis: str, access_offset: int = 0) -> str:
+    """
+    Converts a level marker with its offset to the python expression of the bound
+    """
+    side = "start" if offset.level == ir.LevelMarker.START else "end"
+    total = offset.offset + access_offset
+    if total == 0:
+        return "{}_{}".format(side, axis)
+    return "{}_{} {} {}".format(side, axis, "+" if total > 0 else "-", abs(total))
+
+
+def loop_index_to_string(axis: str, access_offset: int) -> str:
+    if access_offset == 0:
+        return "idx_{}".format(axis)
+    return "idx_{} {} {}".format(axis, "+" if access_offset > 0 else "-", abs(access_offset))
+
+
+def is_leaf(node: ir.Expr) -> bool:
+    return isinstance(node, (ir.FieldAccessExpr, ir.LiteralExpr, ir.LocalExpr, ir.ScalarAccessExpr))
+
+
+def has_vertical_dependency(vertical_domain: ir.VerticalDomain) -> bool:
+    """
+    Checks whether a field that is written inside the vertical domain is also accessed
+    with a vertical offset. In that case the result depends on the order in which the
+    levels are computed and we can't evaluate all levels at once.
+    """
+    written: Set[str] = set()
+    for horizontal_domain in vertical_domain.body:
+        for stmt in horizontal_domain.body:
+            written.add(stmt.left.name)
+
+    return any(
+        access.name in written and access.offset.offsets[2] != 0
+        for access in FieldCollector.apply(vertical_domain)
+    )
+
+
+def horizontal_loop_axes(horizontal_domain: ir.HorizontalDomain) -> List[str]:
+    """
+    The horizontal axes along which the points of a horizontal domain have to be computed
+    one after the other, like the loops of the C++ backend do. A field that is written and
+    also accessed with an offset along an axis would otherwise be read before the points
+    it depends on are written.
+    """
+    return [
+        axis for axis in ["j", "i"] if carried_fields(horizontal_domain, axis, fixed=["k"])
+    ]
+
+
+class CodeGenNumpy(IRNodeVisitor):
+    """
+    The code-generation module that traverses the IR and generates numpy code from it.
+
+    Every horizontal domain is lowered to whole-array slice expressions. Whenever
+    possible the expressions are evaluated in place into the destination array with
+    the `out=` argument of the ufuncs, so that no temporary arrays are created. Along the
+    axes with loop carried dependencies the points are computed one after the other.
+    """
+
+    def __init__(self):
+        # The index along an axis is either a slice over the whole domain or the loop
+        # variable `idx_<axis>` if the points have to be computed one after the other,
+        # which is what `_loop_axes` selects. The loops along i and j index slices of a
+        # single point, so that the accesses stay views that can be written through.
+        self._vertical_extents: ir.AxisInterval = None
+        self._loop_axes: Set[str] = set()
+        self._horizontal_extents: List[ir.AxisInterval] = []
+        self._scratch_count = 0
+        # The locals that are computed so far in the current horizontal domain, and the
+        # ones the current statement needs first
+        self._defined_locals: Set[str] = set()
+        self._local_definitions: List[str] = []
+
+    @classmethod
+    def apply(cls: CodeGenNumpy, ir: ir.IR) -> str:
+        """
+        Entrypoint for the code generation, applying this to an IR returns the source
+        of a python module containing the function for that IR
+        """
+        codegen = cls()
+        return codegen.visit(ir)
+
+    def slice_to_string(self, access_offset: ir.AccessOffset) -> str:
+        """
+        Converts the offset of a FieldAccess to the slices selecting the whole domain
+        """
+        extents = {
+            "i": self._horizontal_extents[0],
+            "j": self._horizontal_extents[1],
+            "k": self._vertical_extents,
+        }
+        offsets = {
+            "i": access_offset.offsets[0],
+            "j": access_offset.offsets[1],
+            "k": access_offset.offsets[2],
+        }
+
+        indices = []
+        for axis in array_axes:
+            if axis == "k" and axis in self._loop_axes:
+                indices.append(loop_index_to_string(axis, offsets[axis]))
+            elif axis in self._loop_axes:
+                indices.append(
+                    "{}:{} + 1".format(
+                        loop_index_to_string(axis, offsets[axis]),
+                        loop_index_to_string(axis, offsets[axis]),
+                    )
+                )
+            else:
+                indices.append(
+                    "{}:{}".format(
+                        bound_to_string(extents[axis].start, axis, offsets[axis]),
+                        bound_to_string(extents[axis].end, axis, offsets[axis]),
+                    )
+                )
+        return "[" + ", ".join(indices) + "]"
+
+    def new_scratch(self) -> str:
+        self._scratch_count += 1
+        return "scratch_{}".format(self._scratch_count)
+
+    def evaluate_into(self, node: ir.Expr, destination: str) -> List[str]:
+        """
+        Generates the statements that evaluate an expression into the array `destination`
+        without creating any temporaries but explicitly allocated scratch arrays.
+        """
+        if isinstance(node, (ir.LiteralExpr, ir.ScalarAccessExpr)):
+            return ["{}[...] = {}".format(destination, self.visit(node))]
+        if isinstance(node, (ir.FieldAccessExpr, ir.LocalExpr)):
+            return ["np.copyto({}, {})".format(destination, self.visit(node))]
+
+        ufunc = ufuncs[node.operator]
+        if is_leaf(node.left) and is_leaf(node.right):
+            return [
+                "{}({}, {}, out={})".format(
+                    ufunc, self.visit(node.left), self.visit(node.right), destination
+                )
+            ]
+        if is_leaf(node.right):
+            lines = self.evaluate_into(node.left, destination)
+            lines.append(
+                "{}({}, {}, out={})".format(ufunc, destination, self.visit(node.right), destination)
+            )
+            return lines
+        if is_leaf(node.left):
+            lines = self.evaluate_into(node.right, destination)
+            lines.append(
+                "{}({}, {}, out={})".format(ufunc, self.visit(node.left), destination, destination)
+            )
+            return lines
+
+        # Both operands are expressions themselves, one of them needs its own buffer
+        lines = self.evaluate_into(node.left, destination)
+        scratch = self.new_scratch()
+        lines.append("{} = np.empty_like({})".format(scratch, destination))
+        lines.extend(self.evaluate_into(node.right, scratch))
+        lines.append("{}({}, {}, out={})".format(ufunc, destination, scratch, destination))
+        return lines
+
+    # ---- Visitor handlers ----
+    def generic_visit(self, node: ir.Node, **kwargs) -> None:
+        """
+        Each visit needs to do something in code-generation, there can't be a default visit
+        """
+        raise RuntimeError("Invalid IR node: {}".format(node))
+
+    def visit_LiteralExpr(self, node: ir.LiteralExpr) -> str:
+        return node.value
+
+    def visit_FieldAccessExpr(self, node: ir.FieldAccessExpr) -> str:
+        return node.name + self.slice_to_string(node.offset)
+
+    def visit_AssignmentStmt(self, node: ir.AssignmentStmt) -> List[str]:
+        left = self.visit(node.left)
+        reads = {access.name for access in FieldCollector.apply(node.right)}
+
+        if node.left.name in reads or is_leaf(node.right):
+            # The destination is read on the right hand side, possibly with an offset.
+            # Writing intermediate results into it would change the values we still
+            # have to read, so we let numpy evaluate the expression on its own.
+            return ["{} = {}".format(left, self.visit(node.right))]
+
+        destination = "{}_view".format(node.left.name)
+        lines = ["{} = {}".format(destination, left)]
+        lines.extend(self.evaluate_into(node.right, destination))
+        return lines
+
+    def visit_ScalarAccessExpr(self, node: ir.ScalarAccessExpr) -> str:
+        return node.name
+
+    def visit_BinaryOp(self, node: ir.BinaryOp) -> str:
+        return "({} {} {})".format(self.visit(node.left), node.operator, self.visit(node.right))
+
+    def visit_LocalExpr(self, node: ir.LocalExpr) -> str:
+        # The local holds the values of all the points of the domain
+        if node.name not in self._defined_locals:
+            value = self.visit(node.value)
+            self._defined_locals.add(node.name)
+            self._local_definitions.append("{} = {}".format(node.name, value))
+        return node.name
+
+    def visit_VerticalDomain(self, node: ir.VerticalDomain) -> List[str]:
+        previous_vertical_extents = self._vertical_extents
+        previous_loop_axes = self._loop_axes
+        self._vertical_extents = node.extents
+        self._loop_axes = {"k"} if has_vertical_dependency(node) else set()
+
+        vertical_block = TextBlock()
+        if "k" in self._loop_axes:
+            vertical_block.append(
+                "for idx_k in range({}, {}):".format(
+                    bound_to_string(node.extents.start, "k"),
+                    bound_to_string(node.extents.end, "k"),
+                )
+            )
+            vertical_block.indent()
+
+        for stmt in node.body:
+            for line in self.visit(stmt):
+                vertical_block.append(line)
+
+        self._vertical_extents = previous_vertical_extents
+        self._loop_axes = previous_loop_axes
+
+        return vertical_block.lines
+
+    def visit_HorizontalDomain(self, node: ir.HorizontalDomain) -> List[str]:
+        previous_horizontal_extents = self._horizontal_extents
+        previous_loop_axes = self._loop_axes
+        self._horizontal_extents = node.extents
+        loop_axes = horizontal_loop_axes(node)
+        self._loop_axes = self._loop_axes | set(loop_axes)
+
+        block = TextBlock()
+        extents = {"i": node.extents[0], "j": node.extents[1]}
+        for axis in loop_axes:
+            block.append(
+                "for idx_{axis} in range({}, {}):".format(
+                    bound_to_string(extents[axis].start, axis),
+                    bound_to_string(extents[axis].end, axis),
+                    axis=axis,
+                )
+            )
+            block.indent()
+
+        self._defined_locals = set()
+        for stmt in node.body:
+            code = self.visit(stmt)
+            for line in self._local_definitions + code:
+                block.append(line)
+            self._local_definitions = []
+
+        self._horizontal_extents = previous_horizontal_extents
+        self._loop_axes = previous_loop_axes
+
+        return block.lines
+
+    def visit_IR(self, node: ir.IR) -> str:
+        scope = TextBlock()
+        scope.append("import numpy as np")
+        scope.append("")
+        scope.append("")
+        arguments = call_arguments(node)
+        fields = field_arguments(node)
+        scope.append(
+            "def {name}({args}, k, j, i):".format(name=node.name, args=", ".join(arguments))
+        )
+        scope.indent()
+        for axis in ["i", "j", "k"]:
+            scope.append("start_{axis}, end_{axis} = {axis}[0], {axis}[1]".format(axis=axis))
+        # The temporaries are computed like the fields the stencil writes, over their shape
+        written = [name for name in fields if name in written_fields(node)]
+        for name in node.temporaries:
+            scope.append("{} = np.empty_like({})".format(name, (written or fields)[0]))
+
+        for stmt in node.body:
+            for line in self.visit(stmt):
+                scope.append(line)
+
+        return "\n".join(scope.lines) + "\n"
@@ -0,0 +1,525 @@
+"""
+Benchmarks of the DSL, run with `python -m toydsl bench run`.
+
+Every benchmark is a DSL stencil together with a handwritten numpy version of it, the
+`baseline` backend. The baselines are written like the ones in `easyNumpy/easynumpy.py`,
+but they compute on the same intervals as the stencils, e.g. the second stage of
+`lapoflap` starts at `start + 2`, so that their results can be compared. The runner times
+them for every combination of grid size, backend and number of OpenMP threads, and
+reports the time per call, the memory bandwidth, the floating point operations and the
+points computed per second.
+
+The bandwidth and FLOP rates come from a model of the stencil rather than from hardware
+counters: every field argument is read once from memory if the stencil reads it, and
+written once if it writes it. The operations are counted on the optimized IR, so they
+are the ones the generated code actually executes.
+
+The results are stored as JSON, `python -m toydsl bench compare` compares two such runs
+and flags the benchmarks that got slower.
+"""
+import datetime
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+import toydsl.ir.ir as ir
+from toydsl.driver.build import build_environment, default_build_mode
+from toydsl.driver.cache import compiler_version, default_build_type
+from toydsl.driver.driver import create_stencil, hash_source_code, optimize, parse_definition
+# Horizontal etc. are not used by the python interpreter, the stencils are parsed from
+# their source. The import just keeps linters happy.
+from toydsl.frontend.language import Horizontal, Vertical, end, start
+from toydsl.ir.accesses import field_arguments, read_accesses, subexpressions, written_fields
+
+# The version of the format of the result files
+format_version = 1
+
+default_backends = ("cpp", "numpy", "baseline")
+
+default_sizes = ((16, 32, 32), (32, 64, 64), (64, 128, 128), (128, 256, 256))
+
+# Relative slowdown of the time per call above which `compare` reports a regression
+default_threshold = 0.1
+
+
+def copy_stencil(out_field, in_field):
+    with Vertical[start:end]:
+        with Horizontal[start : end, start : end]:
+            out_field[0, 0, 0] = in_field[0, 0, 0]
+
+
+def vertical_blur(out_field, in_field):
+    with Vertical[start + 1 : end - 1]:
+        with Horizontal[start : end, start : end]:
+            out_field[0, 0, 0] = (in_field[0, 0, 1] + in_field[0, 0, 0] + in_field[0, 0, -1]) / 3
+
+
+def lapoflap(out_field, in_field, tmp1_field):
+    """
+    out = in - 0.03 * laplace of laplace
+    """
+    with Vertical[start:end]:
+        with Horizontal[start + 1 : end - 1, start + 1 : end - 1]:
+            tmp1_field[0, 0, 0] = (
+                -4.0 * in_field[0, 0, 0]
+                + in_field[-1, 0, 0] + in_field[1, 0, 0]
+                + in_field[0, -1, 0] + in_field[0, 1, 0]
+            )
+        with Horizontal[start + 2 : end - 2, start + 2 : end - 2]:
+            out_field[0, 0, 0] = in_field[0, 0, 0] - 0.03 * (
+                -4.0 * tmp1_field[0, 0, 0]
+                + tmp1_field[-1, 0, 0] + tmp1_field[1, 0, 0]
+                + tmp1_field[0, -1, 0] + tmp1_field[0, 1, 0]
+            )
+
+
+def copy_stencil_numpy(out_field, in_field, k, j, i):
+    out_field[k[0]:k[1], j[0]:j[1], i[0]:i[1]] = in_field[k[0]:k[1], j[0]:j[1], i[0]:i[1]]
+
+
+def vertical_blur_numpy(out_field, in_field, k, j, i):
+    kb, ke = k[0] + 1, k[1] - 1
+    plane = (slice(j[0], j[1]), slice(i[0], i[1]))
+    out_field[(slice(kb, ke),) + plane] = (
+        in_field[(slice(kb + 1, ke + 1),) + plane]
+        + in_field[(slice(kb, ke),) + plane]
+        + in_field[(slice(kb - 1, ke - 1),) + plane]
+    ) / 3
+
+
+def lapoflap_numpy(out_field, in_field, tmp1_field, k, j, i):
+    def laplacian(out, field, margin):
+        kb, ke = k[0], k[1]
+        jb, je = j[0] + margin, j[1] - margin
+        ib, ie = i[0] + margin, i[1] - margin
+        out[kb:ke, jb:je, ib:ie] = (
+            -4.0 * field[kb:ke, jb:je, ib:ie]
+            + field[kb:ke, jb:je, ib - 1:ie - 1] + field[kb:ke, jb:je, ib + 1:ie + 1]
+            + field[kb:ke, jb - 1:je - 1, ib:ie] + field[kb:ke, jb + 1:je + 1, ib:ie]
+        )
+
+    laplacian(tmp1_field, in_field, 1)
+    interior = (slice(k[0], k[1]), slice(j[0] + 2, j[1] - 2), slice(i[0] + 2, i[1] - 2))
+    tmp2_field = np.empty_like(tmp1_field)
+    laplacian(tmp2_field, tmp1_field, 2)
+    out_field[interior] = in_field[interior] - 0.03 * tmp2_field[interior]
+
+
+class Benchmark:
+    """A DSL stencil, its handwritten numpy version and the options to compile it with"""
+
+    def __init__(self, definition, baseline: Callable, options: Optional[Dict[str, Any]] = None):
+        self.definition = definition
+        self.baseline = baseline
+        self.options = options if options is not None else {}
+
+    @property
+    def name(self) -> str:
+        return self.definition.__name__
+
+
+benchmarks: Dict[str, Benchmark] = {
+    benchmark.name: benchmark
+    for benchmark in [
+        Benchmark(copy_stencil, copy_stencil_numpy),
+        Benchmark(vertical_blur, vertical_blur_numpy),
+        Benchmark(lapoflap, lapoflap_numpy),
+    ]
+}
+
+
+def interval_size(interval: ir.AxisInterval, size: int) -> int:
+    """The number of points of a domain along an axis of the given size"""
+    def index(offset: ir.Offset) -> int:
+        return offset.offset + (size if offset.level == ir.LevelMarker.END else 0)
+
+    return max(0, index(interval.end) - index(interval.start))
+
+
+def count_operations(node: ir.HorizontalDomain) -> int:
+    """
+    The arithmetic operations per point of a horizontal domain. A value shared by several
+    expressions is computed once, also when the expressions are in different statements.
+    """
+    return len({
+        id(expr)
+        for stmt in node.body
+        for expr in subexpressions(stmt.right)
+        if isinstance(expr, ir.BinaryOp)
+    })
+
+
+def stencil_metrics(node: ir.IR, shape: Sequence[int], itemsize: int) -> Tuple[int, int]:
+    """
+    The bytes moved from and to memory and the floating point operations of a call of an
+    optimized stencil on bounds of the given shape (k, j, i).
+    """
+    size_k, size_j, size_i = shape
+    flops = 0
+    for vertical_domain in node.body:
+        levels = interval_size(vertical_domain.extents, size_k)
+        for horizontal_domain in vertical_domain.body:
+            points = (
+                levels
+                * interval_size(horizontal_domain.extents[0], size_i)
+                * interval_size(horizontal_domain.extents[1], size_j)
+            )
+            flops += points * count_operations(horizontal_domain)
+
+    fields = set(field_arguments(node))
+    read = {access.name for access in read_accesses(node)} & fields
+    written = written_fields(node) & fields
+    return (len(read) + len(written)) * size_k * size_j * size_i * itemsize, flops
+
+
+def parse_shape(shape: str) -> Tuple[int, int, int]:
+    """Parses a grid size given as `NKxNJxNI`, e.g. `64x128x128`"""
+    sizes = tuple(int(size) for size in shape.lower().split("x"))
+    if len(sizes) != 3:
+        raise ValueError("Expected a grid size of the form NKxNJxNI, got '{}'".format(shape))
+    return sizes
+
+
+def format_shape(shape: Sequence[int]) -> str:
+    return "x".join(str(size) for size in shape)
+
+
+def current_threads() -> int:
+    """The number of threads the OpenMP parallel regions of this process use"""
+    threads = os.getenv("OMP_NUM_THREADS")
+    if threads:
+        return int(threads.split(",")[0])
+    return os.cpu_count() or 1
+
+
+def cpu_model() -> str:
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return line.split(":", 1)[1].strip()
+    except OSError:
+        pass
+    return platform.processor() or platform.machine()
+
+
+def set_up_fields(benchmark: Benchmark, shape: Sequence[int], dtype: str) -> List[np.ndarray]:
+    """The arrays of a call, the inputs are random and the outputs zero"""
+    node = parse_definition(benchmark.definition)
+    written = written_fields(node)
+    random = np.random.default_rng(0)
+    return [
+        np.zeros(shape, dtype=dtype) if name in written else random.random(shape).astype(dtype)
+        for name in field_arguments(node)
+    ]
+
+
+def create_call(benchmark: Benchmark, backend: str, dtype: str) -> Callable:
+    """The stencil of a benchmark compiled for a backend, or its numpy baseline"""
+    if backend == "baseline":
+        return benchmark.baseline
+    if backend not in ("cpp", "numpy", "python"):
+        raise ValueError(
+            "Unknown backend '{}', available backends are: cpp, numpy, python, baseline".format(
+                backend
+            )
+        )
+    return create_stencil(
+        benchmark.definition,
+        hash_source_code(benchmark.definition),
+        backend=backend,
+        dtype=dtype,
+        compilation="eager",
+        **benchmark.options,
+    )
+
+
+def time_call(call: Callable[[], Any], repeat: int) -> List[float]:
+    """
+    The times of a single call in seconds, averaged over enough calls for each of the
+    `repeat` measurements to take at least 0.2 seconds. Finding that number of calls
+    warms up the caches.
+    """
+    timer = timeit.Timer(call)
+    number, _ = timer.autorange()
+    return [total / number for total in timer.repeat(repeat=repeat, number=number)]
+
+
+def run_benchmark(
+    benchmark: Benchmark, backend: str, shape: Sequence[int], dtype: str, repeat: int
+) -> Dict[str, Any]:
+    """Times a benchmark for one backend and grid size and computes the rates"""
+    function = create_call(benchmark, backend, dtype)
+    fields = set_up_fields(benchmark, shape, dtype)
+    bounds = [[0, size] for size in shape]
+    times = time_call(lambda: function(*fields, *bounds), repeat)
+
+    node = optimize(parse_definition(benchmark.definition), benchmark.options)
+    memory_bytes, flops = stencil_metrics(node, shape, np.dtype(dtype).itemsize)
+    time = statistics.median(times)
+    return {
+        "stencil": benchmark.name,
+        "backend": backend,
+        "shape": list(shape),
+        "threads": current_threads(),
+        "dtype": dtype,
+        "time": time,
+        "time_min": min(times),
+        "time_max": max(times),
+        "bytes": memory_bytes,
+        "flops": flops,
+        "bandwidth": memory_bytes / time / 1e9,
+        "gflops": flops / time / 1e9,
+        "points_per_second": int(np.prod(shape)) / time,
+    }
+
+
+def format_result(result: Dict[str, Any]) -> str:
+    return (
+        "{stencil:16} {backend:8} {shape:>12} {threads:>4} {time:>10.3f}ms"
+        " {bandwidth:>8.2f} GB/s {gflops:>8.2f} GFLOP/s {points:>8.1f} Mpt/s"
+    ).format(
+        stencil=result["stencil"],
+        backend=result["backend"],
+        shape=format_shape(result["shape"]),
+        threads=result["threads"],
+        time=result["time"] * 1e3,
+        bandwidth=result["bandwidth"],
+        gflops=result["gflops"],
+        points=result["points_per_second"] / 1e6,
+    )
+
+
+def run(
+    stencils: Sequence[str],
+    backends: Sequence[str],
+    sizes: Sequence[Sequence[int]],
+    dtype: str = "float64",
+    repeat: int = 5,
+    verbose: bool = True,
+) -> List[Dict[str, Any]]:
+    """Runs the benchmarks in this process, with its number of OpenMP threads"""
+    results = []
+    for name in stencils:
+        if name not in benchmarks:
+            raise ValueError(
+                "Unknown benchmark '{}', available benchmarks are: {}".format(
+                    name, ", ".join(benchmarks)
+                )
+            )
+        for shape in sizes:
+            for backend in backends:
+                result = run_benchmark(benchmarks[name], backend, shape, dtype, repeat)
+                if verbose:
+                    print(format_result(result), flush=True)
+                results.append(result)
+    return results
+
+
+def run_with_threads(
+    threads: int,
+    stencils: Sequence[str],
+    backends: Sequence[str],
+    sizes: Sequence[Sequence[int]],
+    dtype: str = "float64",
+    repeat: int = 5,
+) -> List[Dict[str, Any]]:
+    """
+    Runs the benchmarks in a new process with the given number of OpenMP threads, which
+    can't be changed once the OpenMP runtime of a process has started.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        output = Path(directory) / "results.json"
+        command = [
+            sys.executable, "-m", "toydsl", "bench", "run",
+            "--stencils", ",".join(stencils),
+            "--backends", ",".join(backends),
+            "--sizes", ",".join(format_shape(shape) for shape in sizes),
+            "--dtype", dtype,
+            "--repeat", str(repeat),
+            "--output", str(output),
+        ]
+        environment = dict(os.environ, OMP_NUM_THREADS=str(threads))
+        subprocess.run(command, env=environment, check=True)
+        return load_results(output)["results"]
+
+
+# Run in a new process by `time_startup`, prints how long importing the DSL and defining
+# the stencils took
+startup_script = """
+import time
+start = time.perf_counter()
+import toydsl.driver.driver
+imported = time.perf_counter()
+from toydsl import bench
+for name in {stencils!r}:
+    bench.create_call(bench.benchmarks[name], "cpp", {dtype!r})
+print(imported - start, time.perf_counter() - imported)
+"""
+
+
+def time_startup(
+    stencils: Sequence[str], dtype: str = "float64", repeat: int = 5
+) -> Dict[str, Any]:
+    """
+    How long a new process takes until the C++ stencils of the benchmarks are ready to be
+    called, once they are in the code cache. The first process fills the cache and isn't
+    timed. Returns the medians of the whole process, of importing the DSL, and of
+    defining the stencils, in seconds.
+    """
+    command = [sys.executable, "-c", startup_script.format(stencils=list(stencils), dtype=dtype)]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+    process_times, import_times, define_times = [], [], []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        output = subprocess.run(command, check=True, capture_output=True, text=True).stdout
+        process_times.append(time.perf_counter() - start_time)
+        import_time, define_time = output.split()[-2:]
+        import_times.append(float(import_time))
+        define_times.append(float(define_time))
+    return {
+        "stencils": list(stencils),
+        "process": statistics.median(process_times),
+        "import": statistics.median(import_times),
+        "define": statistics.median(define_times),
+    }
+
+
+def run_suite(
+    stencils: Sequence[str] = tuple(benchmarks),
+    backends: Sequence[str] = default_backends,
+    sizes: Sequence[Sequence[int]] = default_sizes,
+    threads: Optional[Sequence[int]] = None,
+    dtype: str = "float64",
+    repeat: int = 5,
+) -> Dict[str, Any]:
+    """
+    Runs every benchmark for every grid size and backend, and returns the results along
+    with a description of the machine.
+
+    Without `threads` the benchmarks run in this process. Otherwise the C++ backend is
+    run for each of the given numbers of threads, the other backends don't use OpenMP and
+    only run with the first one.
+    """
+    if threads is None:
+        results = run(stencils, backends, sizes, dtype, repeat)
+    else:
+        results = []
+        for n, count in enumerate(threads):
+            thread_backends = [backend for backend in backends if n == 0 or backend == "cpp"]
+            if thread_backends:
+                results += run_with_threads(count, stencils, thread_backends, sizes, dtype, repeat)
+
+    return {
+        "version": format_version,
+        "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        "host": platform.node(),
+        "cpu": cpu_model(),
+        "environment": dict(
+            build_environment(default_build_type(), default_build_mode()),
+            compiler=compiler_version(),
+        ),
+        "results": results,
+    }
+
+
+def save_results(report: Dict[str, Any], filename: Path) -> None:
+    with open(filename, "w") as f:
+        json.dump(report, f, indent=2)
+
+
+def load_results(filename: Path) -> Dict[str, Any]:
+    with open(filename) as f:
+        report = json.load(f)
+    if report.get("version") != format_version:
+        raise ValueError(
+            "{} has version {} of the result format, expected {}".format(
+                filename, report.get("version"), format_version
+            )
+        )
+    return report
+
+
+def result_key(result: Dict[str, Any]) -> Tuple:
+    """The parameters identifying the same benchmark in two runs"""
+    return (
+        result["stencil"],
+        result["backend"],
+        tuple(result["shape"]),
+        result["threads"],
+        result["dtype"],
+    )
+
+
+def compare(
+    baseline: Dict[str, Any], current: Dict[str, Any], threshold: float = default_threshold
+) -> List[Dict[str, Any]]:
+    """
+    Compares the median times of the benchmarks that are in both runs. A benchmark whose
+    time grew by more than `threshold` is a regression, one whose time shrank by as
+    much an improvement.
+    """
+    baseline_results = {result_key(result): result for result in baseline["results"]}
+    comparisons = []
+    for result in current["results"]:
+        key = result_key(result)
+        if key not in baseline_results:
+            continue
+        change = result["time"] / baseline_results[key]["time"] - 1
+        if change > threshold:
+            status = "regression"
+        elif change < -threshold:
+            status = "improvement"
+        else:
+            status = ""
+        comparisons.append({
+            "stencil": result["stencil"],
+            "backend": result["backend"],
+            "shape": result["shape"],
+            "threads": result["threads"],
+            "dtype": result["dtype"],
+            "baseline_time": baseline_results[key]["time"],
+            "time": result["time"],
+            "change": change,
+            "status": status,
+        })
+    return comparisons
+
+
+def environment_differences(baseline: Dict[str, Any], current: Dict[str, Any]) -> List[str]:
+    """Describes how the machines and builds of two runs differ"""
+    differences = []
+    for name in ["host", "cpu"]:
+        if baseline.get(name) != current.get(name):
+            differences.append("{}: {} -> {}".format(name, baseline.get(name), current.get(name)))
+    old, new = baseline.get("environment", {}), current.get("environment", {})
+    for name in sorted(set(old) | set(new)):
+        if old.get(name) != new.get(name):
+            differences.append("{}: {} -> {}".format(name, old.get(name), new.get(name)))
+    return differences
+
+
+def format_comparison(comparison: Dict[str, Any]) -> str:
+    return (
+        "{stencil:16} {backend:8} {shape:>12} {threads:>4} {old:>10.3f}ms {new:>10.3f}ms"
+        " {change:>+7.1%}  {status}"
+    ).format(
+        stencil=comparison["stencil"],
+        backend=comparison["backend"],
+        shape=format_shape(comparison["shape"]),
+        threads=comparison["threads"],
+        old=comparison["baseline_time"] * 1e3,
+        new=comparison["time"] * 1e3,
+        change=comparison["change"],
+        status=comparison["status"],
+    )
@@ -0,0 +1,195 @@
+"""
+Ahead-of-time compilation of the stencils of a module, e.g.
+
+    python -m toydsl.compile model.dynamics model/physics.py -o prebuilt
+
+Imports the modules with lazy compilation, so that their decorators don't build
+anything, and then builds every stencil they define in the process pool. The code cache
+in the output directory only refers to its entries by relative paths, it can be copied to
+the compute nodes or packaged, and is used by pointing `CODE_CACHE_ROOT` to it.
+"""
+
+import argparse
+import importlib
+import importlib.util
+import os
+import shutil
+import sys
+import time
+from pathlib import Path
+from typing import Any, List, Optional, Sequence, Set, Tuple
+
+from toydsl.backend.codegen_cpp import CppStencil
+from toydsl.driver.autotune import Autotuner
+from toydsl.driver.build import (
+    BuildTimer,
+    build_modes,
+    build_precompiled_header,
+    default_build_mode,
+)
+from toydsl.driver.cache import CodeCache, default_build_type, format_size
+from toydsl.driver.compilation import DeferredStencil
+from toydsl.driver.driver import set_up_cache_directory
+from toydsl.driver.specialization import DtypeSpecializations, specialization_dtypes
+from toydsl.ir.extents import CheckedStencil
+
+
+def cache_root() -> Path:
+    """The code cache that the decorators fill"""
+    return Path(set_up_cache_directory())
+
+
+def import_target(target: str):
+    """Imports a module given by its name, e.g. `model.physics`, or by the path of its file"""
+    path = Path(target)
+    if path.suffix != ".py":
+        return importlib.import_module(target)
+    # The modules next to the file can be imported like when it runs as a script
+    sys.path.insert(0, str(path.resolve().parent))
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[path.stem] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def find_stencils(module, dtypes: Sequence[str]) -> Tuple[List[Tuple[str, Any]], List[str]]:
+    """
+    The stencils defined at the top level of a module, as `(name, stencil)`. The stencils
+    specialized on the dtype of their arguments are specialized on each of `dtypes`.
+    Also returns the names of the autotuned stencils, they can only be built once the
+    shapes of their arguments are known.
+    """
+    stencils = []
+    autotuned = []
+    seen = set()
+    for name, value in sorted(vars(module).items()):
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        if isinstance(value, DtypeSpecializations):
+            for dtype in dtypes:
+                stencils.append(("{}[{}]".format(name, dtype), value.specialize(dtype)))
+        elif isinstance(value, Autotuner):
+            autotuned.append(name)
+        elif isinstance(value, (DeferredStencil, CppStencil, CheckedStencil)):
+            stencils.append((name, value))
+    return stencils, autotuned
+
+
+def compile_stencils(stencils: List[Tuple[str, Any]]) -> List[str]:
+    """
+    Builds the stencils that aren't built yet, all of them concurrently, and loads each
+    module once to check it. Returns the names of the stencils that failed to build.
+    """
+    deferred = [
+        (name, stencil) for name, stencil in stencils if isinstance(stencil, DeferredStencil)
+    ]
+    missing = [stencil for _, stencil in deferred if not stencil.ready()]
+    if missing and default_build_mode() == "direct":
+        # Once, rather than in every worker at the same time
+        build_precompiled_header(cache_root(), default_build_type(), BuildTimer())
+    for _, stencil in deferred:
+        stencil.start()
+
+    failed = []
+    for name, stencil in deferred:
+        try:
+            stencil.wait()
+        except Exception as error:
+            print("Failed to build {}: {}".format(name, error), file=sys.stderr)
+            failed.append(name)
+    return failed
+
+
+def lock_files(cache: CodeCache) -> Set[Path]:
+    return set(cache.root.glob("*.lock"))
+
+
+def strip_build_files(cache: CodeCache, existing_locks: Set[Path] = frozenset()) -> None:
+    """
+    Removes what is only needed to build the modules: the CMake build trees and object
+    files next to the compiled modules, the precompiled headers and the lock files that
+    were created since `existing_locks` were listed. The older lock files are kept,
+    another process using the cache may wait for one of them.
+    """
+    for metadata in cache.entries():
+        entry = cache.root / metadata["entry"]
+        if metadata.get("backend") == "pch":
+            cache.remove(metadata["entry"])
+        elif metadata.get("backend") == "cpp" and (entry / "build").is_dir():
+            for path in sorted((entry / "build").iterdir()):
+                if path.name == "dslgen.so":
+                    continue
+                if path.is_dir():
+                    shutil.rmtree(path, ignore_errors=True)
+                else:
+                    path.unlink()
+    cache.update_sizes()
+    # Last, removing the entries takes their locks
+    for lock_filename in lock_files(cache) - existing_locks:
+        lock_filename.unlink()
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        prog="python -m toydsl.compile",
+        description="Compiles the stencils of modules into a code cache ahead of time",
+    )
+    parser.add_argument("targets", nargs="+", help="module names or paths of python files")
+    parser.add_argument("-o", "--output",
+                        help="the code cache to fill, default: $CODE_CACHE_ROOT or .codecache")
+    parser.add_argument("-j", "--workers", type=int,
+                        help="stencils compiled concurrently, default: $TOYDSL_COMPILE_WORKERS "
+                             "or the number of CPUs")
+    parser.add_argument("--build-mode", choices=build_modes,
+                        help="how the modules are built, default: $TOYDSL_BUILD_MODE or cmake")
+    parser.add_argument("--dtypes", default=",".join(specialization_dtypes),
+                        help="the dtypes to build the stencils with dtype='auto' for, "
+                             "default: %(default)s")
+    parser.add_argument("--keep-build-files", action="store_true",
+                        help="keep the build trees and precompiled headers in the cache")
+    args = parser.parse_args(argv)
+
+    dtypes = [dtype for dtype in args.dtypes.split(",") if dtype]
+    for dtype in dtypes:
+        if dtype not in specialization_dtypes:
+            parser.error("unknown dtype '{}'".format(dtype))
+
+    # The decorators read these when the modules are imported, and the workers inherit them
+    if args.output is not None:
+        os.environ["CODE_CACHE_ROOT"] = args.output
+    if args.workers is not None:
+        os.environ["TOYDSL_COMPILE_WORKERS"] = str(args.workers)
+    if args.build_mode is not None:
+        os.environ["TOYDSL_BUILD_MODE"] = args.build_mode
+    os.environ["TOYDSL_COMPILATION"] = "lazy"
+
+    start_time = time.perf_counter()
+    stencils = []
+    for target in args.targets:
+        module = import_target(target)
+        module_stencils, autotuned = find_stencils(module, dtypes)
+        for name in autotuned:
+            print("Skipping {}.{}, autotuned stencils are built on their first call.".format(
+                module.__name__, name
+            ), file=sys.stderr)
+        stencils.extend(
+            ("{}.{}".format(module.__name__, name), stencil) for name, stencil in module_stencils
+        )
+
+    cache = CodeCache(cache_root())
+    existing_locks = lock_files(cache)
+    failed = compile_stencils(stencils)
+
+    if not args.keep_build_files:
+        strip_build_files(cache, existing_locks)
+    print("Compiled {} stencils into {} ({}) in {:.2f} seconds.".format(
+        len(stencils) - len(failed), cache.root, format_size(cache.total_size()),
+        time.perf_counter() - start_time,
+    ))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,7 +1,13 @@
 #include <array>
 #include <Eigen/Core>
 
+#include "isa.hpp"
+
+#ifdef TOYDSL_FLOAT32
+using scalar_t = float;
+#else
 using scalar_t = double;
+#endif
 using array_t = Eigen::Matrix<scalar_t, Eigen::Dynamic, 1>;
 using bounds_t = std::array<std::size_t, 2>;
 
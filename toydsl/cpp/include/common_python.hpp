@@ -1,13 +1,39 @@
 #include <boost/python.hpp>
 #include <boost/python/numpy.hpp>
 #include <array>
+#include <cstddef>
+#include <cstdint>
+#include <stdexcept>
+#include <utility>
+
+#include "isa.hpp"
 
 namespace np = boost::python::numpy;
 
+// The generated code defines TOYDSL_FLOAT32 before including this header if the fields
+// are single precision.
+#ifdef TOYDSL_FLOAT32
+using scalar_t = float;
+#define SCALAR_NAME "float32"
+constexpr char scalar_format = 'f';
+#else
 using scalar_t = double;
+#define SCALAR_NAME "float64"
+constexpr char scalar_format = 'd';
+#endif
+
 using array_t = np::ndarray;
 using bounds_t = boost::python::list;
 
+// A field as seen by the generated kernels: the data pointer together with the
+// strides along the i, j and k axes, counted in elements.
+struct field_t {
+    scalar_t* data;
+    std::ptrdiff_t stride_i;
+    std::ptrdiff_t stride_j;
+    std::ptrdiff_t stride_k;
+};
+
 inline std::array<std::size_t, 6> get_bounds(bounds_t const& i, bounds_t const& j, bounds_t const& k) {
     const std::size_t start_i = boost::python::extract<std::size_t>(i[0]);
     const std::size_t end_i = boost::python::extract<std::size_t>(i[1]);
@@ -18,3 +44,331 @@ inline std::array<std::size_t, 6> get_bounds(bounds_t const& i, bounds_t const&
 
     return {start_i, end_i, start_j, end_j, start_k, end_k};
 }
+
+// The numpy axes of a field are (k, j, i), the strides numpy reports are in bytes.
+inline field_t get_field(array_t const& array) {
+    if (array.get_nd() != 3) {
+        throw std::invalid_argument("fields need to be three dimensional arrays");
+    }
+    if (array.get_dtype() != np::dtype::get_builtin<scalar_t>()) {
+        throw std::invalid_argument("fields need to be arrays of " SCALAR_NAME);
+    }
+
+    const Py_intptr_t* strides = array.get_strides();
+    for (int axis = 0; axis < 3; ++axis) {
+        if (strides[axis] % static_cast<Py_intptr_t>(sizeof(scalar_t)) != 0) {
+            throw std::invalid_argument("field strides need to be multiples of the element size");
+        }
+    }
+
+    return {
+        reinterpret_cast<scalar_t*>(array.get_data()),
+        strides[2] / static_cast<std::ptrdiff_t>(sizeof(scalar_t)),
+        strides[1] / static_cast<std::ptrdiff_t>(sizeof(scalar_t)),
+        strides[0] / static_cast<std::ptrdiff_t>(sizeof(scalar_t)),
+    };
+}
+
+// A single horizontal plane, the vertical index is ignored for it.
+inline field_t plane_field(scalar_t* data, std::ptrdiff_t stride_i, std::ptrdiff_t stride_j) {
+    return {data, stride_i, stride_j, 0};
+}
+
+// Whether all the rows of a field start at an address aligned to `alignment` bytes, given
+// the first element of one row and the strides of the two other axes.
+inline bool aligned_rows(const scalar_t* row_start, std::ptrdiff_t stride_first, std::ptrdiff_t stride_second,
+                         std::size_t alignment) {
+    const auto aligned_stride = [alignment](std::ptrdiff_t stride) {
+        return static_cast<std::size_t>(stride < 0 ? -stride : stride) * sizeof(scalar_t) % alignment == 0;
+    };
+    return reinterpret_cast<std::uintptr_t>(row_start) % alignment == 0 && aligned_stride(stride_first) &&
+           aligned_stride(stride_second);
+}
+
+// ---- Low overhead calling convention ----
+//
+// Besides the Boost.Python entry point, every module exposes `<name>_fast`, a plain
+// CPython function with the same signature that reads the arrays through the buffer
+// protocol, and `<name>_bind`, which does all the argument checks once and returns a
+// function without arguments running the kernel on the bound arrays.
+
+// Runs a kernel on the fields and the scalars of the signature and the bounds, in the
+// order of `get_bounds`.
+using kernel_t = void (*)(const field_t* fields, const scalar_t* scalars, const std::size_t* bounds);
+
+// Runs several steps of a kernel, the fields at positions `swap_first` and `swap_second`
+// are swapped after every step.
+using steps_kernel_t = void (*)(const field_t* fields, const scalar_t* scalars, const std::size_t* bounds,
+                                std::size_t steps, std::size_t swap_first, std::size_t swap_second);
+
+// Checks that the arrays are large enough for the accesses of the kernel, the shapes of
+// the fields are given along (i, j, k). Returns an error message or nullptr.
+using check_t = const char* (*)(const std::size_t* shapes, const std::size_t* bounds);
+
+// A kernel with N fields and M scalar parameters.
+template <std::size_t N, std::size_t M>
+struct kernel_info_t {
+    kernel_t kernel;
+    steps_kernel_t steps_kernel;
+    check_t check;
+    // Which of the fields are written by the kernel, they need writable buffers.
+    std::array<bool, N> written;
+    // Where the fields and the scalars are among the arguments before the bounds.
+    std::array<std::size_t, N> field_positions;
+    std::array<std::size_t, M> scalar_positions;
+};
+
+inline bool is_scalar_format(const char* format) {
+    if (format == nullptr) {
+        return false;
+    }
+    if (format[0] == '@' || format[0] == '=' || format[0] == '<') {
+        ++format;
+    }
+    return format[0] == scalar_format && format[1] == '\0';
+}
+
+// Acquires the buffer of a field. Returns false with a python exception set on failure.
+inline bool get_buffer_field(PyObject* object, bool writable, Py_buffer& view, field_t& field) {
+    const int flags = PyBUF_STRIDES | PyBUF_FORMAT | (writable ? PyBUF_WRITABLE : 0);
+    if (PyObject_GetBuffer(object, &view, flags) != 0) {
+        return false;
+    }
+
+    const char* error = nullptr;
+    if (view.ndim != 3) {
+        error = "fields need to be three dimensional arrays";
+    } else if (view.itemsize != sizeof(scalar_t) || !is_scalar_format(view.format)) {
+        error = "fields need to be arrays of " SCALAR_NAME;
+    } else {
+        for (int axis = 0; axis < 3; ++axis) {
+            if (view.strides[axis] % static_cast<Py_ssize_t>(sizeof(scalar_t)) != 0) {
+                error = "field strides need to be multiples of the element size";
+            }
+        }
+    }
+    if (error != nullptr) {
+        PyBuffer_Release(&view);
+        PyErr_SetString(PyExc_ValueError, error);
+        return false;
+    }
+
+    field = {
+        static_cast<scalar_t*>(view.buf),
+        view.strides[2] / static_cast<std::ptrdiff_t>(sizeof(scalar_t)),
+        view.strides[1] / static_cast<std::ptrdiff_t>(sizeof(scalar_t)),
+        view.strides[0] / static_cast<std::ptrdiff_t>(sizeof(scalar_t)),
+    };
+    return true;
+}
+
+// Reads a `[start, end]` pair. Returns false with a python exception set on failure.
+inline bool get_bound(PyObject* object, std::size_t& start, std::size_t& end) {
+    PyObject* sequence = PySequence_Fast(object, "bounds need to be [start, end] sequences");
+    if (sequence == nullptr) {
+        return false;
+    }
+    bool success = false;
+    if (PySequence_Fast_GET_SIZE(sequence) != 2) {
+        PyErr_SetString(PyExc_ValueError, "bounds need to be [start, end] sequences");
+    } else {
+        std::size_t values[2];
+        success = true;
+        for (int n = 0; n < 2 && success; ++n) {
+            PyObject* index = PyNumber_Index(PySequence_Fast_GET_ITEM(sequence, n));
+            if (index == nullptr) {
+                success = false;
+                break;
+            }
+            values[n] = PyLong_AsSize_t(index);
+            Py_DECREF(index);
+            success = !PyErr_Occurred();
+        }
+        if (success && values[0] > values[1]) {
+            PyErr_SetString(PyExc_ValueError, "bounds need to satisfy start <= end");
+            success = false;
+        }
+        start = values[0];
+        end = values[1];
+    }
+    Py_DECREF(sequence);
+    return success;
+}
+
+template <std::size_t N>
+void release_views(std::array<Py_buffer, N>& views, std::size_t count) {
+    for (std::size_t n = 0; n < count; ++n) {
+        PyBuffer_Release(&views[n]);
+    }
+}
+
+// The shapes of the fields along (i, j, k), as the checks of the kernels expect them.
+template <std::size_t N>
+std::array<std::size_t, 3 * N> buffer_shapes(const std::array<Py_buffer, N>& views) {
+    std::array<std::size_t, 3 * N> shapes;
+    for (std::size_t n = 0; n < N; ++n) {
+        for (std::size_t axis = 0; axis < 3; ++axis) {
+            shapes[3 * n + axis] = static_cast<std::size_t>(views[n].shape[2 - axis]);
+        }
+    }
+    return shapes;
+}
+
+// The arguments of a call: the fields and scalars in the order of the signature, followed
+// by the bounds along k, j and i, and `extra` arguments that are left to the caller. On
+// success the caller has to release the views.
+template <std::size_t N, std::size_t M>
+bool parse_arguments(const kernel_info_t<N, M>& info, PyObject* const* args, Py_ssize_t nargs,
+                     std::array<Py_buffer, N>& views, std::array<field_t, N>& fields,
+                     std::array<scalar_t, M>& scalars, std::array<std::size_t, 6>& bounds,
+                     std::size_t extra = 0) {
+    if (nargs != static_cast<Py_ssize_t>(N + M + 3 + extra)) {
+        PyErr_Format(PyExc_TypeError,
+                     "expected %zu fields, %zu scalars, the bounds k, j, i and %zu more arguments, got %zd", N, M,
+                     extra, nargs);
+        return false;
+    }
+    if (!get_bound(args[N + M], bounds[4], bounds[5]) || !get_bound(args[N + M + 1], bounds[2], bounds[3]) ||
+        !get_bound(args[N + M + 2], bounds[0], bounds[1])) {
+        return false;
+    }
+    for (std::size_t m = 0; m < M; ++m) {
+        const double value = PyFloat_AsDouble(args[info.scalar_positions[m]]);
+        if (value == -1.0 && PyErr_Occurred()) {
+            return false;
+        }
+        scalars[m] = static_cast<scalar_t>(value);
+    }
+    for (std::size_t n = 0; n < N; ++n) {
+        if (!get_buffer_field(args[info.field_positions[n]], info.written[n], views[n], fields[n])) {
+            release_views(views, n);
+            return false;
+        }
+    }
+
+    const char* error = info.check(buffer_shapes(views).data(), bounds.data());
+    if (error != nullptr) {
+        release_views(views, N);
+        PyErr_SetString(PyExc_ValueError, error);
+        return false;
+    }
+    return true;
+}
+
+template <std::size_t N, std::size_t M, const kernel_info_t<N, M>& info>
+PyObject* fast_call(PyObject*, PyObject* const* args, Py_ssize_t nargs) {
+    std::array<Py_buffer, N> views;
+    std::array<field_t, N> fields;
+    std::array<scalar_t, M> scalars;
+    std::array<std::size_t, 6> bounds;
+    if (!parse_arguments(info, args, nargs, views, fields, scalars, bounds)) {
+        return nullptr;
+    }
+    info.kernel(fields.data(), scalars.data(), bounds.data());
+    for (auto& view : views) {
+        PyBuffer_Release(&view);
+    }
+    Py_RETURN_NONE;
+}
+
+// The fields, scalars and bounds, followed by the number of steps and the positions of
+// the two fields to swap after every step, counted among the fields only.
+template <std::size_t N, std::size_t M, const kernel_info_t<N, M>& info>
+PyObject* steps_call(PyObject*, PyObject* const* args, Py_ssize_t nargs) {
+    std::array<Py_buffer, N> views;
+    std::array<field_t, N> fields;
+    std::array<scalar_t, M> scalars;
+    std::array<std::size_t, 6> bounds;
+    if (!parse_arguments(info, args, nargs, views, fields, scalars, bounds, 3)) {
+        return nullptr;
+    }
+
+    std::size_t steps_arguments[3];
+    for (std::size_t n = 0; n < 3; ++n) {
+        steps_arguments[n] = PyLong_AsSize_t(args[N + M + 3 + n]);
+    }
+    const std::size_t steps = steps_arguments[0];
+    const std::size_t swap_first = steps_arguments[1];
+    const std::size_t swap_second = steps_arguments[2];
+    if (!PyErr_Occurred() && (swap_first >= N || swap_second >= N)) {
+        PyErr_SetString(PyExc_ValueError, "the fields to swap are out of range");
+    }
+    if (!PyErr_Occurred() && steps > 1) {
+        // Every other step, the swapped fields are used in each other's place
+        std::array<Py_buffer, N> swapped = views;
+        std::swap(swapped[swap_first], swapped[swap_second]);
+        const char* error = info.check(buffer_shapes(swapped).data(), bounds.data());
+        if (error != nullptr) {
+            PyErr_SetString(PyExc_ValueError, error);
+        }
+    }
+    if (!PyErr_Occurred()) {
+        // The steps can take a while, other python threads may run in the meantime
+        Py_BEGIN_ALLOW_THREADS
+        info.steps_kernel(fields.data(), scalars.data(), bounds.data(), steps, swap_first, swap_second);
+        Py_END_ALLOW_THREADS
+    }
+
+    for (auto& view : views) {
+        PyBuffer_Release(&view);
+    }
+    if (PyErr_Occurred()) {
+        return nullptr;
+    }
+    Py_RETURN_NONE;
+}
+
+// A call whose arguments have been checked already. The views keep the arrays alive.
+template <std::size_t N, std::size_t M>
+struct bound_call_t {
+    kernel_t kernel;
+    std::array<Py_buffer, N> views;
+    std::array<field_t, N> fields;
+    std::array<scalar_t, M> scalars;
+    std::array<std::size_t, 6> bounds;
+
+    static PyObject* invoke(PyObject* self, PyObject*) {
+        auto* call = static_cast<bound_call_t*>(PyCapsule_GetPointer(self, nullptr));
+        call->kernel(call->fields.data(), call->scalars.data(), call->bounds.data());
+        Py_RETURN_NONE;
+    }
+
+    static void destroy(PyObject* capsule) {
+        auto* call = static_cast<bound_call_t*>(PyCapsule_GetPointer(capsule, nullptr));
+        for (auto& view : call->views) {
+            PyBuffer_Release(&view);
+        }
+        delete call;
+    }
+
+    static inline PyMethodDef invoke_def = {"bound_call", reinterpret_cast<PyCFunction>(invoke),
+                                            METH_NOARGS, "Runs the kernel on the bound arrays."};
+};
+
+template <std::size_t N, std::size_t M, const kernel_info_t<N, M>& info>
+PyObject* bind_call(PyObject*, PyObject* const* args, Py_ssize_t nargs) {
+    using call_t = bound_call_t<N, M>;
+    auto* call = new call_t();
+    call->kernel = info.kernel;
+    if (!parse_arguments(info, args, nargs, call->views, call->fields, call->scalars, call->bounds)) {
+        delete call;
+        return nullptr;
+    }
+    PyObject* capsule = PyCapsule_New(call, nullptr, call_t::destroy);
+    if (capsule == nullptr) {
+        for (auto& view : call->views) {
+            PyBuffer_Release(&view);
+        }
+        delete call;
+        return nullptr;
+    }
+    PyObject* function = PyCFunction_New(&call_t::invoke_def, capsule);
+    Py_DECREF(capsule);
+    return function;
+}
+
+// Adds a CPython function to the module that is being initialized.
+inline void add_function(PyMethodDef& definition) {
+    boost::python::scope().attr(definition.ml_name) =
+        boost::python::object(boost::python::handle<>(PyCFunction_New(&definition, nullptr)));
+}
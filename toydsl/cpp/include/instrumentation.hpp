@@ -0,0 +1,83 @@
+#pragma once
+
+#include <boost/python.hpp>
+#include <algorithm>
+#include <array>
+#include <cstddef>
+#include <cstdint>
+#include <thread>
+#include <vector>
+
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
+#include "tsc_x86.h"
+
+// ---- Instrumentation ----
+//
+// Only the modules generated with `instrument=True` include this header. Their kernels
+// read the time stamp counter around every stage, a horizontal domain, and add the
+// cycles to the counters of the thread. The entry points count the calls and the bytes
+// the stages move from and to memory.
+
+inline std::size_t stats_threads() {
+#ifdef _OPENMP
+    return static_cast<std::size_t>(omp_get_max_threads());
+#else
+    return 1;
+#endif
+}
+
+inline std::size_t stats_thread() {
+#ifdef _OPENMP
+    return static_cast<std::size_t>(omp_get_thread_num());
+#else
+    return 0;
+#endif
+}
+
+template <std::size_t S>
+struct stage_stats_t {
+    // Every thread writes its own cache line(s), the threads don't share counters
+    struct alignas(64) thread_cycles_t {
+        std::array<std::uint64_t, S> cycles{};
+    };
+
+    std::vector<thread_cycles_t> threads;
+    std::array<std::uint64_t, S> calls{};
+    std::array<std::uint64_t, S> bytes{};
+
+    // The counters are allocated once when the module is loaded, so that calls running
+    // concurrently never see them move. Threads beyond `$OMP_NUM_THREADS` and the number
+    // of CPUs at that time aren't counted.
+    stage_stats_t() : threads(std::max<std::size_t>(stats_threads(), std::thread::hardware_concurrency())) {}
+
+    void record(std::size_t stage, std::uint64_t cycles) {
+        const std::size_t thread = stats_thread();
+        if (thread < threads.size()) {
+            threads[thread].cycles[stage] += cycles;
+        }
+    }
+
+    void reset() {
+        for (auto& thread : threads) {
+            thread.cycles.fill(0);
+        }
+        calls.fill(0);
+        bytes.fill(0);
+    }
+
+    // One tuple `(calls, bytes, [cycles of every thread])` per stage
+    boost::python::list to_python() const {
+        boost::python::list stages;
+        for (std::size_t stage = 0; stage < S; ++stage) {
+            boost::python::list cycles;
+            for (const auto& thread : threads) {
+                cycles.append(thread.cycles[stage]);
+            }
+            stages.append(boost::python::make_tuple(calls[stage], bytes[stage], cycles));
+        }
+        return stages;
+    }
+};
@@ -0,0 +1,106 @@
+#pragma once
+
+#include <immintrin.h>
+#include <algorithm>
+#include <cstddef>
+#include <cstdint>
+#include <cstdlib>
+#include <cstring>
+
+// ---- Instruction set dispatch ----
+//
+// The modules are compiled for the baseline x86-64 instruction set. The kernels using
+// vector instructions carry target attributes instead, and the widest variant the CPU
+// supports is picked once when the module is loaded.
+
+enum class isa_t { scalar, avx2, avx512 };
+
+inline const char* isa_name(isa_t isa) {
+    switch (isa) {
+    case isa_t::avx512:
+        return "avx512";
+    case isa_t::avx2:
+        return "avx2";
+    default:
+        return "scalar";
+    }
+}
+
+// The widest instruction set supported by the CPU. `$TOYDSL_ISA` can select a narrower
+// one, e.g. to compare the variants on one machine.
+inline isa_t detect_isa() {
+    __builtin_cpu_init();
+    isa_t isa = isa_t::scalar;
+    if (__builtin_cpu_supports("avx512f")) {
+        isa = isa_t::avx512;
+    } else if (__builtin_cpu_supports("avx2") && __builtin_cpu_supports("fma")) {
+        isa = isa_t::avx2;
+    }
+
+    const char* requested = std::getenv("TOYDSL_ISA");
+    if (requested != nullptr) {
+        for (isa_t narrower : {isa_t::scalar, isa_t::avx2}) {
+            if (std::strcmp(requested, isa_name(narrower)) == 0 && narrower < isa) {
+                isa = narrower;
+            }
+        }
+    }
+    return isa;
+}
+
+inline const isa_t cpu_isa = detect_isa();
+
+// The masks of the vector loads and stores covering the last `n` points of a loop,
+// only the first min(n, width) lanes are active.
+__attribute__((target("avx2,fma"))) inline __m256i remainder_mask_avx2_pd(std::size_t n) {
+    return _mm256_cmpgt_epi64(_mm256_set1_epi64x(static_cast<long long>(std::min<std::size_t>(n, 4))),
+                              _mm256_set_epi64x(3, 2, 1, 0));
+}
+
+__attribute__((target("avx2,fma"))) inline __m256i remainder_mask_avx2_ps(std::size_t n) {
+    return _mm256_cmpgt_epi32(_mm256_set1_epi32(static_cast<int>(std::min<std::size_t>(n, 8))),
+                              _mm256_setr_epi32(0, 1, 2, 3, 4, 5, 6, 7));
+}
+
+__attribute__((target("avx512f"))) inline __mmask8 remainder_mask_avx512_pd(std::size_t n) {
+    return static_cast<__mmask8>((1u << std::min<std::size_t>(n, 8)) - 1);
+}
+
+__attribute__((target("avx512f"))) inline __mmask16 remainder_mask_avx512_ps(std::size_t n) {
+    return static_cast<__mmask16>((1u << std::min<std::size_t>(n, 16)) - 1);
+}
+
+// Non-temporal stores bypass the caches, they need addresses aligned to the vector size.
+// Unaligned addresses fall back to regular stores. The loops advance by whole vectors, so
+// the branch goes the same way for every store of a row.
+__attribute__((target("avx2,fma"))) inline void stream_store_avx2_pd(double* address, __m256d value) {
+    if (reinterpret_cast<std::uintptr_t>(address) % 32 == 0) {
+        _mm256_stream_pd(address, value);
+    } else {
+        _mm256_storeu_pd(address, value);
+    }
+}
+
+__attribute__((target("avx2,fma"))) inline void stream_store_avx2_ps(float* address, __m256 value) {
+    if (reinterpret_cast<std::uintptr_t>(address) % 32 == 0) {
+        _mm256_stream_ps(address, value);
+    } else {
+        _mm256_storeu_ps(address, value);
+    }
+}
+
+__attribute__((target("avx512f"))) inline void stream_store_avx512_pd(double* address, __m512d value) {
+    if (reinterpret_cast<std::uintptr_t>(address) % 64 == 0) {
+        _mm512_stream_pd(address, value);
+    } else {
+        _mm512_storeu_pd(address, value);
+    }
+}
+
+__attribute__((target("avx512f"))) inline void stream_store_avx512_ps(float* address, __m512 value) {
+    if (reinterpret_cast<std::uintptr_t>(address) % 64 == 0) {
+        _mm512_stream_ps(address, value);
+    } else {
+        _mm512_storeu_ps(address, value);
+    }
+}
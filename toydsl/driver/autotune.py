@@ -0,0 +1,195 @@
+import json
+import os
+import statistics
+import sys
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from toydsl.driver.cache import atomic_replacement
+
+
+# The parameters of the C++ code generation that are tuned, the first value of each
+# parameter is the one the search starts from.
+#
+# The loop order is not part of the search: the vertical loop has to stay outermost
+# so that the horizontal domains are executed one after the other for every level.
+default_search_space: Dict[str, List[Any]] = {
+    "unroll_factor": [4, 8, 2],
+    "vectorize": [True, False],
+    "openmp": [True, False],
+    "schedule": [None, "dynamic", "guided"],
+    "tile_sizes": [None, (64, 16, 0), (256, 8, 0)],
+    "streaming_stores": [None, ()],
+}
+
+# Parameters that only have an effect for some value of another parameter, they are only
+# tuned, and otherwise kept at their first value, when that parameter has the value.
+dependent_parameters: Dict[str, Tuple[str, Any]] = {
+    "schedule": ("openmp", True),
+}
+
+
+def signature_key(args) -> str:
+    """
+    Describes the shapes of the arrays and the bounds a stencil is called with. A tuned
+    configuration is only reused for calls with the same key.
+    """
+    parts = []
+    for arg in args:
+        if isinstance(arg, np.ndarray):
+            parts.append("x".join(str(size) for size in arg.shape))
+        elif np.isscalar(arg):
+            # Scalar parameters don't change the best configuration
+            parts.append("scalar")
+        else:
+            parts.append(":".join(str(bound) for bound in arg))
+    return "|".join(parts)
+
+
+def copy_arguments(args) -> List[Any]:
+    """Copies the arrays of a call so that tuning doesn't modify the caller's data"""
+    return [np.copy(arg, order="K") if isinstance(arg, np.ndarray) else arg for arg in args]
+
+
+def from_json(options: Dict[str, Any]) -> Dict[str, Any]:
+    """JSON has no tuples, we need them back so that the options hash the same way"""
+    return {
+        name: tuple(value) if isinstance(value, list) else value for name, value in options.items()
+    }
+
+
+class Autotuner:
+    """
+    A stencil whose code generation options are chosen empirically.
+
+    On the first call with a given signature (see `signature_key`), variants of the
+    stencil are built and timed on copies of the caller's arrays. The search varies one
+    parameter at a time, keeping the best value before moving on to the next parameter.
+    The winning options are recorded in a JSON file in the code cache, so later runs
+    load the tuned kernel without searching again.
+    """
+
+    def __init__(
+        self,
+        build: Callable[[Dict[str, Any]], Callable],
+        record_filename: Path,
+        base_options: Optional[Dict[str, Any]] = None,
+        search_space: Optional[Dict[str, List[Any]]] = None,
+        repetitions: int = 5,
+    ):
+        """
+        Args:
+        build: Builds (or loads from the cache) the stencil for the given options.
+        record_filename: JSON file storing the tuned options for every signature.
+        base_options: Options that are used for all the variants unless tuned.
+        search_space: The parameters to tune and their candidate values.
+        repetitions: How many times each variant is timed.
+        """
+        self.build = build
+        self.record_filename = record_filename
+        self.base_options = dict(base_options) if base_options is not None else {}
+        self.search_space = search_space if search_space is not None else default_search_space
+        self.repetitions = repetitions
+        self._kernels: Dict[str, Callable] = {}
+
+    def __call__(self, *args):
+        return self.kernel(args)(*args)
+
+    def bind(self, *args) -> Callable:
+        """Binds the arguments to the kernel tuned for them, see `CppStencil.bind`"""
+        return self.kernel(args).bind(*args)
+
+    def run(self, *args, steps: int, swap=None):
+        """Runs several steps of the kernel tuned for the arguments, see `CppStencil.run`"""
+        return self.kernel(args).run(*args, steps=steps, swap=swap)
+
+    def kernel(self, args) -> Callable:
+        """The tuned kernel for the signature of the arguments"""
+        key = signature_key(args)
+        kernel = self._kernels.get(key)
+        if kernel is None:
+            kernel = self.build(self.tuned_options(key, args))
+            self._kernels[key] = kernel
+        return kernel
+
+    def load_records(self) -> Dict[str, Dict[str, Any]]:
+        if not os.path.isfile(self.record_filename):
+            return {}
+        with open(self.record_filename) as f:
+            return json.load(f)
+
+    def store_record(self, key: str, options: Dict[str, Any]) -> None:
+        records = self.load_records()
+        records[key] = options
+        os.makedirs(self.record_filename.parent, exist_ok=True)
+        # Concurrent processes never read a partial record, like the index of the cache
+        with atomic_replacement(self.record_filename) as temporary_filename:
+            with open(temporary_filename, "w") as f:
+                json.dump(records, f, indent=4, sort_keys=True)
+
+    def tuned_options(self, key: str, args) -> Dict[str, Any]:
+        """Returns the recorded options for a signature, tuning them if necessary"""
+        records = self.load_records()
+        if key in records:
+            return from_json(records[key])
+
+        options = self.search(args)
+        self.store_record(key, options)
+        return options
+
+    def measure(self, options: Dict[str, Any], args) -> float:
+        """Builds a variant of the stencil and returns its median runtime in seconds"""
+        kernel = self.build(options)
+        arguments = copy_arguments(args)
+
+        kernel(*arguments)  # warm up
+        times = []
+        for _ in range(self.repetitions):
+            start_time = time.perf_counter()
+            kernel(*arguments)
+            times.append(time.perf_counter() - start_time)
+        return statistics.median(times)
+
+    def applicable(self, name: str, options: Dict[str, Any]) -> bool:
+        """Whether a parameter has an effect with the other options, see `dependent_parameters`"""
+        if name not in dependent_parameters:
+            return True
+        parameter, value = dependent_parameters[name]
+        return options.get(parameter) == value
+
+    def without_inapplicable(self, options: Dict[str, Any]) -> Dict[str, Any]:
+        """Resets the parameters that have no effect, so that equal variants aren't timed twice"""
+        return {
+            name: value if name not in self.search_space or self.applicable(name, options)
+            else self.search_space[name][0]
+            for name, value in options.items()
+        }
+
+    def search(self, args) -> Dict[str, Any]:
+        best_options = dict(self.base_options)
+        for name, values in self.search_space.items():
+            best_options.setdefault(name, values[0])
+        best_options = self.without_inapplicable(best_options)
+        best_time = self.measure(best_options, args)
+
+        for name, values in self.search_space.items():
+            if not self.applicable(name, best_options):
+                continue
+            for value in values:
+                if value == best_options[name]:
+                    continue
+                candidate = dict(best_options)
+                candidate[name] = value
+                candidate = self.without_inapplicable(candidate)
+                candidate_time = self.measure(candidate, args)
+                if candidate_time < best_time:
+                    best_options, best_time = candidate, candidate_time
+
+        print(
+            "Autotuned to {} ({:.3g} seconds per call).".format(best_options, best_time),
+            file=sys.stderr,
+        )
+        return best_options
@@ -0,0 +1,319 @@
+import contextlib
+import ctypes.util
+import functools
+import hashlib
+import os
+import platform
+import shlex
+import subprocess
+import sys
+import sysconfig
+import time
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional
+
+from toydsl.driver.cache import (
+    CodeCache,
+    atomic_replacement,
+    codegen_version,
+    compiler,
+    compiler_version,
+)
+
+
+# How the generated C++ code is built into a module:
+#   cmake:  formats the code, configures the CMake project of `toydsl/cpp` and runs make
+#   direct: runs the compiler and the linker right away with the flags of `compile_flags`
+#           and `link_flags`, and a precompiled header of Boost.Python. It never
+#           configures CMake, fetches dependencies or formats the code.
+build_modes = ("cmake", "direct")
+
+# The phases of a build, in the order they run
+build_phases = ("parse", "codegen", "format", "configure", "precompile", "compile", "link")
+
+# The flags of the build types, the same as the CMake project adds
+build_type_flags = {
+    "Release": ["-O3", "-fopenmp", "-DNDEBUG", "-s"],
+    "Debug": ["-g", "-ggdb", "-fno-omit-frame-pointer"],
+    "RelWithDebInfo": ["-O2", "-g", "-DNDEBUG"],
+    "MinSizeRel": ["-Os", "-DNDEBUG"],
+}
+
+warning_flags = ["-Wall", "-Wextra", "-Wpedantic", "-Wno-deprecated"]
+
+# Everything the generated modules include that doesn't change with the stencil. The
+# element type is picked by `common_python.hpp`, which is left out so that the float32
+# and float64 modules share the header.
+precompiled_header = """#include <boost/python.hpp>
+#include <boost/python/numpy.hpp>
+#include <algorithm>
+#include <array>
+#include <cmath>
+#include <cstddef>
+#include <cstdint>
+#include <immintrin.h>
+#include <stdexcept>
+#include <utility>
+#include <vector>
+"""
+
+precompiled_header_name = "toydsl_pch.hpp"
+
+# Written next to the header instead of the precompiled header if precompiling fails
+precompile_failure_name = "failed.txt"
+
+
+def default_build_mode() -> str:
+    """Reads the build mode that is set globally in the environment"""
+    build_mode = os.getenv("TOYDSL_BUILD_MODE", "cmake")
+    if build_mode not in build_modes:
+        raise ValueError(
+            "Invalid TOYDSL_BUILD_MODE '{}', expected one of: {}".format(
+                build_mode, ", ".join(build_modes)
+            )
+        )
+    return build_mode
+
+
+class BuildTimer:
+    """
+    Measures how long the phases of a build take. A phase that runs several times, or
+    not at all, is summed up, or missing from the report.
+    """
+
+    def __init__(self):
+        self.phases: Dict[str, float] = {}
+
+    @contextlib.contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start_time
+
+    def total(self) -> float:
+        return sum(self.phases.values())
+
+    def report(self, name: str, build_mode: str) -> str:
+        """A one line summary, e.g. `Built lapoflap in 2.41 s (direct): parse 0.01 s, ...`"""
+        phases = ", ".join(
+            "{} {:.2f} s".format(phase, self.phases[phase])
+            for phase in sorted(self.phases, key=phase_order)
+        )
+        return "Built {} in {:.2f} s ({}): {}".format(name, self.total(), build_mode, phases)
+
+
+def phase_order(phase: str) -> int:
+    return build_phases.index(phase) if phase in build_phases else len(build_phases)
+
+
+def run_tool(command: List[str], description: str, cwd: Optional[Path] = None) -> None:
+    """Runs a compiler or linker command and raises with its output if it fails"""
+    result = subprocess.run(
+        [str(arg) for arg in command], cwd=cwd, capture_output=True, text=True
+    )
+    if result.returncode != 0:
+        raise Exception(
+            "{} failed. return code: {}. command: {}\n{}{}".format(
+                description, result.returncode, " ".join(shlex.quote(str(arg)) for arg in command),
+                result.stdout, result.stderr,
+            )
+        )
+
+
+@functools.lru_cache(maxsize=None)
+def boost_library(component: str) -> str:
+    """
+    The name of the Boost library of a component for the running Python, e.g.
+    `boost_python311`, like FindBoost picks it.
+    """
+    version = sys.version_info
+    candidates = [
+        "boost_{}{}{}".format(component, version.major, version.minor),
+        "boost_{}{}".format(component, version.major),
+        "boost_{}".format(component),
+    ]
+    for candidate in candidates:
+        if ctypes.util.find_library(candidate) is not None:
+            return candidate
+    return candidates[0]
+
+
+def extra_flags(variable: str) -> List[str]:
+    """The flags set in an environment variable, e.g. `$TOYDSL_CXXFLAGS`"""
+    return shlex.split(os.getenv(variable, ""))
+
+
+def build_type_compile_flags(build_type: str) -> List[str]:
+    """The language, warning and build type flags of the compiler, without search paths"""
+    if build_type not in build_type_flags:
+        raise ValueError(
+            "Unknown build type '{}', available build types are: {}".format(
+                build_type, ", ".join(build_type_flags)
+            )
+        )
+    return ["-std=c++17", "-fPIC"] + warning_flags + build_type_flags[build_type]
+
+
+def build_type_link_flags(build_type: str) -> List[str]:
+    """The flags of the linker for a build type, without search paths and libraries"""
+    flags = ["-shared"]
+    flags += [flag for flag in build_type_flags[build_type] if flag in ("-fopenmp", "-s")]
+    if sys.platform == "darwin":
+        # The symbols of the interpreter are resolved when the module is loaded
+        flags += ["-undefined", "dynamic_lookup"]
+    return flags
+
+
+def compile_flags(build_type: str) -> List[str]:
+    """
+    The flags the generated code is compiled with. `$BOOST_ROOT` is searched for Boost
+    like CMake does, `$TOYDSL_CXXFLAGS` is appended.
+    """
+    include_dirs = [
+        Path(__file__).parent.parent / "cpp" / "include",
+        sysconfig.get_paths()["include"],
+    ]
+    if os.getenv("BOOST_ROOT"):
+        include_dirs.append(Path(os.environ["BOOST_ROOT"]) / "include")
+    return (
+        build_type_compile_flags(build_type)
+        + ["-I{}".format(directory) for directory in include_dirs]
+        + extra_flags("TOYDSL_CXXFLAGS")
+    )
+
+
+def link_flags(build_type: str) -> List[str]:
+    """The flags the module is linked with, `$TOYDSL_LDFLAGS` is appended"""
+    flags = build_type_link_flags(build_type)
+    if os.getenv("BOOST_ROOT"):
+        flags.append("-L{}".format(Path(os.environ["BOOST_ROOT"]) / "lib"))
+    flags += ["-l{}".format(boost_library(component)) for component in ("python", "numpy")]
+    return flags + extra_flags("TOYDSL_LDFLAGS")
+
+
+def build_environment(build_type: str, build_mode: str) -> Dict[str, str]:
+    """
+    Everything besides the stencil and its options that the compiled module depends on,
+    as far as it is known without running the compiler. A cache compiled ahead of time
+    is loaded on nodes without the compiler, or with another one in `$CXX`, so the
+    compiler is only recorded with the module when it is built, see `compiler_version`.
+
+    The flags of the direct build leave out the include and library paths, these depend
+    on where the package and Python are installed rather than on what is built, and the
+    Boost libraries, which are only looked up to link. The CMake project sets the flags
+    of the other builds, it is part of the code generator.
+    """
+    environment = {
+        "build_type": build_type,
+        "build_mode": build_mode,
+        # The extension modules only depend on the ABI, which changes with the minor version
+        "python": "{}.{}".format(*sys.version_info[:2]),
+        "codegen": codegen_version(),
+        # The modules pick the instruction set of their kernels when they are loaded,
+        # they only depend on the architecture and not on the CPU model.
+        "machine": platform.machine(),
+    }
+    if build_mode == "direct":
+        environment["compile_flags"] = shlex.join(
+            build_type_compile_flags(build_type) + extra_flags("TOYDSL_CXXFLAGS")
+        )
+        environment["link_flags"] = shlex.join(
+            build_type_link_flags(build_type) + extra_flags("TOYDSL_LDFLAGS")
+        )
+        if os.getenv("BOOST_ROOT"):
+            environment["boost_root"] = os.environ["BOOST_ROOT"]
+    return environment
+
+
+def precompiled_header_key(build_type: str) -> str:
+    """The precompiled header is only valid for the compiler and the flags it was built with"""
+    hash_algorithm = hashlib.sha256()
+    hash_algorithm.update(compiler_version().encode())
+    hash_algorithm.update(repr(compile_flags(build_type)).encode())
+    hash_algorithm.update(precompiled_header.encode())
+    return hash_algorithm.hexdigest()[:10]
+
+
+def build_precompiled_header(cache_dir: Path, build_type: str, timer: BuildTimer) -> Optional[Path]:
+    """
+    Precompiles the Boost.Python headers into the code cache unless they are there
+    already, and returns the header to include. Returns `None` if the compiler can't
+    precompile them, the modules are then compiled without. The failure is recorded in
+    the cache, so the compiler and flags that failed once aren't tried again.
+    """
+    cache = CodeCache(cache_dir)
+    pch_dir = cache_dir / "pch_{}".format(precompiled_header_key(build_type))
+    header = pch_dir / precompiled_header_name
+    # GCC looks for `<header>.gch` next to an included header, clang also for `<header>.pch`
+    pch_filename = pch_dir / (precompiled_header_name + ".gch")
+    failure_filename = pch_dir / precompile_failure_name
+
+    if pch_filename.is_file():
+        cache.touch(pch_dir.name)
+        return header
+    if failure_filename.is_file():
+        return None
+
+    # The modules compiled in parallel all need the header, only one process builds it
+    with cache.lock(pch_dir.name):
+        if pch_filename.is_file():
+            cache.touch(pch_dir.name)
+            return header
+        if failure_filename.is_file():
+            return None
+
+        with timer.phase("precompile"):
+            os.makedirs(pch_dir, exist_ok=True)
+            header.write_text(precompiled_header)
+            # The compiler only finds a complete header under its final name
+            try:
+                with atomic_replacement(pch_filename) as temporary_filename:
+                    run_tool(
+                        [compiler()] + compile_flags(build_type)
+                        + ["-x", "c++-header", header, "-o", temporary_filename],
+                        "Precompiling the headers",
+                    )
+            except Exception as error:
+                print("{}\nCompiling without precompiled header.".format(error), file=sys.stderr)
+                failure_filename.write_text(str(error))
+                header = None
+
+    cache.record(pch_dir.name, {
+        "backend": "pch",
+        "name": precompiled_header_name,
+        "failed": header is None,
+        "environment": {"compiler": compiler_version(), "build_type": build_type},
+    })
+    return header
+
+
+def compile_direct(code_dir: Path, cache_dir: Path, build_type: str, timer: BuildTimer) -> Path:
+    """
+    Compiles and links the generated `dslgen.cpp` of `code_dir` into `build/dslgen.so`
+    without CMake and returns the path to the module.
+    """
+    build_dir = code_dir / "build"
+    os.makedirs(build_dir, exist_ok=True)
+    so_filename = build_dir / "dslgen.so"
+    object_filename = build_dir / "dslgen.o"
+
+    header = build_precompiled_header(cache_dir, build_type, timer)
+    include_header = ["-include", header] if header is not None else []
+
+    with timer.phase("compile"):
+        run_tool(
+            [compiler()] + compile_flags(build_type) + include_header
+            + ["-c", code_dir / "dslgen.cpp", "-o", object_filename],
+            "Compiling {}".format(code_dir / "dslgen.cpp"),
+        )
+    with timer.phase("link"):
+        # The module only appears once it is linked completely
+        with atomic_replacement(so_filename) as temporary_filename:
+            run_tool(
+                [compiler(), object_filename, "-o", temporary_filename] + link_flags(build_type),
+                "Linking {}".format(so_filename),
+            )
+    object_filename.unlink()
+    return so_filename
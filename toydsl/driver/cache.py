@@ -0,0 +1,306 @@
+import contextlib
+import fcntl
+import functools
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+import uuid
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional
+
+
+# The directories and files whose content determines the generated code. A change to any
+# of these files gives the cached modules new keys. The driver runs the IR passes and
+# assembles the compiler flags.
+codegen_sources = ["backend", "frontend", "ir", "cpp", "driver/driver.py", "driver/build.py"]
+
+index_filename = "index.json"
+
+default_size_limit = "5G"
+
+# How often the time an entry was last used is updated, in seconds. The pruning only
+# needs it roughly, and most loads of a module then don't rewrite the index.
+touch_interval = 600
+
+size_units = {"": 1, "K": 2**10, "M": 2**20, "G": 2**30, "T": 2**40}
+
+
+@functools.lru_cache(maxsize=None)
+def codegen_version() -> str:
+    """Hashes the sources of the frontend, the IR passes, the code generators and the driver"""
+    hash_algorithm = hashlib.sha256()
+    package_dir = Path(__file__).parent.parent
+    for source in codegen_sources:
+        path = package_dir / source
+        for filename in [path] if path.is_file() else sorted(path.rglob("*")):
+            if filename.suffix not in [".py", ".hpp", ".txt"]:
+                continue
+            hash_algorithm.update(str(filename.relative_to(package_dir)).encode())
+            hash_algorithm.update(filename.read_bytes())
+    return hash_algorithm.hexdigest()[:10]
+
+
+def compiler() -> str:
+    """The C++ compiler that CMake picks up, `$CXX` or `c++`"""
+    return os.getenv("CXX", "c++")
+
+
+@functools.lru_cache(maxsize=None)
+def compiler_version() -> str:
+    """The first line of `--version` of the C++ compiler"""
+    try:
+        output = subprocess.run(
+            [compiler(), "--version"], capture_output=True, text=True, check=True
+        ).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return compiler()
+    return output.splitlines()[0] if output else compiler()
+
+
+def default_build_type() -> str:
+    """The CMake build type of the C++ modules, `$TOYDSL_BUILD_TYPE` or Release"""
+    return os.getenv("TOYDSL_BUILD_TYPE", "Release")
+
+
+def temporary_name(path: Path) -> Path:
+    """
+    A unique name next to `path` to create it under before it is renamed into place.
+    The name is random, the processes of several hosts may share a cache and their pids
+    aren't unique. Unlike with `tempfile`, the files get the usual permissions, so a
+    cache shared with other users stays readable.
+    """
+    return path.with_name("{}.{}.tmp".format(path.name, uuid.uuid4().hex))
+
+
+@contextlib.contextmanager
+def atomic_replacement(filename: Path) -> Iterator[Path]:
+    """
+    Yields a temporary name to write `filename` to, the file then replaces `filename` in
+    one step, so that other processes never see a partial file. It is removed if the
+    block fails.
+    """
+    temporary_filename = temporary_name(filename)
+    try:
+        yield temporary_filename
+        os.replace(temporary_filename, filename)
+    finally:
+        if temporary_filename.exists():
+            temporary_filename.unlink()
+
+
+def parse_size(size: str) -> int:
+    """Parses a size in bytes with an optional unit, e.g. `500M` or `2G`"""
+    size = size.strip().upper().rstrip("B")
+    unit = size[-1:] if size[-1:] in size_units else ""
+    try:
+        return int(float(size[: len(size) - len(unit)]) * size_units[unit])
+    except ValueError:
+        raise ValueError("Invalid size '{}'".format(size))
+
+
+def format_size(size: int) -> str:
+    for unit in ["", "K", "M", "G"]:
+        if size < 1024:
+            break
+        size /= 1024
+    return "{:.1f}{}".format(size, unit) if unit else "{}".format(size)
+
+
+def size_limit() -> Optional[int]:
+    """The size the code cache is pruned to, `$TOYDSL_CACHE_SIZE`, 0 disables the limit"""
+    limit = parse_size(os.getenv("TOYDSL_CACHE_SIZE", default_size_limit))
+    return limit if limit > 0 else None
+
+
+def disk_usage(path: Path) -> int:
+    if path.is_file():
+        return path.stat().st_size
+    return sum(f.stat().st_size for f in path.rglob("*") if f.is_file() and not f.is_symlink())
+
+
+class CodeCache:
+    """
+    Index of the generated modules in the code cache.
+
+    Every entry is a file or directory in the cache root, named after the key of the
+    module. The index records how each entry was built, its size, and when it was last
+    used, so the cache can be pruned to a size limit by evicting the least recently
+    used entries.
+
+    The index is rewritten atomically, so concurrent processes never read a partial
+    index, and it is only modified under the lock of the index, see `update`, so that
+    no process loses the updates of another one. The entries themselves are built under
+    a `lock`, by one process at a time.
+    """
+
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.index_filename = self.root / index_filename
+
+    def load(self) -> Dict[str, Dict[str, Any]]:
+        try:
+            with open(self.index_filename) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def store(self, index: Dict[str, Dict[str, Any]]) -> None:
+        os.makedirs(self.root, exist_ok=True)
+        with atomic_replacement(self.index_filename) as temporary_filename:
+            with open(temporary_filename, "w") as f:
+                json.dump(index, f, indent=4, sort_keys=True)
+
+    @contextlib.contextmanager
+    def update(self) -> Iterator[Dict[str, Dict[str, Any]]]:
+        """
+        Yields the index to be modified in place and stores it at the end of the block.
+        Another process can't modify the index in between, it waits for the lock.
+        """
+        with self.lock(index_filename, quiet=True):
+            index = self.load()
+            yield index
+            self.store(index)
+
+    def record(self, entry: str, metadata: Dict[str, Any]) -> None:
+        """Adds a freshly built entry to the index and prunes the cache to the size limit"""
+        size = disk_usage(self.root / entry)
+        with self.update() as index:
+            now = time.time()
+            index[entry] = dict(metadata, size=size, created=now, last_used=now)
+
+        limit = size_limit()
+        if limit is not None:
+            self.prune(limit, keep=[entry])
+
+    @contextlib.contextmanager
+    def lock(self, entry: str, quiet: bool = False) -> Iterator[None]:
+        """
+        Holds an exclusive lock on an entry, shared by all the processes using the cache,
+        e.g. while the entry is built. The lock files are kept, removing one while another
+        process waits for it would let two processes hold the lock. Unless `quiet`, a
+        message tells that the process waits for another one.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.root / "{}.lock".format(entry), "a") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                if not quiet:
+                    print(
+                        "Waiting for another process to build {}.".format(entry),
+                        file=sys.stderr,
+                    )
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def try_lock(self, entry: str) -> Iterator[bool]:
+        """
+        Like `lock`, but doesn't wait for another process holding the lock. Yields whether
+        the lock was acquired.
+        """
+        try:
+            lock_file = open(self.root / "{}.lock".format(entry), "a")
+        except OSError:
+            # A read-only cache, nothing can be changed in it anyway
+            yield False
+            return
+        with lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def touch(self, entry: str) -> None:
+        """
+        Marks an entry as used, unless it was marked within the `touch_interval` or the
+        cache is read-only, e.g. shipped in a package
+        """
+        metadata = self.load().get(entry)
+        if metadata is None or time.time() - metadata.get("last_used", 0) < touch_interval:
+            return
+        try:
+            with self.update() as index:
+                if entry in index:
+                    index[entry]["last_used"] = time.time()
+        except OSError:
+            pass
+
+    def update_sizes(self) -> None:
+        """Measures the size of every entry again, after files were removed from it"""
+        with self.update() as index:
+            for entry, metadata in index.items():
+                if (self.root / entry).exists():
+                    metadata["size"] = disk_usage(self.root / entry)
+
+    def entries(self) -> List[Dict[str, Any]]:
+        """The entries of the index, least recently used first"""
+        entries = [dict(metadata, entry=entry) for entry, metadata in self.load().items()]
+        return sorted(entries, key=lambda metadata: metadata["last_used"])
+
+    def total_size(self) -> int:
+        return sum(metadata["size"] for metadata in self.load().values())
+
+    def remove(self, entry: str) -> bool:
+        """
+        Removes an entry and its record, unless another process holds its lock, e.g.
+        while it builds the entry. Returns whether the entry was removed.
+        """
+        with self.try_lock(entry) as locked:
+            if not locked:
+                return False
+            path = self.root / entry
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            elif path.exists():
+                path.unlink()
+            with self.update() as index:
+                index.pop(entry, None)
+        return True
+
+    def prune(self, limit: int, keep: List[str] = ()) -> List[str]:
+        """
+        Evicts the least recently used entries until the cache fits into `limit` bytes.
+        The entries another process holds the lock of are skipped.
+        """
+        with self.update() as index:
+            # Entries whose files were deleted by hand don't count
+            for entry in [entry for entry in index if not (self.root / entry).exists()]:
+                del index[entry]
+
+        total = sum(metadata["size"] for metadata in index.values())
+        evicted = []
+        for metadata in self.entries():
+            if total <= limit:
+                break
+            if metadata["entry"] in keep or not self.remove(metadata["entry"]):
+                continue
+            total -= metadata["size"]
+            evicted.append(metadata["entry"])
+
+        if evicted:
+            print(
+                "Evicted {} entries from the code cache {}.".format(len(evicted), self.root),
+                file=sys.stderr,
+            )
+        return evicted
+
+    def clear(self) -> None:
+        """Removes all the generated code, including the entries missing from the index"""
+        for path in self.root.iterdir():
+            if path.is_dir():
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                path.unlink()
@@ -0,0 +1,168 @@
+import functools
+import multiprocessing
+import os
+import sys
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from toydsl.backend.codegen_cpp import CppStencil, load_cpp_module, run_steps
+
+
+# When the C++ code of a stencil is compiled:
+#   eager:      while the decorator runs, blocking until the module is built
+#   lazy:       on the first call of the stencil
+#   background: in a pool of worker processes, started while the decorator runs
+compilation_modes = ("eager", "lazy", "background")
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+def default_compilation() -> str:
+    """Reads the compilation mode that is set globally in the environment"""
+    compilation = os.getenv("TOYDSL_COMPILATION", "eager")
+    if compilation not in compilation_modes:
+        raise ValueError(
+            "Invalid TOYDSL_COMPILATION '{}', expected one of: {}".format(
+                compilation, ", ".join(compilation_modes)
+            )
+        )
+    return compilation
+
+
+def compile_workers() -> int:
+    """The number of stencils that are compiled concurrently, `$TOYDSL_COMPILE_WORKERS`"""
+    workers = os.getenv("TOYDSL_COMPILE_WORKERS")
+    if workers:
+        return int(workers)
+    return os.cpu_count() or 1
+
+
+def executor() -> ProcessPoolExecutor:
+    """
+    The process pool shared by all the stencils compiled in the background.
+
+    The workers are forked, the other start methods import the main module again in the
+    workers, which would run the decorators of a script once more.
+    """
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=compile_workers(), mp_context=multiprocessing.get_context("fork")
+        )
+    return _executor
+
+
+class DeferredStencil:
+    """
+    A C++ stencil whose module is built when it is needed rather than when it is defined.
+
+    The compilation is either started right away in the process pool (background) or
+    on the first call (lazy). A call that arrives before the module is built blocks until
+    it is ready, unless a fallback is given: the call then runs the fallback, e.g. the
+    numpy version of the stencil, and the compiled kernel takes over once it is loaded.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        arguments: List[str],
+        so_filename: Path,
+        build: Callable[[], Path],
+        fallback: Optional[Callable[[], Callable]] = None,
+        background: bool = False,
+        kernel: Optional[Callable] = None,
+    ):
+        """
+        Args:
+        name: Name of the function in the compiled module.
+        arguments: The fields in the signature of the function.
+        so_filename: Where the compiled module is found once it is built.
+        build: Builds the module and returns its path. It is sent to the worker
+            processes, so it must be picklable.
+        fallback: Creates the function that is called while the module is being built.
+        background: Start building the module in the process pool right away.
+        kernel: The compiled kernel, if the module is already built and loaded.
+        """
+        self.name = name
+        self.arguments = arguments
+        self.so_filename = so_filename
+        self.build = build
+        self.fallback = fallback
+        self._kernel: Optional[Callable] = kernel
+        self._fallback_kernel: Optional[Callable] = None
+        self._future: Optional[Future] = None
+        self._lock = threading.Lock()
+        if background:
+            self.start()
+
+    def __call__(self, *args):
+        if self._kernel is None and self.fallback is not None:
+            self.start()
+            if not self.ready():
+                return self.fallback_kernel()(*args)
+        return self.wait()(*args)
+
+    def start(self) -> None:
+        """Submits the build to the process pool, unless the module is already there"""
+        with self._lock:
+            if self._kernel is not None or self._future is not None:
+                return
+            if not os.path.isfile(self.so_filename):
+                # Forked workers would print whatever is still buffered a second time
+                sys.stdout.flush()
+                sys.stderr.flush()
+                self._future = executor().submit(self.build)
+
+    def ready(self) -> bool:
+        """Whether the compiled kernel can be called without waiting"""
+        if self._kernel is not None:
+            return True
+        if self._future is not None:
+            # Only the worker knows whether the build failed
+            return self._future.done()
+        return os.path.isfile(self.so_filename)
+
+    def wait(self) -> Callable:
+        """Blocks until the module is built and returns the compiled kernel"""
+        with self._lock:
+            if self._kernel is None:
+                if self._future is not None:
+                    so_filename = self._future.result()
+                else:
+                    so_filename = self.build()
+                self._kernel = CppStencil(load_cpp_module(so_filename), self.name)
+                self._future = None
+            return self._kernel
+
+    def bind(self, *args) -> Callable:
+        """
+        Binds the arguments to the compiled kernel, see `CppStencil.bind`. While the
+        fallback is in use, the returned function keeps dispatching through this stencil.
+        """
+        if self._kernel is None and self.fallback is not None:
+            self.start()
+            if not self.ready():
+                return functools.partial(self, *args)
+        return self.wait().bind(*args)
+
+    def run(self, *args, steps: int, swap: Optional[Tuple[str, str]] = None):
+        """Runs several steps of the stencil, see `CppStencil.run`"""
+        if self._kernel is None and self.fallback is not None:
+            self.start()
+            if not self.ready():
+                return run_steps(self.fallback_kernel(), self.arguments, args, steps, swap)
+        return self.wait().run(*args, steps=steps, swap=swap)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """The counters of the compiled kernel, see `CppStencil.stats`"""
+        return self.wait().stats()
+
+    def reset_stats(self) -> None:
+        self.wait().reset_stats()
+
+    def fallback_kernel(self) -> Callable:
+        if self._fallback_kernel is None:
+            self._fallback_kernel = self.fallback()
+        return self._fallback_kernel
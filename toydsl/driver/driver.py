@@ -1,74 +1,325 @@
 import functools
 import hashlib
 import inspect
+import json
 import os
+import shutil
 import sys
-import time
 from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 from toydsl.backend.codegen import CodeGen, ModuleGen
-from toydsl.backend.codegen_cpp import CodeGenCpp, format_cpp, compile_cpp, load_cpp_module
+from toydsl.backend.codegen_cpp import (
+    CodeGenCpp,
+    CppStencil,
+    configure_cpp,
+    format_cpp,
+    load_cpp_module,
+    make_cpp,
+)
+from toydsl.backend.codegen_numpy import CodeGenNumpy
+from toydsl.driver.autotune import Autotuner
+from toydsl.driver.build import BuildTimer, build_environment, compile_direct, default_build_mode
+from toydsl.driver.cache import (
+    CodeCache,
+    atomic_replacement,
+    codegen_version,
+    compiler_version,
+    default_build_type,
+    temporary_name,
+)
+from toydsl.driver.compilation import DeferredStencil, compilation_modes, default_compilation
+from toydsl.driver.specialization import DtypeSpecializations, specialization_dtypes
 from toydsl.frontend.frontend import parse
+from toydsl.ir.compose import compose
+from toydsl.ir.extents import AdjustDomains, CheckedStencil, domain_modes
+from toydsl.ir.fusion import FuseHorizontalDomains
+from toydsl.ir.ir import IR
+from toydsl.ir.passes import PassManager
+from toydsl.ir.simplify import SimplifyExpressions
+from toydsl.ir.temporaries import FindTemporaries
 
 
-def driver_cpp(function, hash: str, cache_dir: Path):
+# The options that configure the passes over the IR rather than the code generation
+ir_options = ("temporaries", "demote_temporaries", "domains")
+
+def parse_definition(definition) -> IR:
+    """The IR of a DSL function, definitions that are IR already are passed through"""
+    if isinstance(definition, IR):
+        return definition
+    return parse(definition)
+
+def optimize(ir, options: Optional[Dict[str, Any]] = None):
+    """Runs the optimization passes over the IR of a function"""
+    if options is None:
+        options = {}
+    passes = []
+    if options.get("domains") is not None:
+        passes.append(AdjustDomains(options["domains"]))
+    if options.get("demote_temporaries", False):
+        passes.append(FindTemporaries())
+    passes.append(FuseHorizontalDomains(temporaries=options.get("temporaries", ())))
+    passes.append(SimplifyExpressions())
+    return PassManager(passes).apply(ir)
+
+def codegen_options(options: Dict[str, Any]) -> Dict[str, Any]:
+    """The options that are passed on to the C++ code generator"""
+    return {name: value for name, value in options.items() if name not in ir_options}
+
+def signature_arguments(ir) -> List[str]:
+    """The arguments of the generated function, the temporaries are dropped from the signature"""
+    return [arg for arg in ir.api_signature if arg not in ir.temporaries]
+
+def cpp_cache_key(hash: str) -> str:
     """
-    Driver for generating the c++ code, formatting it, compiling it, and loading the
-    resulting shared object as a python module.
+    The key of a compiled module in the code cache. Besides the stencil and its options,
+    the module depends on the build type and mode, the flags, the architecture and the
+    version of the code generator, see `build_environment`. The kernels for the
+    instruction sets of different CPUs are all in the module, so nodes of one
+    architecture can share it.
     """
+    environment = build_environment(default_build_type(), default_build_mode())
+    return hash_string(hash + repr(sorted(environment.items())))
 
-    # we need to do this outside of the if block because we need the function name
-    ir = parse(function)
-    function_name = ir.name
+def python_cache_key(hash: str) -> str:
+    """The key of a generated python module in the code cache"""
+    return hash_string(hash + codegen_version())
 
-    # We actually hash the generated C++ code as well. This is a convenience feature
-    # so that changing the C++ code generation causes an update. In a real usecase
-    # the generated C++ code would not be hashed, we would only need the hash of
-    # the input code, because end-users would not be changing the function mapping
-    # input code to C++.
-    # cpp_hash = hash_string(code)
+def cpp_module_filename(key: str, cache_dir: Path) -> Path:
+    """The shared object that the C++ code of a stencil is compiled into"""
+    return cache_dir / "cpp_{}".format(key) / "build" / "dslgen.so"
 
-    code_dir = cache_dir / "cpp_{}".format(hash)
-    so_filename = code_dir / "build" / "dslgen.so"
+def cpp_manifest_filename(key: str, cache_dir: Path) -> Path:
+    """
+    Describes a compiled module: the name and signature of the stencil in it and how it
+    was built. A stencil whose module is in the cache only needs the manifest, so its
+    definition isn't parsed.
+    """
+    return cache_dir / "cpp_{}".format(key) / "manifest.json"
+
+def write_manifest(filename: Path, manifest: Dict[str, Any]) -> None:
+    with atomic_replacement(filename) as temporary_filename:
+        with open(temporary_filename, "w") as f:
+            json.dump(manifest, f, indent=4, sort_keys=True)
 
+def load_cached_cpp(key: str, cache_dir: Path) -> Optional[Tuple[CppStencil, Dict[str, Any]]]:
+    """The compiled stencil and its manifest if both are in the cache"""
+    so_filename = cpp_module_filename(key, cache_dir)
+    try:
+        with open(cpp_manifest_filename(key, cache_dir)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
     if not os.path.isfile(so_filename):
-        # For now we just perform all the generation steps if the .so file
-        # is missing. The case where some of the steps have already been
-        # performed is rare and we wouldn't save much time anyway.
+        return None
+    CodeCache(cache_dir).touch("cpp_{}".format(key))
+    return CppStencil(load_cpp_module(so_filename), manifest["name"]), manifest
 
-        start_time = time.perf_counter()
+def build_cpp(
+    ir,
+    hash: str,
+    cache_dir: Path,
+    options: Optional[Dict[str, Any]] = None,
+    timer: Optional[BuildTimer] = None,
+) -> Path:
+    """
+    Generates and compiles the C++ code of a stencil unless the compiled module is
+    already in the cache, and returns the path to the module. How the code is built is
+    set by `$TOYDSL_BUILD_MODE`, see `toydsl.driver.build`. The time every phase took is
+    reported, `timer` may already hold the time it took to parse the stencil.
 
-        cmake_dir = Path(__file__).parent.parent / "cpp"
-        code = CodeGenCpp.apply(ir)
-        cpp_filename = code_dir / "dslgen.cpp"
+    This runs in the worker processes when stencils are compiled in the background.
+    """
+    if options is None:
+        options = {}
+    if timer is None:
+        timer = BuildTimer()
 
-        os.makedirs(code_dir, exist_ok=True)
-        with open(cpp_filename, "w") as f:
-            f.write(code)
+    build_type = default_build_type()
+    build_mode = default_build_mode()
+    key = cpp_cache_key(hash)
+    code_dir = cache_dir / "cpp_{}".format(key)
+    so_filename = cpp_module_filename(key, cache_dir)
+    cache = CodeCache(cache_dir)
+
+    if os.path.isfile(so_filename):
+        cache.touch(code_dir.name)
+        return so_filename
+
+    # Only one process builds a module, the others wait here and then load its module
+    with cache.lock(code_dir.name):
+        if os.path.isfile(so_filename):
+            cache.touch(code_dir.name)
+            return so_filename
+
+        # The module is built in a directory of its own, which is then renamed to the
+        # entry of the cache. Other processes only ever see a complete module and manifest.
+        build_dir = temporary_name(code_dir)
+        try:
+            cmake_dir = Path(__file__).parent.parent / "cpp"
+            with timer.phase("codegen"):
+                optimized = optimize(ir, options)
+                code = CodeGenCpp.apply(optimized, **codegen_options(options))
+            cpp_filename = build_dir / "dslgen.cpp"
+
+            os.makedirs(build_dir)
+            with open(cpp_filename, "w") as f:
+                f.write(code)
+
+            if build_mode == "direct":
+                compile_direct(build_dir, cache_dir, build_type, timer)
+            else:
+                with timer.phase("format"):
+                    format_cpp(cpp_filename, cmake_dir)
+                with timer.phase("configure"):
+                    configure_cpp(build_dir, cmake_dir, build_type)
+                # make compiles and links in one go, with -flto most of the work is the link
+                with timer.phase("compile"):
+                    make_cpp(build_dir)
+
+            print("\n\n" + timer.report(ir.name, build_mode), file=sys.stderr)
+
+            metadata = {
+                "backend": "cpp",
+                "name": ir.name,
+                "source_hash": hash,
+                "options": options,
+                "environment": dict(
+                    build_environment(build_type, build_mode), compiler=compiler_version()
+                ),
+                "build_mode": build_mode,
+                "build_time": timer.total(),
+                "build_phases": timer.phases,
+            }
+            write_manifest(
+                build_dir / "manifest.json",
+                dict(metadata, arguments=signature_arguments(optimized)),
+            )
+            # Whatever a build that failed before left behind
+            shutil.rmtree(code_dir, ignore_errors=True)
+            os.rename(build_dir, code_dir)
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+
+    cache.record(code_dir.name, metadata)
+    return so_filename
 
-        format_cpp(cpp_filename, cmake_dir)
-        compile_cpp(code_dir, cmake_dir)
+def driver_cpp(function, hash: str, cache_dir: Path, options: Optional[Dict[str, Any]] = None):
+    """
+    Driver for generating the c++ code, compiling it, and loading the resulting shared
+    object as a python module.
+
+    The options are passed on to the C++ code generator.
+    """
+    cached = load_cached_cpp(cpp_cache_key(hash), cache_dir)
+    if cached is not None:
+        return cached[0]
+
+    timer = BuildTimer()
+    with timer.phase("parse"):
+        ir = parse_definition(function)
+    so_filename = build_cpp(ir, hash, cache_dir, options, timer)
+    return CppStencil(load_cpp_module(so_filename), ir.name)
+
+def build_cpp_definition(
+    definition, hash: str, cache_dir: Path, options: Optional[Dict[str, Any]] = None
+) -> Path:
+    """`build_cpp` for a definition that hasn't been parsed yet"""
+    return build_cpp(parse_definition(definition), hash, cache_dir, options)
+
+def driver_cpp_deferred(
+    function,
+    hash: str,
+    cache_dir: Path,
+    options: Optional[Dict[str, Any]] = None,
+    *,
+    background: bool = False,
+    fallback: Optional[str] = None,
+) -> DeferredStencil:
+    """
+    Driver for the C++ backend that doesn't compile the code right away. The stencil is
+    compiled in the process pool (`background=True`) or on its first call. Until then,
+    calls either wait for the compilation or run the `fallback` backend.
+    """
+    key = cpp_cache_key(hash)
+    fallback_stencil = (
+        functools.partial(backends[fallback], function, hash, cache_dir, options)
+        if fallback is not None
+        else None
+    )
+
+    cached = load_cached_cpp(key, cache_dir)
+    if cached is not None:
+        # Loading the module takes less time than parsing the definition
+        stencil, manifest = cached
+        return DeferredStencil(
+            manifest["name"],
+            manifest["arguments"],
+            cpp_module_filename(key, cache_dir),
+            functools.partial(build_cpp_definition, function, hash, cache_dir, options),
+            fallback_stencil,
+            kernel=stencil,
+        )
 
-        end_time = time.perf_counter()
-        print("\n\nGenerated, formatted, and compiled C++ code in {:.2f} seconds.".format(end_time - start_time), file=sys.stderr)
+    timer = BuildTimer()
+    with timer.phase("parse"):
+        ir = parse_definition(function)
 
-    return getattr(load_cpp_module(so_filename), function_name)
+    return DeferredStencil(
+        ir.name,
+        signature_arguments(optimize(ir, options)),
+        cpp_module_filename(key, cache_dir),
+        functools.partial(build_cpp, ir, hash, cache_dir, options, timer),
+        fallback_stencil,
+        background,
+    )
 
-def driver_python(function, hash: str, cache_dir: Path):
+def driver_python(function, hash: str, cache_dir: Path, options: Optional[Dict[str, Any]] = None):
     """
     Driver for generating a module from a parsable function while storing the python module
     in the given cache directory.
     """
-    filename = cache_dir / "generated_{hash}.py".format(hash=hash),
+    ir = parse_definition(function)
+    filename = cache_dir / "generated_{key}.py".format(key=python_cache_key(hash))
+    cache = CodeCache(cache_dir)
+    optimized = optimize(ir, options)
 
-    ir = parse(function)
-    code = CodeGen.apply(ir)
+    if not os.path.isfile(filename):
+        code = CodeGen.apply(optimized)
+        with open(filename, "w") as f:
+            f.write(code)
+        cache.record(filename.name, {"backend": "python", "name": ir.name, "source_hash": hash})
+    else:
+        cache.touch(filename.name)
 
-    # print(CodeGenCpp.apply(ir))
+    return CheckedStencil(ModuleGen.apply(ir.name, filename), optimized)
 
-    with open(filename, "w") as f:
-        f.write(code)
-    return ModuleGen.apply(ir.name, filename)
+def driver_numpy(function, hash: str, cache_dir: Path, options: Optional[Dict[str, Any]] = None):
+    """
+    Driver for generating a vectorized numpy module from a parsable function. The
+    generated module is cached in the given cache directory like the C++ modules.
+    """
+    ir = parse_definition(function)
+    filename = cache_dir / "generated_numpy_{key}.py".format(key=python_cache_key(hash))
+    cache = CodeCache(cache_dir)
+    optimized = optimize(ir, options)
+
+    if not os.path.isfile(filename):
+        code = CodeGenNumpy.apply(optimized)
+        with open(filename, "w") as f:
+            f.write(code)
+        cache.record(filename.name, {"backend": "numpy", "name": ir.name, "source_hash": hash})
+    else:
+        cache.touch(filename.name)
+
+    return CheckedStencil(ModuleGen.apply(ir.name, filename), optimized)
+
+
+backends = {
+    "cpp": driver_cpp,
+    "numpy": driver_numpy,
+    "python": driver_python,
+}
 
 
 def set_up_cache_directory() -> str:
@@ -88,20 +339,237 @@ def hash_source_code(definition_func) -> str:
     """Hashes the source code of a function to get a unique ID for a target file"""
     return hash_string(repr(inspect.getsource(definition_func)))
 
-def computation(func):
+def hash_options(hash: str, options: Dict[str, Any]) -> str:
+    """Combines the hash of the source code with the code generation options"""
+    if not options:
+        return hash
+    return hash_string(hash + repr(sorted(options.items())))
+
+def parse_tile_sizes(tile_sizes: str) -> Tuple[int, int, int]:
+    """Parses tile sizes given as a comma separated list, e.g. `64,16,0`"""
+    sizes = tuple(int(size) for size in tile_sizes.split(","))
+    if len(sizes) != 3:
+        raise ValueError("Expected three tile sizes (i, j, k), got '{}'".format(tile_sizes))
+    return sizes
+
+def default_options() -> Dict[str, Any]:
+    """Reads the code generation options that are set globally in the environment"""
+    options = {}
+    tile_sizes = os.getenv("TOYDSL_TILE_SIZES")
+    if tile_sizes:
+        options["tile_sizes"] = parse_tile_sizes(tile_sizes)
+    return options
+
+def create_stencil(
+    definition,
+    source_hash: str,
+    *,
+    backend: str = "cpp",
+    tile_sizes: Optional[Tuple[int, int, int]] = None,
+    isas: Optional[Sequence[str]] = None,
+    dtype: str = "float64",
+    streaming_stores: Optional[Sequence[str]] = None,
+    autotune: bool = False,
+    instrument: bool = False,
+    temporaries: Sequence[str] = (),
+    demote_temporaries: bool = False,
+    domains: Optional[str] = None,
+    compilation: Optional[str] = None,
+    fallback: Optional[str] = None,
+):
+    """
+    Generates the code for a DSL function, or its IR, with the options of `computation`
+    and returns the callable stencil.
+    """
+    if backend not in backends:
+        raise ValueError(
+            "Unknown backend '{}', available backends are: {}".format(backend, ", ".join(backends))
+        )
+    if autotune and backend != "cpp":
+        raise ValueError("Autotuning is only supported by the cpp backend")
+    if instrument and (backend != "cpp" or autotune):
+        # The counters would also slow down the variants that are timed
+        raise ValueError("Instrumentation is only supported by the cpp backend without autotuning")
+    if dtype not in specialization_dtypes and dtype != "auto":
+        raise ValueError(
+            "Unknown dtype '{}', available dtypes are: {}, auto".format(
+                dtype, ", ".join(specialization_dtypes)
+            )
+        )
+    if dtype == "auto" and backend == "cpp":
+        # Every specialization is created with the same options but for the dtype
+        options = dict(
+            backend=backend, tile_sizes=tile_sizes, isas=isas,
+            streaming_stores=streaming_stores, autotune=autotune, instrument=instrument,
+            temporaries=temporaries, demote_temporaries=demote_temporaries, domains=domains,
+            compilation=compilation, fallback=fallback,
+        )
+        return DtypeSpecializations(
+            lambda dtype: create_stencil(definition, source_hash, dtype=dtype, **options)
+        )
+    if compilation is None:
+        compilation = default_compilation()
+    if compilation not in compilation_modes:
+        raise ValueError(
+            "Unknown compilation mode '{}', available modes are: {}".format(
+                compilation, ", ".join(compilation_modes)
+            )
+        )
+    if fallback is not None:
+        if backend != "cpp" or autotune:
+            raise ValueError("A fallback is only supported by the cpp backend without autotuning")
+        if fallback not in backends or fallback == "cpp":
+            raise ValueError(
+                "Unknown fallback '{}', available fallbacks are: numpy, python".format(fallback)
+            )
+
+    options = default_options()
+    if tile_sizes is not None:
+        options["tile_sizes"] = tuple(tile_sizes)
+    if isas is not None:
+        options["isas"] = tuple(isas)
+    if dtype != "float64" and backend == "cpp":
+        options["dtype"] = dtype
+    if streaming_stores is not None:
+        options["streaming_stores"] = tuple(streaming_stores)
+    if instrument:
+        options["instrument"] = True
+    if temporaries:
+        options["temporaries"] = tuple(temporaries)
+    if demote_temporaries:
+        options["demote_temporaries"] = True
+    if domains is not None:
+        if domains not in domain_modes:
+            raise ValueError(
+                "Unknown domain mode '{}', available modes are: {}".format(
+                    domains, ", ".join(domain_modes)
+                )
+            )
+        options["domains"] = domains
+
+    cache_dir = set_up_cache_directory()
+    hash = hash_options(source_hash, options)
+
+    if autotune:
+        def build(variant_options):
+            return driver_cpp(
+                definition,
+                hash_options(source_hash, variant_options),
+                Path(cache_dir),
+                variant_options
+            )
+
+        record_filename = Path(cache_dir) / "autotune_{}.json".format(cpp_cache_key(hash))
+        return Autotuner(build, record_filename, options)
+
+    if backend == "cpp" and (compilation != "eager" or fallback is not None):
+        return driver_cpp_deferred(
+            definition,
+            hash,
+            Path(cache_dir),
+            options,
+            background=compilation != "lazy",
+            fallback=fallback,
+        )
+
+    stencil_call = backends[backend](
+        definition,
+        hash,
+        Path(cache_dir),
+        options
+    )
+    return stencil_call
+
+def computation(func=None, **kwargs):
     """Main entrypoint into the DSL.
     Decorating functions with this call will allow for calls to the generated code
+
+    The backend generating the code can be selected with `@computation(backend="numpy")`,
+    available backends are "cpp" (default), "numpy" and "python".
+
+    `tile_sizes` sets the sizes of the tiles (i, j, k) the C++ loops are blocked into, a
+    size of 0 leaves that axis untiled. It overrides the global `TOYDSL_TILE_SIZES`.
+
+    `isas` limits the vector instruction sets ("avx512", "avx2") the C++ kernels are
+    generated for, the scalar kernels are always there as the fallback.
+
+    `dtype` is the element type of the fields of the C++ kernels, "float64" (default) or
+    "float32". With `dtype="auto"` the kernel is specialized on the dtype of the arrays
+    of each call, the specializations are compiled when they are first needed and
+    cached separately. The numpy and python backends work with the dtype of the arrays.
+
+    The vectorized C++ kernels write the fields that they don't read with non-temporal
+    stores, which bypass the caches. `streaming_stores` names the fields to stream instead,
+    `streaming_stores=()` turns them off.
+
+    `temporaries` names the arguments that are only used as scratch space. Their content
+    is not observable after the call, which lets the optimization passes fuse the stages
+    producing and consuming them.
+
+    With `demote_temporaries=True` the arguments that are written before they are read on
+    every level are detected automatically. They are replaced by small per-thread buffers
+    and dropped from the signature of the generated function, so the caller no longer
+    allocates them.
+
+    With `domains="shrink"` the compute domains are shrunk so that no access leaves the
+    bounds of the call, and stages reading a field computed by an earlier stage only
+    compute where the field is available. `domains="extend"` instead extends the stages
+    computing a field to every point later stages read it at, the arrays then need a
+    halo around the bounds. Without the option the domains are used as written.
+
+    With `autotune=True` the C++ code generation options are tuned on the first call for
+    every shape of the arguments, and the tuned configuration is kept in the code cache.
+
+    With `instrument=True` the C++ kernels count the cycles spent in every horizontal
+    domain, `stencil.stats()` returns them. Without it the kernels contain no counters.
+
+    `compilation` decides when the C++ code is compiled: "eager" compiles it right here,
+    "lazy" on the first call and "background" starts compiling it in a pool of worker
+    processes, so that the stencils of a module compile concurrently. It overrides the
+    global `TOYDSL_COMPILATION`. With `fallback="numpy"` (or "python") the calls that
+    arrive before the compiled code is ready run that backend instead of waiting, eager
+    compilation then also happens in the background.
     """
 
-    @functools.wraps(func)
     def _decorator(definition_func):
-        cache_dir = set_up_cache_directory()
-        hash = hash_source_code(definition_func)
-        stencil_call = driver_cpp(
-            definition_func,
-            hash,
-            Path(cache_dir)
+        stencil_call = create_stencil(
+            definition_func, hash_source_code(definition_func), **kwargs
         )
+        # Keep the definition around so that the stencil can be part of a program
+        stencil_call.definition = definition_func
         return stencil_call
 
+    if func is None:
+        return _decorator
     return _decorator(func)
+
+def program(*stages, name: str = "program", **kwargs):
+    """
+    Composes several DSL functions into a single computation with one entry point.
+
+    The stages run in the given order. Stages sharing an argument name share the field,
+    the signature of the program lists the fields in the order they first appear. A stage
+    can also be given as `(function, {"in_field": "tmp_field"})` to map its arguments to
+    differently named fields of the program. The stages may be plain DSL functions or
+    decorated with `@computation`.
+
+    With the C++ backend all the stages run in one parallel region. The threads only wait
+    for each other between two stages if the later one accesses a field that the earlier
+    one writes, or the other way around. The keyword arguments are the options of
+    `computation`, e.g. `program(lapoflap, vertical_blur, demote_temporaries=True)`.
+    """
+    if not stages:
+        raise ValueError("A program needs at least one stage")
+
+    composed_stages = []
+    sources = [name]
+    for stage in stages:
+        names = {}
+        if isinstance(stage, tuple):
+            stage, names = stage
+        definition = getattr(stage, "definition", stage)
+        composed_stages.append((parse(definition), names))
+        sources.append(hash_source_code(definition) + repr(sorted(names.items())))
+
+    ir = compose(name, composed_stages)
+    return create_stencil(ir, hash_string("".join(sources)), **kwargs)
@@ -0,0 +1,87 @@
+import threading
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+# The element types the C++ kernels can be specialized on
+specialization_dtypes = ("float64", "float32")
+
+
+def field_dtype(field) -> str:
+    """The name of the element type of a numpy array or any other buffer"""
+    dtype = getattr(field, "dtype", None)
+    if dtype is None:
+        dtype = memoryview(field).format
+    return np.dtype(dtype).name
+
+
+class DtypeSpecializations:
+    """
+    A stencil whose kernel is specialized on the element type of the fields it is called
+    with. The specialization for a dtype is created on the first call with arrays of that
+    dtype, each of them is compiled and cached on its own.
+
+    The dtype is taken from the first field, scalar parameters are converted to it. The
+    specializations reject calls where the other fields have a different one. Arrays of
+    mixed dtypes have to be cast explicitly.
+    """
+
+    def __init__(self, create: Callable[[str], Callable]):
+        """
+        Args:
+        create: Creates the stencil specialized on the given dtype.
+        """
+        self.create = create
+        self.specializations: Dict[str, Callable] = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, *args):
+        return self.specialization(args)(*args)
+
+    def specialization(self, args) -> Callable:
+        """The stencil specialized on the dtype of the fields among the arguments"""
+        fields = [arg for arg in args if not np.isscalar(arg)]
+        if not fields:
+            raise TypeError("Expected the fields and the bounds of the stencil")
+        return self.specialize(field_dtype(fields[0]))
+
+    def specialize(self, dtype: str) -> Callable:
+        """The stencil specialized on a dtype, it is created if it doesn't exist yet"""
+        stencil = self.specializations.get(dtype)
+        if stencil is None:
+            if dtype not in specialization_dtypes:
+                raise ValueError(
+                    "Fields need to be arrays of {}, got {}".format(
+                        " or ".join(specialization_dtypes), dtype
+                    )
+                )
+            with self._lock:
+                stencil = self.specializations.get(dtype)
+                if stencil is None:
+                    stencil = self.create(dtype)
+                    self.specializations[dtype] = stencil
+        return stencil
+
+    def bind(self, *args) -> Callable:
+        """Binds the arguments to the specialization for their dtype, see `CppStencil.bind`"""
+        return self.specialization(args).bind(*args)
+
+    def run(self, *args, steps: int, swap: Optional[Tuple[str, str]] = None):
+        """Runs several steps of the specialization for the dtype, see `CppStencil.run`"""
+        return self.specialization(args).run(*args, steps=steps, swap=swap)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        """
+        The counters of the specializations created so far, see `CppStencil.stats`. Every
+        stage also has the `dtype` of its specialization.
+        """
+        return [
+            dict(stage, dtype=dtype)
+            for dtype, stencil in sorted(self.specializations.items())
+            for stage in stencil.stats()
+        ]
+
+    def reset_stats(self) -> None:
+        for stencil in self.specializations.values():
+            stencil.reset_stats()
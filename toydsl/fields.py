@@ -0,0 +1,103 @@
+"""
+Allocation of fields for the C++ kernels.
+
+The arrays returned here have a halo around the interior, and the first interior point
+of every row is aligned to `alignment` bytes. The stencils called with such arrays use
+aligned vector loads and stores on the points whose offset keeps that alignment. The
+rows and planes are padded so that their size in bytes is never a multiple of 4096,
+which would map the same point of neighbouring rows onto the same cache sets.
+"""
+from typing import List, Sequence, Tuple, Union
+
+import numpy as np
+
+# The size of a cache line, and the default alignment of the rows
+cache_line = 64
+
+# Strides that are a multiple of this many bytes make neighbouring rows conflict in the cache
+conflict_stride = 4096
+
+Halo = Union[int, Sequence[Union[int, Tuple[int, int]]]]
+
+
+def axis_halos(halo: Halo) -> List[Tuple[int, int]]:
+    """The halo before and after the interior along the k, j and i axes"""
+    if isinstance(halo, int):
+        halo = [halo] * 3
+    if len(halo) != 3:
+        raise ValueError("Expected a halo for each of the 3 axes, got {}".format(len(halo)))
+    halos = [(h, h) if isinstance(h, int) else tuple(h) for h in halo]
+    if any(len(h) != 2 or h[0] < 0 or h[1] < 0 for h in halos):
+        raise ValueError("The halo needs to be non-negative, got {}".format(halo))
+    return halos
+
+
+def padded_stride(size: int, alignment: int) -> int:
+    """The stride in bytes of rows or planes of `size` bytes"""
+    stride = -(-size // alignment) * alignment
+    if stride % conflict_stride == 0:
+        stride += -(-cache_line // alignment) * alignment
+    return stride
+
+
+def empty(
+    shape: Sequence[int], halo: Halo = 0, dtype=np.float64, alignment: int = cache_line
+) -> np.ndarray:
+    """
+    Allocates an uninitialized field whose interior has the given shape.
+
+    Args:
+    shape: The size of the interior along the k, j and i axes, in the order of the array axes.
+    halo: The number of points around the interior, either one for all sides, or one per
+          axis in the order k, j, i, which may be a pair for the halo before and after it.
+    dtype: The element type, `float64` or `float32`.
+    alignment: The alignment in bytes of the first interior point of every row.
+
+    Returns:
+    An array of shape `shape` plus the halo, the interior is at the indices
+    `bounds(shape, halo)`.
+    """
+    dtype = np.dtype(dtype)
+    if len(shape) != 3:
+        raise ValueError("Fields need to be three dimensional, got shape {}".format(tuple(shape)))
+    if alignment <= 0 or alignment % dtype.itemsize != 0:
+        raise ValueError(
+            "The alignment needs to be a multiple of the size of {}".format(dtype.name)
+        )
+    halos = axis_halos(halo)
+    full_shape = tuple(size + before + after for size, (before, after) in zip(shape, halos))
+    halo_i = halos[2][0]
+
+    # The interior starts `halo_i` points into each row, the row itself starts before the
+    # aligned address so that the interior point lands on it.
+    lead = -(-halo_i * dtype.itemsize // alignment) * alignment - halo_i * dtype.itemsize
+    row = padded_stride(lead + full_shape[2] * dtype.itemsize, alignment)
+    plane = padded_stride(row * full_shape[1], alignment)
+    size = plane * full_shape[0]
+
+    buffer = np.empty(size + alignment, dtype=np.uint8)
+    shift = (-buffer.ctypes.data) % alignment + lead
+    return np.ndarray(
+        full_shape,
+        dtype=dtype,
+        buffer=buffer,
+        offset=shift,
+        strides=(plane, row, dtype.itemsize),
+    )
+
+
+def zeros(
+    shape: Sequence[int], halo: Halo = 0, dtype=np.float64, alignment: int = cache_line
+) -> np.ndarray:
+    """Allocates a field filled with zeros, see `empty`"""
+    field = empty(shape, halo, dtype, alignment)
+    field[...] = 0
+    return field
+
+
+def bounds(shape: Sequence[int], halo: Halo = 0) -> List[List[int]]:
+    """
+    The bounds of the interior of a field allocated with the given shape and halo, one
+    `[start, end]` list per array axis as the stencils take them.
+    """
+    return [[before, before + size] for size, (before, _) in zip(shape, axis_halos(halo))]
@@ -66,6 +66,18 @@ class ArgumentParser(ast.NodeVisitor):
         # TODO: check the type_comment?
         return node.arg
 
+    @staticmethod
+    def is_scalar(node: ast.arg) -> bool:
+        """Arguments annotated with `float` are scalars, the others are fields"""
+        if node.annotation is None:
+            return False
+        if isinstance(node.annotation, ast.Name) and node.annotation.id == "float":
+            return True
+        raise ValueError(
+            "Unsupported annotation of argument {}, only scalars can be annotated, "
+            "with float".format(node.arg)
+        )
+
 
 class LanguageParser(ast.NodeVisitor):
     def __init__(self):
@@ -76,8 +88,10 @@ class LanguageParser(ast.NodeVisitor):
     def visit_Constant(self, node: ast.Constant) -> ir.LiteralExpr:
         return ir.LiteralExpr(value=str(node.value))
 
-    def visit_Name(self, node: ast.Name) -> ir.FieldAccessExpr:
+    def visit_Name(self, node: ast.Name) -> ir.Expr:
         symbol = node.id
+        if symbol in self._IR.scalars:
+            return ir.ScalarAccessExpr(name=symbol)
         return ir.FieldAccessExpr(name=symbol, offset=ir.AccessOffset(0, 0, 0))
 
     def visit_Subscript(self, node: ast.Subscript) -> ir.FieldAccessExpr:
@@ -102,6 +116,8 @@ class LanguageParser(ast.NodeVisitor):
     def visit_Assign(self, node: ast.Assign) -> None:
         assert len(node.targets) == 1
         lhs = self.visit(node.targets[0])
+        if not isinstance(lhs, ir.FieldAccessExpr):
+            raise ValueError("Only fields can be assigned to, {} is a scalar".format(lhs.name))
         rhs = self.visit(node.value)
         assign = ir.AssignmentStmt(left=lhs, right=rhs)
         self._scope.body.append(assign)
@@ -130,6 +146,8 @@ class LanguageParser(ast.NodeVisitor):
         self._IR.name = node.name
         for arg in node.args.args:
             self._IR.api_signature.append(ArgumentParser.apply(arg))
+            if ArgumentParser.is_scalar(arg):
+                self._IR.scalars.append(arg.arg)
         for element in node.body:
             self.visit(element)
 
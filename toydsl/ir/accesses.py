@@ -0,0 +1,113 @@
+from __future__ import annotations
+
+from typing import List, Set
+
+import toydsl.ir.ir as ir
+from toydsl.ir.visitor import IRNodeVisitor
+
+
+class FieldCollector(IRNodeVisitor):
+    """
+    Collects the field accesses of a subtree of the IR.
+    """
+
+    def __init__(self):
+        self.accesses: List[ir.FieldAccessExpr] = []
+
+    @classmethod
+    def apply(cls, node) -> List[ir.FieldAccessExpr]:
+        collector = cls()
+        collector.visit(node)
+        return collector.accesses
+
+    def generic_visit(self, node, **kwargs) -> None:
+        pass
+
+    def visit_list_of_Node(self, nodes: List[ir.Node]) -> None:
+        for node in nodes:
+            self.visit(node)
+
+    def visit_FieldAccessExpr(self, node: ir.FieldAccessExpr) -> None:
+        self.accesses.append(node)
+
+    def visit_AssignmentStmt(self, node: ir.AssignmentStmt) -> None:
+        self.visit(node.left)
+        self.visit(node.right)
+
+    def visit_BinaryOp(self, node: ir.BinaryOp) -> None:
+        self.visit(node.left)
+        self.visit(node.right)
+
+    def visit_LocalExpr(self, node: ir.LocalExpr) -> None:
+        self.visit(node.value)
+
+    def visit_HorizontalDomain(self, node: ir.HorizontalDomain) -> None:
+        self.visit(node.body)
+
+    def visit_VerticalDomain(self, node: ir.VerticalDomain) -> None:
+        self.visit(node.body)
+
+    def visit_IR(self, node: ir.IR) -> None:
+        self.visit(node.body)
+
+
+def call_arguments(node: ir.IR) -> List[str]:
+    """The fields and scalars a computation is called with, the temporaries are dropped"""
+    return [arg for arg in node.api_signature if arg not in node.temporaries]
+
+
+def field_arguments(node: ir.IR) -> List[str]:
+    """The fields a computation is called with, without the temporaries and scalars"""
+    return [arg for arg in call_arguments(node) if arg not in node.scalars]
+
+
+def read_accesses(node) -> List[ir.FieldAccessExpr]:
+    """The field accesses on the right hand side of all the assignments in a subtree"""
+    return [access for stmt in assignments(node) for access in FieldCollector.apply(stmt.right)]
+
+
+def written_fields(node) -> Set[str]:
+    """The names of the fields that are assigned to in a subtree"""
+    return {stmt.left.name for stmt in assignments(node)}
+
+
+def accessed_fields(node) -> Set[str]:
+    """The names of the fields that are read or written in a subtree"""
+    return {access.name for access in FieldCollector.apply(node)}
+
+
+def conflicting_fields(first, second) -> Set[str]:
+    """
+    The fields that one of the subtrees writes and the other one accesses. The second
+    subtree can't run concurrently with the first one if there are any.
+    """
+    return (written_fields(first) & accessed_fields(second)) | (
+        accessed_fields(first) & written_fields(second)
+    )
+
+
+def assignments(node) -> List[ir.AssignmentStmt]:
+    """All the assignments of a subtree in program order"""
+    if isinstance(node, list):
+        return [stmt for element in node for stmt in assignments(element)]
+    if isinstance(node, ir.AssignmentStmt):
+        return [node]
+    if isinstance(node, (ir.IR, ir.VerticalDomain, ir.HorizontalDomain)):
+        return assignments(node.body)
+    return []
+
+
+def subexpressions(node: ir.Expr) -> List[ir.Expr]:
+    """An expression and all the expressions it is made of, shared values only once"""
+    result = []
+    visited_locals = set()
+    pending = [node]
+    while pending:
+        expr = pending.pop()
+        result.append(expr)
+        if isinstance(expr, ir.BinaryOp):
+            pending.extend([expr.right, expr.left])
+        elif isinstance(expr, ir.LocalExpr) and id(expr) not in visited_locals:
+            visited_locals.add(id(expr))
+            pending.append(expr.value)
+    return result
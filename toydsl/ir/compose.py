@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+import copy
+from typing import Dict, List, Tuple
+
+import toydsl.ir.ir as ir
+from toydsl.ir.passes import IRPass
+
+
+class RenameFields(IRPass):
+    """Renames the fields of an IR, the fields that are not in `names` keep their name"""
+
+    def __init__(self, names: Dict[str, str]):
+        self.names = names
+
+    def visit_IR(self, node: ir.IR) -> ir.IR:
+        node.api_signature = [self.names.get(arg, arg) for arg in node.api_signature]
+        node.temporaries = [self.names.get(arg, arg) for arg in node.temporaries]
+        node.scalars = [self.names.get(arg, arg) for arg in node.scalars]
+        return super().visit_IR(node)
+
+    def visit_FieldAccessExpr(self, node: ir.FieldAccessExpr) -> ir.FieldAccessExpr:
+        return ir.FieldAccessExpr(name=self.names.get(node.name, node.name), offset=node.offset)
+
+    def visit_ScalarAccessExpr(self, node: ir.ScalarAccessExpr) -> ir.ScalarAccessExpr:
+        return ir.ScalarAccessExpr(name=self.names.get(node.name, node.name))
+
+
+def compose(name: str, stages: List[Tuple[ir.IR, Dict[str, str]]]) -> ir.IR:
+    """
+    Concatenates the IRs of several computations into one that runs them in order.
+
+    Every stage comes with a mapping from the names of its arguments to the fields of the
+    composed IR, arguments that are not mapped keep their name. Stages sharing a field
+    name work on the same field. The signature of the composed IR lists the fields in the
+    order they first appear in the stages.
+    """
+    if not name.isidentifier():
+        raise ValueError("Invalid name of a composed computation: '{}'".format(name))
+
+    composed = ir.IR()
+    composed.name = name
+    fields = set()
+    for stage, names in stages:
+        unknown = set(names) - set(stage.api_signature)
+        if unknown:
+            raise ValueError(
+                "{} has no arguments named {}".format(stage.name, ", ".join(sorted(unknown)))
+            )
+        stage = RenameFields.apply(copy.deepcopy(stage), names=names)
+        composed.body.extend(stage.body)
+        for arg in stage.api_signature:
+            if arg not in composed.api_signature:
+                composed.api_signature.append(arg)
+        for arg in stage.temporaries:
+            if arg not in composed.temporaries:
+                composed.temporaries.append(arg)
+        for arg in stage.scalars:
+            if arg not in composed.scalars:
+                composed.scalars.append(arg)
+        fields.update(arg for arg in stage.api_signature if arg not in stage.scalars)
+    mixed = fields & set(composed.scalars)
+    if mixed:
+        raise ValueError(
+            "{} are scalars in one stage and fields in another".format(", ".join(sorted(mixed)))
+        )
+    return composed
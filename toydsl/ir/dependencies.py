@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+from typing import Iterable, List, Set
+
+import toydsl.ir.ir as ir
+from toydsl.ir.accesses import FieldCollector, assignments
+
+
+axes = ["i", "j", "k"]
+
+
+def carried_fields(node, axis: str, fixed: Iterable[str] = ()) -> Set[str]:
+    """
+    The fields through which the iterations of a loop along `axis` over a subtree depend
+    on each other, while the loops along the `fixed` axes stay on one iteration.
+
+    A write and another access of the same field touch the same point in two different
+    iterations if their offsets differ along `axis` and agree along the fixed axes. The
+    offsets along the remaining axes don't matter, their loops run over all the points
+    in every iteration.
+    """
+    axis_index = axes.index(axis)
+    fixed_indices = [axes.index(fixed_axis) for fixed_axis in fixed]
+    accesses = FieldCollector.apply(node)
+
+    carried = set()
+    for stmt in assignments(node):
+        write = stmt.left.offset.offsets
+        for access in accesses:
+            if access.name != stmt.left.name:
+                continue
+            offsets = access.offset.offsets
+            if offsets[axis_index] != write[axis_index] and all(
+                offsets[index] == write[index] for index in fixed_indices
+            ):
+                carried.add(access.name)
+    return carried
+
+
+class ParallelLoops:
+    """
+    The loops of a vertical domain whose iterations can be shared among threads.
+
+    `vertical` tells whether the levels are independent of each other. If they are not,
+    the levels are computed one after the other, and `horizontal` lists for every
+    horizontal domain the axes along which its points on one level are independent.
+    """
+
+    def __init__(self, vertical: bool, horizontal: List[Set[str]]):
+        self.vertical = vertical
+        self.horizontal = horizontal
+
+    def collapse(self, axis: str) -> bool:
+        """
+        Whether the loop over the levels can be collapsed with the loop along `axis`
+        directly inside of it, i.e. the vertical domain has a single horizontal domain
+        and both loops are parallel.
+        """
+        return self.vertical and len(self.horizontal) == 1 and axis in self.horizontal[0]
+
+
+def parallel_loops(node: ir.VerticalDomain) -> ParallelLoops:
+    """Finds the loops of a vertical domain that are free of loop carried dependencies"""
+    return ParallelLoops(
+        vertical=not carried_fields(node, "k"),
+        horizontal=[
+            {
+                axis
+                for axis in ["i", "j"]
+                if not carried_fields(horizontal_domain, axis, fixed=["k"])
+            }
+            for horizontal_domain in node.body
+        ],
+    )
@@ -0,0 +1,261 @@
+from __future__ import annotations
+
+import copy
+from typing import Dict, List, Optional, Tuple
+
+import toydsl.ir.ir as ir
+from toydsl.ir.accesses import FieldCollector, call_arguments, read_accesses, written_fields
+from toydsl.ir.passes import IRPass
+
+
+axes = ["i", "j", "k"]
+
+
+class AxisExtent:
+    """
+    The indices of a field that are accessed along one axis, relative to the bounds the
+    computation is called with.
+
+    `lower` holds the lowest accessed index relative to the start and to the end bound,
+    `upper` one past the highest accessed index. Bounds that no domain of the
+    computation is relative to are `None`.
+    """
+
+    def __init__(self):
+        self.lower: Dict[ir.LevelMarker, Optional[int]] = {
+            ir.LevelMarker.START: None,
+            ir.LevelMarker.END: None,
+        }
+        self.upper: Dict[ir.LevelMarker, Optional[int]] = {
+            ir.LevelMarker.START: None,
+            ir.LevelMarker.END: None,
+        }
+
+    def add(self, interval: ir.AxisInterval, offset: int) -> None:
+        """Adds the accesses of a domain with the given extents, shifted by `offset`"""
+        lower = self.lower[interval.start.level]
+        value = interval.start.offset + offset
+        self.lower[interval.start.level] = value if lower is None else min(lower, value)
+
+        upper = self.upper[interval.end.level]
+        value = interval.end.offset + offset
+        self.upper[interval.end.level] = value if upper is None else max(upper, value)
+
+    def halo(self) -> Tuple[int, int]:
+        """How many points the field needs before the start and after the end bound"""
+        before = self.lower[ir.LevelMarker.START]
+        after = self.upper[ir.LevelMarker.END]
+        return (
+            max(0, -before) if before is not None else 0,
+            max(0, after) if after is not None else 0,
+        )
+
+
+def field_extents(node: ir.IR) -> Dict[str, List[AxisExtent]]:
+    """The extents along the i, j and k axes of every field accessed by a computation"""
+    extents: Dict[str, List[AxisExtent]] = {}
+    for vertical_domain in node.body:
+        for horizontal_domain in vertical_domain.body:
+            intervals = horizontal_domain.extents + [vertical_domain.extents]
+            for access in FieldCollector.apply(horizontal_domain):
+                field = extents.setdefault(access.name, [AxisExtent() for _ in axes])
+                for axis in range(3):
+                    field[axis].add(intervals[axis], access.offset.offsets[axis])
+    return extents
+
+
+def field_halos(node: ir.IR) -> Dict[str, List[Tuple[int, int]]]:
+    """The halo every field needs around the bounds of a call along the i, j and k axes"""
+    return {
+        name: [extent.halo() for extent in extents]
+        for name, extents in field_extents(node).items()
+    }
+
+
+def extent_constraints(
+    extents: Dict[str, List[AxisExtent]]
+) -> List[Tuple[str, str, bool, ir.LevelMarker, int]]:
+    """
+    Lists the conditions the arrays have to satisfy for all the accesses to stay inside
+    them: `(field, axis, is_upper, level, offset)` requires `bound + offset >= 0` for
+    lower constraints, and `bound + offset <= shape` for upper ones.
+    """
+    constraints = []
+    for name, field in extents.items():
+        for axis, extent in zip(axes, field):
+            for is_upper, bounds in [(False, extent.lower), (True, extent.upper)]:
+                for level, offset in bounds.items():
+                    if offset is not None:
+                        constraints.append((name, axis, is_upper, level, offset))
+    return constraints
+
+
+def bound_name(axis: str, level: ir.LevelMarker) -> str:
+    return "{}_{}".format("start" if level == ir.LevelMarker.START else "end", axis)
+
+
+def describe_constraint(
+    name: str, axis: str, is_upper: bool, level: ir.LevelMarker, offset: int
+) -> str:
+    """The error message for an array that violates a constraint"""
+    index = "{} {} {}".format(bound_name(axis, level), "-" if offset < 0 else "+", abs(offset))
+    if is_upper:
+        return "{} is accessed up to index {} - 1 along {}, past the end of the array".format(
+            name, index, axis
+        )
+    return "{} is accessed from index {} along {}, before the start of the array".format(
+        name, index, axis
+    )
+
+
+def check_arguments(constraints, arguments: List[str], args) -> None:
+    """
+    Checks the arrays and bounds of a call `(fields..., k, j, i)` against the constraints
+    of a computation, raises a ValueError on the first violated one.
+    """
+    fields = dict(zip(arguments, args))
+    bounds = {}
+    for axis, bound in zip(["k", "j", "i"], args[len(arguments):]):
+        bounds[bound_name(axis, ir.LevelMarker.START)] = bound[0]
+        bounds[bound_name(axis, ir.LevelMarker.END)] = bound[1]
+
+    for name, axis, is_upper, level, offset in constraints:
+        if name not in fields:
+            continue
+        index = bounds[bound_name(axis, level)] + offset
+        size = fields[name].shape[2 - axes.index(axis)]
+        if (is_upper and index > size) or (not is_upper and index < 0):
+            raise ValueError(describe_constraint(name, axis, is_upper, level, offset))
+
+
+class CheckedStencil:
+    """
+    Wraps a stencil of the python backends, checking that the arrays are large enough
+    for the accesses of the computation. Every combination of shapes and bounds is only
+    checked once.
+    """
+
+    def __init__(self, stencil, node: ir.IR):
+        self.stencil = stencil
+        self.arguments = call_arguments(node)
+        self.scalars = set(node.scalars)
+        self.constraints = extent_constraints(field_extents(node))
+        self._checked = set()
+
+    def __call__(self, *args):
+        # The values of the scalars don't matter for the checks
+        signature = tuple(
+            (None if self.arguments[n] in self.scalars else arg.shape)
+            if n < len(self.arguments)
+            else tuple(arg)
+            for n, arg in enumerate(args)
+        )
+        if signature not in self._checked:
+            check_arguments(self.constraints, self.arguments, args)
+            self._checked.add(signature)
+        return self.stencil(*args)
+
+
+# The ways the domains of a computation can be adjusted to its accesses, see AdjustDomains
+domain_modes = ("shrink", "extend")
+
+
+def hull(left: ir.AxisInterval, right: ir.AxisInterval) -> ir.AxisInterval:
+    """The smallest interval containing both intervals, bounds on different levels stay"""
+    start, end = copy.deepcopy(left.start), copy.deepcopy(left.end)
+    if right.start.level == start.level:
+        start.offset = min(start.offset, right.start.offset)
+    if right.end.level == end.level:
+        end.offset = max(end.offset, right.end.offset)
+    return ir.AxisInterval(start, end)
+
+
+def shifted(interval: ir.AxisInterval, offset: int) -> ir.AxisInterval:
+    return ir.AxisInterval(
+        ir.Offset(interval.start.level, interval.start.offset + offset),
+        ir.Offset(interval.end.level, interval.end.offset + offset),
+    )
+
+
+class AdjustDomains(IRPass):
+    """
+    Infers the compute domains from the accesses instead of relying on hand written margins.
+
+    With `mode="shrink"`, every domain is made as small as necessary for its accesses to
+    stay inside the bounds of the call, and for its reads of fields written by an
+    earlier horizontal domain of the same vertical domain to stay where those were
+    computed. `Horizontal[start:end, start:end]` is then enough for every stage, the
+    margins of a laplacian of laplacian follow from the offsets.
+
+    With `mode="extend"`, the horizontal domain writing a field is extended to all the
+    points later horizontal domains of the same vertical domain read it at. The fields
+    then need a halo around the bounds of the call, see `field_halos`. This also lets
+    the fusion pass inline the producers of temporaries into their consumers.
+
+    Bounds relative to the other level marker than the bound they are compared to are
+    left as they are.
+    """
+
+    def __init__(self, mode: str):
+        if mode not in domain_modes:
+            raise ValueError(
+                "Unknown domain mode '{}', available modes are: {}".format(
+                    mode, ", ".join(domain_modes)
+                )
+            )
+        self.mode = mode
+
+    def visit_VerticalDomain(self, node: ir.VerticalDomain) -> ir.VerticalDomain:
+        # The extents are adjusted in place, domains must not share them
+        node.extents = copy.deepcopy(node.extents)
+        for horizontal_domain in node.body:
+            horizontal_domain.extents = copy.deepcopy(horizontal_domain.extents)
+
+        if self.mode == "shrink":
+            self.shrink(node)
+        else:
+            self.extend(node)
+        return node
+
+    @staticmethod
+    def shrink(node: ir.VerticalDomain) -> None:
+        computed: Dict[str, ir.HorizontalDomain] = {}
+        for horizontal_domain in node.body:
+            accesses = FieldCollector.apply(horizontal_domain)
+            intervals = horizontal_domain.extents + [node.extents]
+            for axis, interval in enumerate(intervals):
+                for access in accesses:
+                    offset = access.offset.offsets[axis]
+                    if interval.start.level == ir.LevelMarker.START:
+                        interval.start.offset = max(interval.start.offset, -offset)
+                    if interval.end.level == ir.LevelMarker.END:
+                        interval.end.offset = min(interval.end.offset, -offset)
+
+            for access in read_accesses(horizontal_domain):
+                producer = computed.get(access.name)
+                if producer is None:
+                    continue
+                for axis in range(2):
+                    interval = horizontal_domain.extents[axis]
+                    available = shifted(producer.extents[axis], -access.offset.offsets[axis])
+                    if interval.start.level == available.start.level:
+                        interval.start.offset = max(interval.start.offset, available.start.offset)
+                    if interval.end.level == available.end.level:
+                        interval.end.offset = min(interval.end.offset, available.end.offset)
+
+            for stmt in horizontal_domain.body:
+                if all(offset == 0 for offset in stmt.left.offset.offsets):
+                    computed[stmt.left.name] = horizontal_domain
+
+    @staticmethod
+    def extend(node: ir.VerticalDomain) -> None:
+        for index in reversed(range(len(node.body))):
+            producer = node.body[index]
+            produced = written_fields(producer)
+            for consumer in node.body[index + 1 :]:
+                for access in read_accesses(consumer):
+                    if access.name not in produced:
+                        continue
+                    for axis in range(2):
+                        needed = shifted(consumer.extents[axis], access.offset.offsets[axis])
+                        producer.extents[axis] = hull(producer.extents[axis], needed)
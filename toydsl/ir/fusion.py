@@ -0,0 +1,181 @@
+from __future__ import annotations
+
+import copy
+from typing import Dict, Iterable, List, Optional
+
+import toydsl.ir.ir as ir
+from toydsl.ir.accesses import FieldCollector, assignments, read_accesses, written_fields
+from toydsl.ir.passes import IRPass
+
+
+def same_offset(left: ir.Offset, right: ir.Offset) -> bool:
+    return left.level == right.level and left.offset == right.offset
+
+
+def same_extents(left: ir.HorizontalDomain, right: ir.HorizontalDomain) -> bool:
+    return all(
+        same_offset(left_extent.start, right_extent.start)
+        and same_offset(left_extent.end, right_extent.end)
+        for left_extent, right_extent in zip(left.extents, right.extents)
+    )
+
+
+def contains_shifted(
+    outer: ir.HorizontalDomain, inner: ir.HorizontalDomain, offset: ir.AccessOffset
+) -> bool:
+    """
+    Checks whether the extents of `inner` shifted by `offset` lie within the extents of
+    `outer`. Bounds relative to different level markers can't be compared, so they are
+    never considered to be contained.
+    """
+    for axis in range(2):
+        outer_axis, inner_axis = outer.extents[axis], inner.extents[axis]
+        shift = offset.offsets[axis]
+        if outer_axis.start.level != inner_axis.start.level:
+            return False
+        if outer_axis.end.level != inner_axis.end.level:
+            return False
+        if inner_axis.start.offset + shift < outer_axis.start.offset:
+            return False
+        if inner_axis.end.offset + shift > outer_axis.end.offset:
+            return False
+    return True
+
+
+def same_horizontal_offset(left: ir.AccessOffset, right: ir.AccessOffset) -> bool:
+    return left.offsets[0] == right.offsets[0] and left.offsets[1] == right.offsets[1]
+
+
+class ShiftAccesses(IRPass):
+    """Adds an offset to all the field accesses of an expression"""
+
+    def __init__(self, offset: ir.AccessOffset):
+        self.offset = offset
+
+    def visit_FieldAccessExpr(self, node: ir.FieldAccessExpr) -> ir.FieldAccessExpr:
+        return ir.FieldAccessExpr(
+            name=node.name,
+            offset=ir.AccessOffset(
+                *[a + b for a, b in zip(node.offset.offsets, self.offset.offsets)]
+            ),
+        )
+
+
+class InlineFields(IRPass):
+    """Replaces the reads of fields by the expressions that compute them"""
+
+    def __init__(self, definitions: Dict[str, ir.Expr]):
+        self.definitions = definitions
+
+    def visit_AssignmentStmt(self, node: ir.AssignmentStmt) -> ir.AssignmentStmt:
+        # Only the right hand side reads fields, the target stays as it is
+        node.right = self.visit(node.right)
+        return node
+
+    def visit_FieldAccessExpr(self, node: ir.FieldAccessExpr) -> ir.Expr:
+        if node.name not in self.definitions:
+            return node
+        return ShiftAccesses.apply(copy.deepcopy(self.definitions[node.name]), offset=node.offset)
+
+
+class FuseHorizontalDomains(IRPass):
+    """
+    Fuses consecutive horizontal domains of a vertical domain into one loop nest.
+
+    Two kinds of fusion are performed:
+
+    * Horizontal domains with the same extents are merged into one if every field written
+      by one of them is accessed by the other at the horizontal offset it is written at.
+      The statements then run in the same order for every point as they did before.
+
+    * A producer whose statements only write temporaries, fields that are not observed
+      after the call, is inlined into its consumer. The temporaries are given to the pass
+      or marked in the IR. Every read of a temporary is replaced by the expression
+      computing it, shifted by the offset of the read. This is done if
+      the consumer only reads the temporaries at points the producer computes, the
+      producer doesn't read any field that is written by the two domains, and nothing
+      else reads the temporaries. The producer is then removed, so the fused kernel
+      neither writes nor reads the temporaries.
+    """
+
+    def __init__(self, temporaries: Iterable[str] = ()):
+        self.temporaries = set(temporaries)
+        self._ir: Optional[ir.IR] = None
+
+    def visit_IR(self, node: ir.IR) -> ir.IR:
+        self._ir = node
+        self.temporaries |= set(node.temporaries)
+        return super().visit_IR(node)
+
+    def visit_VerticalDomain(self, node: ir.VerticalDomain) -> ir.VerticalDomain:
+        fused: List[ir.HorizontalDomain] = []
+        for horizontal_domain in node.body:
+            if fused:
+                merged = self.fuse(fused[-1], horizontal_domain)
+                if merged is not None:
+                    fused[-1] = merged
+                    continue
+            fused.append(horizontal_domain)
+        node.body = fused
+        return node
+
+    def fuse(
+        self, producer: ir.HorizontalDomain, consumer: ir.HorizontalDomain
+    ) -> Optional[ir.HorizontalDomain]:
+        if self.can_inline(producer, consumer):
+            definitions = {stmt.left.name: stmt.right for stmt in producer.body}
+            return InlineFields.apply(consumer, definitions=definitions)
+
+        if self.can_merge(producer, consumer):
+            producer.body.extend(consumer.body)
+            return producer
+
+        return None
+
+    @staticmethod
+    def can_merge(producer: ir.HorizontalDomain, consumer: ir.HorizontalDomain) -> bool:
+        if not same_extents(producer, consumer):
+            return False
+
+        for first, second in [(producer, consumer), (consumer, producer)]:
+            for stmt in assignments(first):
+                for access in FieldCollector.apply(second):
+                    if access.name != stmt.left.name:
+                        continue
+                    # Otherwise the other domain sees the point before or after it is
+                    # written depending on where in the loop the two points are
+                    if not same_horizontal_offset(access.offset, stmt.left.offset):
+                        return False
+        return True
+
+    def can_inline(self, producer: ir.HorizontalDomain, consumer: ir.HorizontalDomain) -> bool:
+        produced = written_fields(producer)
+        if not produced or not produced <= self.temporaries:
+            return False
+
+        for stmt in producer.body:
+            if any(offset != 0 for offset in stmt.left.offset.offsets):
+                return False
+
+        # The producer has to compute the same values no matter when it is evaluated
+        modified = produced | written_fields(consumer)
+        if any(access.name in modified for access in read_accesses(producer)):
+            return False
+
+        # The temporaries must not be used anywhere else, neither written nor read
+        for stmt in assignments(self._ir):
+            if stmt.left.name in produced and stmt not in producer.body:
+                return False
+            if any(access.name in produced for access in FieldCollector.apply(stmt.right)):
+                if stmt not in consumer.body:
+                    return False
+
+        for access in read_accesses(consumer):
+            if access.name not in produced:
+                continue
+            if access.offset.offsets[2] != 0:
+                return False
+            if not contains_shifted(producer, consumer, access.offset):
+                return False
+
+        return True
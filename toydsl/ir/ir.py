@@ -112,6 +112,13 @@ class FieldAccessExpr(Expr):
         self.offset = offset
 
 
+class ScalarAccessExpr(Expr):
+    """An access to a scalar parameter, passed at call time"""
+
+    def __init__(self, name: str):
+        self.name = name
+
+
 class AssignmentStmt(Stmt):
     """Assignments"""
 
@@ -129,6 +136,17 @@ class BinaryOp(Expr):
         self.operator = operator
 
 
+class LocalExpr(Expr):
+    """
+    A value that is computed once per point and used by several expressions of a
+    horizontal domain. All the uses of the value refer to the same node.
+    """
+
+    def __init__(self, name: str, value: Expr):
+        self.name = name
+        self.value = value
+
+
 class FieldDecl(Stmt):
     """Declarations of fields"""
 
@@ -140,3 +158,7 @@ class IR(Node):
         self.name: str = ""
         self.body: List[VerticalDomain] = []
         self.api_signature: List[str] = []
+        # Arguments that are only used as scratch space inside the computation
+        self.temporaries: List[str] = []
+        # Arguments that are scalars rather than fields, annotated with `float`
+        self.scalars: List[str] = []
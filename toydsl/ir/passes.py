@@ -0,0 +1,81 @@
+from __future__ import annotations
+
+import copy
+from typing import Any, List
+
+import toydsl.ir.ir as ir
+from toydsl.ir.visitor import IRNodeVisitor
+
+
+class IRPass(IRNodeVisitor):
+    """
+    Base class of the IR-to-IR transformations.
+
+    The default handlers walk the whole tree and replace every child by whatever its
+    visitor returns, so a pass only has to implement the handlers of the nodes it
+    rewrites. Returning `None` from a handler removes the node from its parent.
+    """
+
+    @classmethod
+    def apply(cls, node: ir.IR, **kwargs: Any) -> ir.IR:
+        return cls(**kwargs).run(node)
+
+    def run(self, node: ir.IR) -> ir.IR:
+        """Transforms a tree, a pass can run over several trees one after the other"""
+        # The ids of the locals rewritten in this tree
+        self._visited_locals = set()
+        return self.visit(node)
+
+    def generic_visit(self, node: Any, **kwargs: Any) -> Any:
+        return node
+
+    def transform_list(self, nodes: List[ir.Node]) -> List[ir.Node]:
+        transformed = [self.visit(node) for node in nodes]
+        return [node for node in transformed if node is not None]
+
+    def visit_IR(self, node: ir.IR) -> ir.IR:
+        node.body = self.transform_list(node.body)
+        return node
+
+    def visit_VerticalDomain(self, node: ir.VerticalDomain) -> ir.VerticalDomain:
+        node.body = self.transform_list(node.body)
+        return node
+
+    def visit_HorizontalDomain(self, node: ir.HorizontalDomain) -> ir.HorizontalDomain:
+        node.body = self.transform_list(node.body)
+        return node
+
+    def visit_AssignmentStmt(self, node: ir.AssignmentStmt) -> ir.AssignmentStmt:
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        return node
+
+    def visit_BinaryOp(self, node: ir.BinaryOp) -> ir.BinaryOp:
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        return node
+
+    def visit_LocalExpr(self, node: ir.LocalExpr) -> ir.LocalExpr:
+        # The value is shared by all the uses of the local, it is rewritten once
+        if id(node) not in self._visited_locals:
+            self._visited_locals.add(id(node))
+            node.value = self.visit(node.value)
+        return node
+
+
+class PassManager:
+    """
+    Runs a sequence of passes over the IR.
+
+    The passes rewrite the tree in place, so the manager works on a copy and the IR
+    returned by the frontend stays untouched.
+    """
+
+    def __init__(self, passes: List[IRPass]):
+        self.passes = passes
+
+    def apply(self, node: ir.IR) -> ir.IR:
+        node = copy.deepcopy(node)
+        for ir_pass in self.passes:
+            node = ir_pass.run(node)
+        return node
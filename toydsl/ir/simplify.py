@@ -0,0 +1,242 @@
+from __future__ import annotations
+
+import copy
+import math
+from typing import Callable, Dict, Optional, Set
+
+import toydsl.ir.ir as ir
+from toydsl.ir.passes import IRPass
+
+
+# Operators whose operands can be swapped
+commutative_operators = {"+", "*"}
+
+# Powers with an integer exponent up to this magnitude are expanded into multiplications
+max_expanded_power = 16
+
+
+def literal_value(node: ir.Expr) -> Optional[float]:
+    """The value of a numeric literal, `None` for anything else"""
+    if not isinstance(node, ir.LiteralExpr):
+        return None
+    try:
+        return float(node.value)
+    except ValueError:
+        return None
+
+
+def make_literal(value: float) -> ir.LiteralExpr:
+    return ir.LiteralExpr(value=repr(float(value)))
+
+
+def evaluate(operator: str, left: float, right: float) -> Optional[float]:
+    """The result of a binary operator on two constants, `None` if it can't be folded"""
+    try:
+        if operator == "+":
+            result = left + right
+        elif operator == "-":
+            result = left - right
+        elif operator == "*":
+            result = left * right
+        elif operator == "/":
+            result = left / right
+        elif operator == "**":
+            result = left ** right
+        else:
+            # `%` rounds differently in python and C++, it is left to the backends
+            return None
+    except (ZeroDivisionError, OverflowError):
+        return None
+    if not isinstance(result, float) or not math.isfinite(result):
+        return None
+    return result
+
+
+def expand_power(base: ir.Expr, exponent: int) -> ir.Expr:
+    """
+    Expands `base ** exponent` for a positive exponent into multiplications by repeated
+    squaring. The squared operands are copies of each other, the common subexpression
+    elimination turns them into one value.
+    """
+    if exponent == 1:
+        return base
+    half = expand_power(base, exponent // 2)
+    square = ir.BinaryOp(left=half, right=copy.deepcopy(half), operator="*")
+    if exponent % 2 == 1:
+        return ir.BinaryOp(left=square, right=copy.deepcopy(base), operator="*")
+    return square
+
+
+class SimplifyExpressions(IRPass):
+    """
+    Algebraic simplification of the expressions of a computation.
+
+    Operations on constants are folded, additions of zero and multiplications by one are
+    dropped, divisions by a constant become multiplications by its reciprocal and powers
+    with a small integer exponent are expanded into multiplications. Afterwards, the
+    subexpressions that are computed more than once on the same point of a horizontal
+    domain are replaced by `LocalExpr` nodes, which the backends compute only once.
+
+    This runs after the passes that move expressions around, since those don't expect
+    the values of the locals to be shared.
+    """
+
+    def __init__(self):
+        self._reserved: Set[str] = set()
+        self._local_count = 0
+
+    def visit_IR(self, node: ir.IR) -> ir.IR:
+        self._reserved = set(node.api_signature)
+        return super().visit_IR(node)
+
+    def visit_HorizontalDomain(self, node: ir.HorizontalDomain) -> ir.HorizontalDomain:
+        node.body = self.transform_list(node.body)
+        CommonSubexpressions(self.new_local_name).apply_to(node)
+        return node
+
+    def visit_AssignmentStmt(self, node: ir.AssignmentStmt) -> ir.AssignmentStmt:
+        node.right = self.visit(node.right)
+        return node
+
+    def visit_BinaryOp(self, node: ir.BinaryOp) -> ir.Expr:
+        node.left = self.visit(node.left)
+        node.right = self.visit(node.right)
+        left, right = literal_value(node.left), literal_value(node.right)
+
+        if left is not None and right is not None:
+            result = evaluate(node.operator, left, right)
+            if result is not None:
+                return make_literal(result)
+
+        if node.operator == "+" and left == 0:
+            return node.right
+        if node.operator in ("+", "-") and right == 0:
+            return node.left
+        if node.operator == "*" and left == 1:
+            return node.right
+        if node.operator in ("*", "/") and right == 1:
+            return node.left
+
+        if node.operator == "/" and right is not None and right != 0:
+            reciprocal = evaluate("/", 1.0, right)
+            if reciprocal is not None:
+                return ir.BinaryOp(left=node.left, right=make_literal(reciprocal), operator="*")
+
+        if node.operator == "**" and right is not None and right.is_integer():
+            exponent = int(right)
+            if exponent == 0:
+                return make_literal(1.0)
+            if abs(exponent) <= max_expanded_power:
+                power = self.visit(expand_power(node.left, abs(exponent)))
+                if exponent < 0:
+                    return ir.BinaryOp(left=make_literal(1.0), right=power, operator="/")
+                return power
+
+        return node
+
+    def new_local_name(self) -> str:
+        while True:
+            name = "local_{}".format(self._local_count)
+            self._local_count += 1
+            if name not in self._reserved:
+                return name
+
+
+class CommonSubexpressions:
+    """
+    Replaces the operations that a horizontal domain computes more than once on each
+    point by locals. Two operations are the same if they apply the same operator to the
+    same field accesses and constants, up to the order of the operands of commutative
+    operators, and none of the fields they read is written in between.
+    """
+
+    def __init__(self, new_name: Callable[[], str]):
+        self.new_name = new_name
+        # The number of writes to each field by the statements before the current one
+        self._versions: Dict[str, int] = {}
+        self._counts: Dict[str, int] = {}
+        self._locals: Dict[str, ir.LocalExpr] = {}
+
+    def apply_to(self, node: ir.HorizontalDomain) -> None:
+        for stmt in node.body:
+            self.count(stmt.right)
+            self.written(stmt)
+
+        self._versions = {}
+        for stmt in node.body:
+            stmt.right = self.replace(stmt.right)
+            self.written(stmt)
+
+        # An operation that only occurs inside of a repeated operation is computed once anyway
+        uses: Dict[int, int] = {}
+        for stmt in node.body:
+            self.count_uses(stmt.right, uses)
+        inlined: Set[int] = set()
+        for stmt in node.body:
+            stmt.right = self.inline_single_uses(stmt.right, uses, inlined)
+
+    def written(self, stmt: ir.AssignmentStmt) -> None:
+        name = stmt.left.name
+        self._versions[name] = self._versions.get(name, 0) + 1
+
+    def key(self, node: ir.Expr) -> str:
+        if isinstance(node, ir.FieldAccessExpr):
+            return "{}{}#{}".format(
+                node.name, node.offset.offsets, self._versions.get(node.name, 0)
+            )
+        if isinstance(node, ir.LiteralExpr):
+            value = literal_value(node)
+            return repr(value) if value is not None else node.value
+        if isinstance(node, ir.ScalarAccessExpr):
+            # The scalars can't be written, their value is the same everywhere
+            return node.name
+        if isinstance(node, ir.LocalExpr):
+            return self.key(node.value)
+        operands = [self.key(node.left), self.key(node.right)]
+        if node.operator in commutative_operators:
+            operands.sort()
+        return "({}{}{})".format(operands[0], node.operator, operands[1])
+
+    def count(self, node: ir.Expr) -> None:
+        if isinstance(node, ir.BinaryOp):
+            self.count(node.left)
+            self.count(node.right)
+            key = self.key(node)
+            self._counts[key] = self._counts.get(key, 0) + 1
+
+    def replace(self, node: ir.Expr) -> ir.Expr:
+        if not isinstance(node, ir.BinaryOp):
+            return node
+        key = self.key(node)
+        if key in self._locals:
+            return self._locals[key]
+        node.left = self.replace(node.left)
+        node.right = self.replace(node.right)
+        if self._counts.get(key, 0) > 1:
+            local = ir.LocalExpr(name="", value=node)
+            self._locals[key] = local
+            return local
+        return node
+
+    def count_uses(self, node: ir.Expr, uses: Dict[int, int]) -> None:
+        if isinstance(node, ir.LocalExpr):
+            uses[id(node)] = uses.get(id(node), 0) + 1
+            if uses[id(node)] == 1:
+                self.count_uses(node.value, uses)
+        elif isinstance(node, ir.BinaryOp):
+            self.count_uses(node.left, uses)
+            self.count_uses(node.right, uses)
+
+    def inline_single_uses(self, node: ir.Expr, uses: Dict[int, int], inlined: Set[int]) -> ir.Expr:
+        if isinstance(node, ir.LocalExpr):
+            if uses[id(node)] == 1:
+                return self.inline_single_uses(node.value, uses, inlined)
+            if id(node) not in inlined:
+                inlined.add(id(node))
+                node.value = self.inline_single_uses(node.value, uses, inlined)
+                node.name = self.new_name()
+            return node
+        if isinstance(node, ir.BinaryOp):
+            node.left = self.inline_single_uses(node.left, uses, inlined)
+            node.right = self.inline_single_uses(node.right, uses, inlined)
+        return node
@@ -0,0 +1,69 @@
+from __future__ import annotations
+
+import toydsl.ir.ir as ir
+from toydsl.ir.accesses import FieldCollector, read_accesses, written_fields
+from toydsl.ir.fusion import contains_shifted
+from toydsl.ir.passes import IRPass
+
+
+class FindTemporaries(IRPass):
+    """
+    Marks the arguments that are only used as scratch space as temporaries.
+
+    A field is a temporary if it is written by exactly one horizontal domain, without
+    offset, and it is only read back by later horizontal domains of the same vertical domain,
+    on the same level and within the extents it was written on. Every value that is read
+    is then computed earlier in the same call on the same level, so a single plane per
+    thread is enough to hold the field.
+
+    This assumes that the caller doesn't look at the content of these arguments after
+    the call, which is why the analysis is opt-in.
+    """
+
+    def visit_IR(self, node: ir.IR) -> ir.IR:
+        for name in node.api_signature:
+            if name not in node.temporaries and self.is_temporary(node, name):
+                node.temporaries.append(name)
+        return node
+
+    @staticmethod
+    def is_temporary(node: ir.IR, name: str) -> bool:
+        writers = [
+            (vertical_domain, index)
+            for vertical_domain in node.body
+            for index, horizontal_domain in enumerate(vertical_domain.body)
+            if name in written_fields(horizontal_domain)
+        ]
+        if len(writers) != 1:
+            return False
+        vertical_domain, index = writers[0]
+        writer = vertical_domain.body[index]
+
+        for stmt in writer.body:
+            if stmt.left.name == name and any(offset != 0 for offset in stmt.left.offset.offsets):
+                return False
+        if any(access.name == name for access in read_accesses(writer)):
+            return False
+
+        # Nothing but the later horizontal domains of the same vertical domain may read it
+        readers = vertical_domain.body[index + 1 :]
+        for other in node.body:
+            for horizontal_domain in other.body:
+                if horizontal_domain is writer or any(horizontal_domain is r for r in readers):
+                    continue
+                if any(access.name == name for access in FieldCollector.apply(horizontal_domain)):
+                    return False
+
+        # Fields that are never read back are the outputs of the computation
+        is_read = False
+        for reader in readers:
+            for access in read_accesses(reader):
+                if access.name != name:
+                    continue
+                if access.offset.offsets[2] != 0:
+                    return False
+                if not contains_shifted(writer, reader, access.offset):
+                    return False
+                is_read = True
+
+        return is_read